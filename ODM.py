@@ -5,20 +5,48 @@ __students__ = 'Santiago Garcia Dominguez & Fernando Contreras Ramirez'
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut
 import time
-from typing import Generator, Any, Self
+from typing import Generator, AsyncGenerator, Any, Self, Callable
 from geojson import Point
 import pymongo
 from pymongo.mongo_client import MongoClient
+from pymongo import AsyncMongoClient
 from pymongo.server_api import ServerApi
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
 from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
+import bson
+from bson import json_util
+import hashlib
+import struct
+import zlib
 import yaml
 from dotenv import load_dotenv
 import redis
+import redis.asyncio
+import asyncio
 import os
 import json
+import csv
+import bisect
 import random
-from sesiones import Sesiones
-from helpdesk import HelpDesk
+import threading
+import uuid
+import queue
+import logging
+from concurrent.futures import Future
+import unicodedata
+import re
+from collections import OrderedDict
+from collections.abc import MutableMapping, MutableSet, Iterator
+import operator
+import math
+from collections import Counter
+from contextvars import ContextVar
+from abc import ABC, abstractmethod
+from sesiones import Sesiones, AsyncSesiones
+from helpdesk import HelpDesk, AsyncHelpDesk
 
 load_dotenv()
 
@@ -28,120 +56,1893 @@ REDIS_HOST = os.getenv("REDIS_HOST")
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME")
 DEFINITIONS_PATH = os.getenv("DEF_PATH")
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "10000"))
+GEOCODE_TTL = int(os.getenv("GEOCODE_TTL", str(30*24*60*60)))
+GEOCODE_NEGATIVE_TTL = int(os.getenv("GEOCODE_NEGATIVE_TTL", "3600"))
+# Nominatim pide como maximo una peticion por segundo
+GEOCODE_RATE = float(os.getenv("GEOCODE_RATE", "1"))
+GEOCODE_ASYNC = os.getenv("GEOCODE_ASYNC", "0") == "1"
+# Backends de geocodificacion en orden, p.ej. "gazetteer,nominatim"
+GEOCODER = os.getenv("GEOCODER")
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH")
+# Formato de las entradas cache:<Modelo>:<id> y a partir de que tamaño se comprimen
+CACHE_SERIALIZER = os.getenv("CACHE_SERIALIZER", "bson")
+CACHE_COMPRESS_THRESHOLD = int(os.getenv("CACHE_COMPRESS_THRESHOLD", "1024"))
+# Proteccion contra estampidas en find_by_id: los ultimos CACHE_STALE_TTL
+# segundos de vida de una entrada se consideran caducados pero servibles
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "60"))
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", "5"))
+CACHE_LOCK_WAIT = float(os.getenv("CACHE_LOCK_WAIT", "0.2"))
+# Refresco anticipado probabilistico (XFetch), 0 lo desactiva
+CACHE_EARLY_REFRESH_BETA = float(os.getenv("CACHE_EARLY_REFRESH_BETA", "0"))
+# TTL por defecto de cache:<Modelo>:<id>, cada modelo puede cambiarlo en models.yml
+CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))
+# Cuanto se recuerda en cache que un id no existe
+CACHE_NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", "30"))
+# Cache local (L1) delante de Redis: entradas, bytes y TTL de seguridad. 0 entradas la desactiva
+CACHE_L1_SIZE = int(os.getenv("CACHE_L1_SIZE", "0"))
+CACHE_L1_BYTES = int(os.getenv("CACHE_L1_BYTES", str(64*1024*1024)))
+CACHE_L1_TTL = float(os.getenv("CACHE_L1_TTL", "60"))
+# Cache de resultados de find(cache=True), se puede cambiar por modelo en models.yml
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "60"))
+QUERY_CACHE_MAX_RESULTS = int(os.getenv("QUERY_CACHE_MAX_RESULTS", "1000"))
+# Vigilante de change streams: "" desactivado, "invalidate" o "refresh"
+CACHE_WATCH = os.getenv("CACHE_WATCH", "")
+CACHE_WATCH_BATCH = int(os.getenv("CACHE_WATCH_BATCH", "100"))
+CACHE_WATCH_WAIT = float(os.getenv("CACHE_WATCH_WAIT", "0.5"))
+# Registro de accesos de find_by_id (track_access en la seccion cache):
+# vida media de los contadores, maximo de ids por modelo y cada cuanto se vuelcan
+CACHE_ACCESS_HALF_LIFE = float(os.getenv("CACHE_ACCESS_HALF_LIFE", str(24*60*60)))
+CACHE_ACCESS_MAX = int(os.getenv("CACHE_ACCESS_MAX", "100000"))
+CACHE_ACCESS_FLUSH = float(os.getenv("CACHE_ACCESS_FLUSH", "5"))
+# Precarga al arrancar de los CACHE_WARMUP_TOP ids mas leidos (0 la desactiva), a CACHE_WARMUP_RATE docs/s
+CACHE_WARMUP_TOP = int(os.getenv("CACHE_WARMUP_TOP", "0"))
+CACHE_WARMUP_RATE = float(os.getenv("CACHE_WARMUP_RATE", "500"))
+# Write-behind (seccion write_behind de models.yml): lote, espera maxima y
+# entradas sin aplicar a partir de las que save() espera al flush
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+WRITE_BEHIND_WAIT = float(os.getenv("WRITE_BEHIND_WAIT", "1"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+# Segundos que login_token recuerda en el proceso los privilegios de un token (0 no los recuerda)
+SESSION_TOKEN_CACHE_TTL = float(os.getenv("SESSION_TOKEN_CACHE_TTL", "0"))
+SESSION_TOKEN_CACHE_SIZE = int(os.getenv("SESSION_TOKEN_CACHE_SIZE", "10000"))
+# Cola de ayuda: shards entre los que se reparte y prioridad que gana una peticion por segundo de espera
+HELPDESK_SHARDS = int(os.getenv("HELPDESK_SHARDS", "1"))
+HELPDESK_AGING = float(os.getenv("HELPDESK_AGING", "0"))
 
 
 redis_client = redis.Redis(host=REDIS_HOST,port=11207,db=0,username=REDIS_UNAME,password=REDIS_PASSWORD,decode_responses=True)
-CACHE: dict[str, Point | str] = {} #clave string valor Point
+async_redis_client = redis.asyncio.Redis(host=REDIS_HOST,port=11207,db=0,username=REDIS_UNAME,password=REDIS_PASSWORD,decode_responses=True)
+# La cache de modelos guarda binario, sus clientes no decodifican las respuestas
+redis_cache_client = redis.Redis(host=REDIS_HOST,port=11207,db=0,username=REDIS_UNAME,password=REDIS_PASSWORD,decode_responses=False)
+async_redis_cache_client = redis.asyncio.Redis(host=REDIS_HOST,port=11207,db=0,username=REDIS_UNAME,password=REDIS_PASSWORD,decode_responses=False)
 FAIL_MESSAGE = "No se pudieron obtener coordenadas"
 NOT_ADMITTED_VARIABLE = "No esta permitida usar esta variable"
 
-def getLocationPoint(address: str) -> Point:
+logger = logging.getLogger(__name__)
+
+# Abreviaturas habituales en direcciones españolas
+_ABREVIATURAS = {
+    "c/": "calle ",
+    "avda.": "avenida ",
+    "avda": "avenida ",
+    "av.": "avenida ",
+    "pza.": "plaza ",
+    "pº": "paseo ",
+    "ctra.": "carretera ",
+}
+
+
+def normalizar_direccion(address: str) -> str:
+    """
+    Normaliza una direccion para usarla como clave de cache: minusculas, sin
+    tildes, abreviaturas expandidas y espacios y comas uniformes.
+    "C/ Gran Vía 12,Madrid" y "calle gran via 12, madrid" dan la misma clave.
+    """
+    texto = address.strip().lower()
+    for abreviatura, completa in _ABREVIATURAS.items():
+        texto = re.sub(r"(?<!\w)" + re.escape(abreviatura), completa, texto)
+    texto = unicodedata.normalize("NFKD", texto)
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r"\s*,\s*", ", ", texto)
+    return re.sub(r"\s+", " ", texto).strip(" ,")
+
+
+class GeocodeCache:
+    """
+    Cache de geocodificacion en dos niveles: un LRU en memoria limitado a
+    maxsize entradas y, si se configura con initRedis, claves geocode:<direccion>
+    en Redis compartidas por todos los procesos. Los resultados negativos
+    (direccion no encontrada) se guardan con un TTL corto.
+    """
+
+    _PREFIJO = "geocode:"
+    _NEGATIVO = ""
+
+    def __init__(self, maxsize: int = GEOCODE_CACHE_SIZE, ttl: int = GEOCODE_TTL, negative_ttl: int = GEOCODE_NEGATIVE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._redis = None
+        # direccion normalizada -> (Point o None si no existe, instante de caducidad o None)
+        self._lru: OrderedDict[str, tuple[Point | None, float | None]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def initRedis(self, redis_client) -> None:
+        self._redis = redis_client
+
+    def __contains__(self, address: str) -> bool:
+        # Sin estadisticas: un "in" seguido de get contaria la consulta dos veces
+        return self._buscar(normalizar_direccion(address), contar=False)[0]
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def get(self, address: str) -> tuple[bool, Point | None]:
+        """Devuelve (encontrado, punto). El punto es None si se cacheo como inexistente."""
+        return self._buscar(normalizar_direccion(address), contar=True)
+
+    def _buscar(self, clave: str, contar: bool) -> tuple[bool, Point | None]:
+        with self._lock:
+            entrada = self._lru.get(clave)
+            if entrada is not None:
+                point, caduca = entrada
+                if caduca is None or caduca > time.monotonic():
+                    self._lru.move_to_end(clave)
+                    if contar:
+                        self.hits += 1
+                    return True, point
+                del self._lru[clave]
+
+        if self._redis is not None:
+            try:
+                valor = self._redis.get(self._PREFIJO + clave)
+            except redis.exceptions.RedisError:
+                valor = None
+            if valor is not None:
+                point = None if valor == self._NEGATIVO else Point(tuple(json.loads(valor)))
+                self._guardar_local(clave, point)
+                if contar:
+                    with self._lock:
+                        self.redis_hits += 1
+                return True, point
+
+        if contar:
+            with self._lock:
+                self.misses += 1
+        return False, None
+
+    def set(self, address: str, point: Point | None) -> None:
+        clave = normalizar_direccion(address)
+        self._guardar_local(clave, point)
+
+        if self._redis is not None:
+            try:
+                if point is None:
+                    self._redis.setex(self._PREFIJO + clave, self.negative_ttl, self._NEGATIVO)
+                else:
+                    self._redis.setex(self._PREFIJO + clave, self.ttl, json.dumps(point["coordinates"]))
+            except redis.exceptions.RedisError:
+                pass
+
+    def _guardar_local(self, clave: str, point: Point | None) -> None:
+        caduca = time.monotonic() + self.negative_ttl if point is None else None
+        with self._lock:
+            self._lru[clave] = (point, caduca)
+            self._lru.move_to_end(clave)
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "size": len(self._lru),
+        }
+
+
+CACHE = GeocodeCache()
+
+
+class TokenBucket:
+    """
+    Limitador de ritmo: rate peticiones por segundo con rafagas de hasta
+    capacity. acquire() espera solo lo necesario en lugar de un sleep fijo.
+    """
+
+    def __init__(self, rate: float = GEOCODE_RATE, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (ahora - self._ultimo) * self.rate)
+            self._ultimo = ahora
+            # Si no hay token reservamos el siguiente y esperamos a que llegue
+            self._tokens -= 1
+            espera = -self._tokens / self.rate if self._tokens < 0 else 0
+        if espera > 0:
+            time.sleep(espera)
+
+
+RATE_LIMITER = TokenBucket()
+_geocoder_lock = threading.Lock()
+_geocoder: Any = None
+
+
+def _get_geocoder() -> Any:
+    """Cliente de Nominatim compartido, se crea una sola vez."""
+    global _geocoder
+    with _geocoder_lock:
+        if _geocoder is None:
+            _geocoder = Nominatim(user_agent="santifer")
+        return _geocoder
+
+
+class Geocoder(ABC):
+    """
+    Interfaz de los backends de geocodificacion. geocode() devuelve el punto
+    o None si no encuentra la direccion. Los backends remotos pasan por la
+    cache de geocodificacion; los locales se consultan antes que ella.
+    """
+
+    remoto = True
+
+    @abstractmethod
+    def geocode(self, address: str) -> Point | None:
+        ...
+
+
+class NominatimGeocoder(Geocoder):
+    """Geocoder de OpenStreetMap, con limitador de ritmo y tres intentos."""
+
+    def __init__(self, attempts: int = 3):
+        self.attempts = attempts
+
+    def geocode(self, address: str) -> Point | None:
+        attempts = 0
+
+        while True:
+            try:
+                RATE_LIMITER.acquire()
+                location = _get_geocoder().geocode(address)
+                break
+            except GeocoderTimedOut:
+                attempts +=1
+                if attempts >= self.attempts:
+                    raise ValueError(FAIL_MESSAGE)
+                continue
+
+        if location is None:
+            return None
+        return Point((location.longitude, location.latitude))
+
+
+class GazetteerGeocoder(Geocoder):
+    """
+    Geocoder offline a partir de un callejero local en CSV con columnas
+    direccion, codigo_postal, lon y lat, y opcionalmente localidad
+    (direccion, codigo_postal o localidad pueden ir vacios). Se carga en
+    memoria en un indice exacto por direccion normalizada, un indice por
+    codigo postal y una lista ordenada de direcciones para las busquedas
+    por prefijo.
+
+    Orden de busqueda: direccion exacta, la calle mas larga que sea prefijo
+    de la direccion ("calle gran via" para "C/ Gran Via 12, Madrid"), una
+    direccion del callejero que empiece por la buscada y por ultimo el
+    codigo postal. Las busquedas por prefijo solo valen si la direccion
+    buscada contiene el codigo postal o la localidad de la fila: "calle
+    mayor" no sirve para "Calle Mayor 1, Salamanca" si es la de Madrid, y
+    la busqueda sigue con el siguiente backend.
+    """
+
+    remoto = False
+
+    def __init__(self, path: str | None = None):
+        # direccion normalizada -> [(punto, codigo postal, localidad normalizada)]
+        self._exacto: dict[str, list[tuple[Point, str, str]]] = {}
+        self._postal: dict[str, Point] = {}
+        self._ordenadas: list[str] = []
+        if path:
+            self.load(path)
+
+    def load(self, path: str) -> None:
+        with open(path, newline="", encoding="utf-8") as file:
+            for fila in csv.DictReader(file):
+                point = Point((float(fila["lon"]), float(fila["lat"])))
+                codigo = (fila.get("codigo_postal") or "").strip()
+                if fila.get("direccion"):
+                    localidad = normalizar_direccion(fila.get("localidad") or "")
+                    self._exacto.setdefault(normalizar_direccion(fila["direccion"]), []).append((point, codigo, localidad))
+                if codigo:
+                    self._postal[codigo] = point
+        self._ordenadas = sorted(self._exacto)
+
+    def __len__(self) -> int:
+        return sum(map(len, self._exacto.values())) + len(self._postal)
+
+    def geocode(self, address: str) -> Point | None:
+        clave = normalizar_direccion(address)
+
+        if clave in self._exacto:
+            point = self._elegir(self._exacto[clave], clave, exigir_zona=False)
+            if point is not None:
+                return point
+
+        # Calle mas larga del callejero que sea prefijo de la direccion
+        palabras = re.split(r"[\s,]+", clave)
+        for n in range(len(palabras) - 1, 0, -1):
+            prefijo = " ".join(palabras[:n])
+            if prefijo in self._exacto:
+                point = self._elegir(self._exacto[prefijo], clave, exigir_zona=True)
+                if point is not None:
+                    return point
+
+        # Direccion del callejero que empiece por la buscada
+        indice = bisect.bisect_left(self._ordenadas, clave)
+        while indice < len(self._ordenadas) and self._ordenadas[indice].startswith(clave):
+            point = self._elegir(self._exacto[self._ordenadas[indice]], clave, exigir_zona=True)
+            if point is not None:
+                return point
+            indice += 1
+
+        codigo = re.search(r"\b\d{5}\b", clave)
+        if codigo and codigo.group() in self._postal:
+            return self._postal[codigo.group()]
+
+        return None
+
+    @staticmethod
+    def _elegir(entradas: list[tuple[Point, str, str]], clave: str, exigir_zona: bool) -> Point | None:
+        # La fila cuyo codigo postal o localidad aparece en la direccion buscada
+        for point, codigo, localidad in entradas:
+            if (codigo and re.search(rf"\b{re.escape(codigo)}\b", clave)) or \
+                    (localidad and re.search(rf"(?<!\w){re.escape(localidad)}(?!\w)", clave)):
+                return point
+        # Sin prefijo la direccion es la misma; solo se duda si hay varias filas
+        if not exigir_zona and len(entradas) == 1:
+            return entradas[0][0]
+        return None
+
+
+GEOCODER_BACKENDS: dict[str, type[Geocoder]] = {
+    "nominatim": NominatimGeocoder,
+    "gazetteer": GazetteerGeocoder,
+}
+
+GEOCODERS: list[Geocoder] = [NominatimGeocoder()]
+
+
+def configurar_geocoders(backends: list[str], gazetteer_path: str | None = None) -> None:
+    """
+    Selecciona los backends de geocodificacion, en orden de consulta.
+
+    Parameters
+    ----------
+        backends : list[str]
+            nombres de GEOCODER_BACKENDS, p.ej. ["gazetteer", "nominatim"]
+        gazetteer_path : str
+            CSV del callejero para el backend gazetteer
+    """
+    nuevos: list[Geocoder] = []
+    for nombre in backends:
+        if nombre not in GEOCODER_BACKENDS:
+            raise ValueError(f"Geocoder desconocido: '{nombre}'")
+        if nombre == "gazetteer":
+            if not gazetteer_path:
+                raise ValueError("El geocoder 'gazetteer' necesita gazetteer_path")
+            nuevos.append(GazetteerGeocoder(gazetteer_path))
+        else:
+            nuevos.append(GEOCODER_BACKENDS[nombre]())
+    GEOCODERS[:] = nuevos
+
+
+def _geocodificar_offline(address: str) -> Point | None:
+    for geocoder in GEOCODERS:
+        if not geocoder.remoto:
+            point = geocoder.geocode(address)
+            if point is not None:
+                return point
+    return None
+
+
+def getLocationPoint(address: str) -> Point | None:
+    """
+    Geocodifica una direccion con los backends de GEOCODERS. Devuelve None si
+    ninguno la encuentra y lanza ValueError si todos los remotos fallan
+    (por ejemplo tres timeouts seguidos de Nominatim).
+    """
 
     if not address:
         raise ValueError(FAIL_MESSAGE)
+
+    # Los backends locales no necesitan cache
+    point = _geocodificar_offline(address)
+    if point is not None:
+        return point
     
-    if address in CACHE:
-        return CACHE[address] 
-    
-    location = None
-    attempts = 0
+    encontrado, point = CACHE.get(address)
+    if encontrado:
+        return point
 
-    while location is None:
+    error = None
+    for geocoder in GEOCODERS:
+        if not geocoder.remoto:
+            continue
         try:
-            time.sleep(2)
-            location = Nominatim(user_agent="santifer").geocode(address)
-        except GeocoderTimedOut:
-            attempts +=1
-            if attempts >= 3:
-                raise ValueError(FAIL_MESSAGE)
+            point = geocoder.geocode(address)
+        except ValueError as e:
+            # Probamos con el siguiente backend
+            error = e
             continue
+        if point is not None:
+            break
+    else:
+        if error is not None:
+            raise error
 
-    point = Point((location.longitude, location.latitude))
-    CACHE[address] = point
+    # Cacheamos tambien los negativos, con TTL corto
+    CACHE.set(address, point)
     return point
 
 
+class GeocodeQueue:
+    """
+    Cola de geocodificacion en segundo plano. submit() devuelve un Future y
+    las direcciones repetidas (tras normalizarlas) comparten el mismo Future,
+    asi que cada direccion se geocodifica una sola vez. Un hilo trabajador
+    saca las peticiones por lotes y las resuelve con getLocationPoint, que ya
+    aplica la cache y el limitador de ritmo.
+    """
+
+    def __init__(self, batch_size: int = 50):
+        self.batch_size = batch_size
+        self._cola: queue.Queue[str] = queue.Queue()
+        self._pendientes: dict[str, tuple[str, Future]] = {}
+        self._lock = threading.Lock()
+        self._hilo: threading.Thread | None = None
+
+    @property
+    def activo(self) -> bool:
+        return self._hilo is not None and self._hilo.is_alive()
+
+    def start(self) -> None:
+        if not self.activo:
+            self._hilo = threading.Thread(target=self._trabajar, name="geocode-queue", daemon=True)
+            self._hilo.start()
+
+    def submit(self, address: str, consultar_cache: bool = True) -> Future:
+        """
+        Pide la geocodificacion de una direccion. Lo que esta en los backends
+        locales o en la cache se resuelve ya; con consultar_cache=False (desde
+        un bucle de eventos, donde no se puede esperar a Redis) eso tambien
+        lo hace el hilo trabajador.
+        """
+        clave = normalizar_direccion(address)
+        with self._lock:
+            if clave in self._pendientes:
+                return self._pendientes[clave][1]
+
+        if consultar_cache:
+            # Fuera del lock, para no hacer esperar a otros hilos por Redis
+            point = _geocodificar_offline(address)
+            encontrado = point is not None
+            if not encontrado:
+                encontrado, point = CACHE.get(address)
+            if encontrado:
+                future: Future = Future()
+                future.set_result(point)
+                return future
+
+        with self._lock:
+            if clave in self._pendientes:
+                return self._pendientes[clave][1]
+            future = Future()
+            self._pendientes[clave] = (address, future)
+        self._cola.put(clave)
+        self.start()
+        return future
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Espera a que terminen todas las geocodificaciones pendientes."""
+        limite = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                futures = [future for _, future in self._pendientes.values()]
+            if not futures:
+                return True
+            for future in futures:
+                restante = None if limite is None else max(0, limite - time.monotonic())
+                try:
+                    future.exception(timeout=restante)
+                except TimeoutError:
+                    return False
+
+    def _trabajar(self) -> None:
+        while True:
+            lote = [self._cola.get()]
+            while len(lote) < self.batch_size:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+
+            for clave in lote:
+                with self._lock:
+                    address, future = self._pendientes[clave]
+                try:
+                    future.set_result(getLocationPoint(address))
+                except Exception as e:
+                    logger.warning("No se pudo geocodificar '%s': %s", address, e)
+                    future.set_exception(e)
+                finally:
+                    with self._lock:
+                        del self._pendientes[clave]
+
+
+GEOCODE_QUEUE = GeocodeQueue()
+
+
+class CacheSerializer(ABC):
+    """
+    Formato de los documentos en la cache de Redis. id es el byte que lo
+    identifica en la cabecera de cada entrada, asi se pueden leer entradas
+    de cualquier formato registrado aunque se escriba con otro.
+    """
+
+    id: bytes
+
+    @abstractmethod
+    def dumps(self, doc: dict) -> bytes:
+        ...
+
+    @abstractmethod
+    def loads(self, data: bytes) -> dict:
+        ...
+
+
+class BsonSerializer(CacheSerializer):
+    """BSON: conserva ObjectId, datetime y el resto de tipos igual que MongoDB."""
+
+    id = b"b"
+
+    def dumps(self, doc: dict) -> bytes:
+        return bson.encode(doc)
+
+    def loads(self, data: bytes) -> dict:
+        return bson.decode(data)
+
+
+class JsonSerializer(CacheSerializer):
+    """
+    JSON extendido de MongoDB: ObjectId, datetime y el resto de tipos BSON
+    sobreviven al viaje. Las entradas antiguas guardaban el _id como texto.
+    """
+
+    id = b"j"
+
+    def dumps(self, doc: dict) -> bytes:
+        return json_util.dumps(doc).encode("utf-8")
+
+    def loads(self, data: bytes) -> dict:
+        return json_util.loads(data)
+
+
+CACHE_SERIALIZERS: dict[str, CacheSerializer] = {
+    "bson": BsonSerializer(),
+    "json": JsonSerializer(),
+}
+_SERIALIZERS_POR_ID = {serializer.id: serializer for serializer in CACHE_SERIALIZERS.values()}
+
+# Cabecera de las entradas: version del formato, serializer y compresion
+_CACHE_VERSION = b"\x01"
+_SIN_COMPRIMIR = b"-"
+_ZLIB = b"z"
+# Entrada con parches: esta marca y segmentos de 4 bytes de longitud mas una
+# entrada normal. El primero es el documento y el resto $set y $unset por
+# rutas que se le aplican al leerla
+_CACHE_PARCHES = b"\x02"
+
+
+def _serializar_cache(doc: dict, serializer: str = CACHE_SERIALIZER, umbral: int = CACHE_COMPRESS_THRESHOLD) -> bytes:
+    """Convierte un documento al formato versionado de la cache de Redis."""
+    formato = CACHE_SERIALIZERS[serializer]
+    cuerpo = formato.dumps(dict(doc))
+    if len(cuerpo) > umbral:
+        return _CACHE_VERSION + formato.id + _ZLIB + zlib.compress(cuerpo, 1)
+    return _CACHE_VERSION + formato.id + _SIN_COMPRIMIR + cuerpo
+
+
+def _deserializar_cache(data: bytes | str) -> dict:
+    """
+    Reconstruye un documento leido de la cache de Redis. Las entradas JSON
+    sin cabecera de versiones anteriores se siguen leyendo.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if data[:1] == _CACHE_PARCHES:
+        return _deserializar_parcheado(data)
+    if data[:1] != _CACHE_VERSION:
+        # Formato sin cabecera: JSON con el _id como texto
+        doc = json.loads(data)
+        if "_id" in doc:
+            doc["_id"] = ObjectId(doc["_id"])
+        return doc
+
+    cuerpo = data[3:]
+    if data[2:3] == _ZLIB:
+        cuerpo = zlib.decompress(cuerpo)
+    return _SERIALIZERS_POR_ID[data[1:2]].loads(cuerpo)
+
+
+def _segmento_cache(doc: dict, umbral: int = CACHE_COMPRESS_THRESHOLD) -> bytes:
+    """Un documento o un parche como segmento de una entrada con parches."""
+    entrada = _serializar_cache(doc, umbral=umbral)
+    return len(entrada).to_bytes(4, "big") + entrada
+
+
+def _deserializar_parcheado(data: bytes) -> dict:
+    doc = None
+    inicio = 1
+    while inicio < len(data):
+        fin = inicio + 4 + int.from_bytes(data[inicio:inicio + 4], "big")
+        segmento = _deserializar_cache(data[inicio + 4:fin])
+        if doc is None:
+            doc = segmento
+        else:
+            _aplicar_parche(doc, segmento)
+        inicio = fin
+    return doc
+
+
+def _aplicar_parche(doc: dict, operaciones: dict) -> None:
+    """Aplica a un documento de la cache un parche, como haria MongoDB con el update."""
+    for op, rutas in operaciones.items():
+        for ruta, valor in rutas.items():
+            *padres, ultima = ruta.split(".")
+            contenedor: Any = doc
+            for parte in padres:
+                contenedor = contenedor[int(parte)] if isinstance(contenedor, list) else contenedor.setdefault(parte, {})
+            clave = int(ultima) if isinstance(contenedor, list) else ultima
+            if op == "$set":
+                contenedor[clave] = valor
+            elif isinstance(contenedor, list):
+                # $unset en una lista deja null en su lugar, como MongoDB
+                contenedor[clave] = None
+            else:
+                contenedor.pop(clave, None)
+
+
+# Valor de cache:<Modelo>:<id> para los ids que no existen. No es una
+# cabecera valida de _serializar_cache ni JSON
+_NO_EXISTE = b"\x00"
+
+# GET + PTTL y EXPIRE solo si la entrada no ha entrado en la ventana de
+# caducidad: una entrada caducada no se renueva hasta que alguien la recarga.
+# Las marcas de inexistente (ARGV[3]) no se renuevan nunca, y nada se
+# renueva con ARGV[1] = 0 (modelos con caducidad fija)
+_LUA_LEER_CACHE = """
+local valor = redis.call('GET', KEYS[1])
+if not valor then
+    return {}
+end
+local pttl = redis.call('PTTL', KEYS[1])
+if tonumber(ARGV[1]) > 0 and pttl > tonumber(ARGV[2]) and valor ~= ARGV[3] then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return {valor, pttl}
+"""
+
+# Añade un parche (ARGV[1], ya como segmento) a una entrada y renueva su TTL
+# (ARGV[2]); una entrada normal (cabecera ARGV[3]) pasa antes a tener parches
+# (cabecera ARGV[4]). Devuelve 0 sin tocar nada si no hay entrada, si es de
+# otro formato, si los parches pesarian mas que el documento o si la entrada
+# pasaria de ARGV[5] bytes (0 sin limite): quien llama la reescribe entera
+_LUA_PARCHEAR_CACHE = """
+local cabecera = redis.call('GETRANGE', KEYS[1], 0, 0)
+local maximo = tonumber(ARGV[5])
+if cabecera == ARGV[3] then
+    local valor = redis.call('GET', KEYS[1])
+    local n = #valor
+    if #ARGV[1] > n or (maximo > 0 and 5 + n + #ARGV[1] > maximo) then
+        return 0
+    end
+    local largo = string.char(math.floor(n / 16777216) % 256, math.floor(n / 65536) % 256, math.floor(n / 256) % 256, n % 256)
+    redis.call('SET', KEYS[1], ARGV[4] .. largo .. valor .. ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+if cabecera ~= ARGV[4] then
+    return 0
+end
+local largo = redis.call('GETRANGE', KEYS[1], 1, 4)
+local n = ((largo:byte(1) * 256 + largo:byte(2)) * 256 + largo:byte(3)) * 256 + largo:byte(4)
+local total = redis.call('STRLEN', KEYS[1]) + #ARGV[1]
+if total - 5 - n > n or (maximo > 0 and total > maximo) then
+    return 0
+end
+redis.call('APPEND', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Suma accesos al zset de un modelo con decaimiento exponencial "hacia
+# delante": cada acceso vale 2^((ahora - epoca) / vida media), asi los
+# antiguos pesan cada vez menos sin tener que recorrer el zset. Cuando los
+# pesos se hacen muy grandes se reescala todo y se mueve la epoca.
+# KEYS: zset, epoca. ARGV: ahora, vida media, maximo de ids, id1, n1, id2, n2...
+_LUA_REGISTRAR_ACCESOS = """
+local ahora = tonumber(ARGV[1])
+local vida = tonumber(ARGV[2])
+local epoca = tonumber(redis.call('GET', KEYS[2]))
+if not epoca then
+    epoca = ahora
+    redis.call('SET', KEYS[2], epoca)
+end
+local exponente = (ahora - epoca) / vida
+if exponente > 512 then
+    redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', 2 ^ -exponente)
+    redis.call('SET', KEYS[2], ahora)
+    exponente = 0
+end
+local peso = 2 ^ exponente
+for i = 4, #ARGV, 2 do
+    redis.call('ZINCRBY', KEYS[1], peso * tonumber(ARGV[i + 1]), ARGV[i])
+end
+local sobran = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[3])
+if sobran > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, sobran - 1)
+end
+return 1
+"""
+
+# Contadores de la cache de modelos, con claves "<Modelo>:<evento>"
+CACHE_STATS: Counter[str] = Counter()
+
+
+def cache_stats(model_class: type | None = None) -> dict[str, int]:
+    """
+    Devuelve los contadores de la cache, de todos los modelos o de uno.
+    Eventos de find_by_id: reload (recarga con el lock), coalesced (esperó a
+    la recarga de otro), stale (sirvio un valor caducado mientras otro
+    recargaba), early_refresh (refresco anticipado) y lock_timeout (no llego
+    la recarga de otro a tiempo y fue a MongoDB). l1_hit cuenta las lecturas
+    de find_by_id y find_by_ids servidas por la cache local sin ir a Redis.
+    negative_hit cuenta los ids que la cache ya sabia que no existen.
+    query_hit y query_miss son los aciertos y fallos de find(cache=True).
+    """
+    if model_class is None:
+        return dict(CACHE_STATS)
+    prefijo = f"{model_class.__name__}:"
+    return {clave[len(prefijo):]: valor for clave, valor in CACHE_STATS.items() if clave.startswith(prefijo)}
+
+
+def escanear_claves(cliente: redis.Redis, patron: str, lote: int = 500) -> Iterator[tuple[str, str, int]]:
+    """
+    Recorre las claves de Redis que encajan con el patron con SCAN, sin
+    bloquear el servidor como KEYS, y por cada lote lee el tipo y el TTL
+    en un pipeline. Una clave puede salir repetida si el keyspace cambia
+    mientras se recorre.
+
+    Parameters
+    ----------
+        cliente : redis.Redis
+            cliente con el que recorrer
+        patron : str
+            patron de SCAN, p.ej. "sesiones:*"
+        lote : int
+            claves por SCAN y por pipeline
+    Returns
+    -------
+        Iterator[tuple[str, str, int]]
+            (clave, tipo, ttl en segundos); ttl -1 si no caduca y -2 si
+            ha desaparecido entre el SCAN y el pipeline
+    """
+    cursor = 0
+    while True:
+        cursor, claves = cliente.scan(cursor, match=patron, count=lote)
+        if claves:
+            pipe = cliente.pipeline(transaction=False)
+            for clave in claves:
+                pipe.type(clave)
+                pipe.ttl(clave)
+            respuestas = pipe.execute()
+            yield from zip(claves, respuestas[::2], respuestas[1::2])
+        if cursor == 0:
+            return
+
+
+def _canonico(valor: Any, sin_orden: bool = False) -> Any:
+    """
+    Forma canonica de un filtro para la clave de la cache de consultas. El
+    orden de los campos de un filtro o de un documento de operadores no
+    importa y se ordena; el de un subdocumento literal si importa
+    ({"a": {"x": 1, "y": 2}} no es lo mismo que {"a": {"y": 2, "x": 1}}).
+    """
+    if isinstance(valor, dict):
+        # Los elementos de $and/$or/$nor y $elemMatch son a su vez filtros
+        items = [(k, _canonico(v, k in ("$and", "$or", "$nor", "$elemMatch"))) for k, v in valor.items()]
+        if sin_orden or all(k.startswith("$") for k in valor):
+            items.sort(key=operator.itemgetter(0))
+        return {"__doc__": items}
+    if isinstance(valor, (list, tuple)):
+        return [_canonico(v, sin_orden) for v in valor]
+    return valor
+
+
+def _proyectar(doc: dict, projection: list[str] | dict[str, int] | None) -> dict:
+    """Aplica una proyeccion de campos de primer nivel a un documento ya cargado."""
+    if not projection:
+        return doc
+    if not isinstance(projection, dict):
+        projection = {campo: 1 for campo in projection}
+    incluir = {campo for campo, valor in projection.items() if valor and campo != "_id"}
+    if incluir:
+        campos = incluir | ({"_id"} if projection.get("_id", 1) else set())
+        return {k: v for k, v in doc.items() if k in campos}
+    return {k: v for k, v in doc.items() if k not in projection}
+
+
+class CacheL1:
+    """
+    Cache en memoria del proceso delante de la cache de modelos de Redis.
+    Guarda los valores ya serializados (cada lectura hidrata una instancia
+    nueva) y esta limitada por numero de entradas y por bytes.
+
+    Se mantiene coherente entre procesos con el canal de invalidaciones:
+    save() y delete() publican en el las claves que cambian y cada proceso,
+    desde initRedis, las descarta de su L1. Pub/sub no garantiza la entrega,
+    asi que ademas las entradas caducan a los ttl segundos y al reconectar
+    la L1 se vacia entera.
+    """
+
+    CANAL = "cache:invalidaciones"
+    # En lugar de claves, vaciar la L1 entera
+    VACIAR = "*"
+
+    def __init__(self, maxsize: int = CACHE_L1_SIZE, maxbytes: int = CACHE_L1_BYTES, ttl: float = CACHE_L1_TTL):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        # clave -> (valor serializado, instante de caducidad)
+        self._lru: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
+        self._bytes = 0
+        # Se incrementa en cada invalidacion, ver marca()
+        self._invalidaciones = 0
+        self._lock = threading.Lock()
+        # Para ignorar nuestras propias publicaciones
+        self._origen = uuid.uuid4().hex
+        self._redis = None
+        self._hilo: threading.Thread | None = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def activo(self) -> bool:
+        return self.maxsize > 0
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def get(self, clave: str) -> bytes | None:
+        if not self.activo:
+            return None
+        with self._lock:
+            entrada = self._lru.get(clave)
+            if entrada is not None:
+                if entrada[1] > time.monotonic():
+                    self._lru.move_to_end(clave)
+                    self.hits += 1
+                    return entrada[0]
+                self._quitar(clave)
+            self.misses += 1
+        return None
+
+    def marca(self) -> int:
+        """
+        Se toma antes de leer de Redis o MongoDB y se pasa a set(): si entre
+        medias ha llegado alguna invalidacion el valor leido puede ser viejo
+        y no se guarda.
+        """
+        return self._invalidaciones
+
+    def set(self, clave: str, valor: bytes, marca: int) -> None:
+        if not self.activo:
+            return
+        with self._lock:
+            if marca == self._invalidaciones:
+                self._guardar(clave, valor)
+
+    def actualizar(self, clave: str, valor: bytes) -> None:
+        """Escritura propia (save): sustituye la entrada y anula lecturas en curso."""
+        if not self.activo:
+            return
+        with self._lock:
+            self._invalidaciones += 1
+            self._guardar(clave, valor)
+
+    def discard(self, *claves: str) -> None:
+        with self._lock:
+            self._invalidaciones += 1
+            for clave in claves:
+                self._quitar(clave)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._invalidaciones += 1
+            self._lru.clear()
+            self._bytes = 0
+
+    def _guardar(self, clave: str, valor: bytes) -> None:
+        tamaño = len(clave) + len(valor)
+        if tamaño > self.maxbytes:
+            self._quitar(clave)
+            return
+        self._quitar(clave)
+        self._lru[clave] = (valor, time.monotonic() + self.ttl)
+        self._bytes += tamaño
+        while len(self._lru) > self.maxsize or self._bytes > self.maxbytes:
+            antigua, (valor_antiguo, _) = self._lru.popitem(last=False)
+            self._bytes -= len(antigua) + len(valor_antiguo)
+
+    def _quitar(self, clave: str) -> None:
+        entrada = self._lru.pop(clave, None)
+        if entrada is not None:
+            self._bytes -= len(clave) + len(entrada[0])
+
+    def mensaje(self, claves: list[str]) -> str:
+        """Mensaje de invalidacion: origen y claves separados por espacios."""
+        return " ".join([self._origen, *claves])
+
+    def _invalidar(self, data: bytes | str) -> None:
+        if isinstance(data, bytes):
+            data = data.decode()
+        origen, _, claves = data.partition(" ")
+        if origen == self._origen:
+            return
+        if claves == self.VACIAR:
+            self.clear()
+        else:
+            self.discard(*claves.split())
+
+    def initRedis(self, redis_client) -> None:
+        """Empieza a escuchar el canal de invalidaciones en un hilo en segundo plano."""
+        self._redis = redis_client
+        if self.activo and self._hilo is None:
+            self._hilo = threading.Thread(target=self._escuchar, name="cache-l1", daemon=True)
+            self._hilo.start()
+
+    def _escuchar(self) -> None:
+        while True:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.CANAL)
+                # Lo publicado mientras no estabamos suscritos se ha perdido
+                self.clear()
+                for mensaje in pubsub.listen():
+                    self._invalidar(mensaje["data"])
+            except redis.exceptions.RedisError as e:
+                logger.warning("Canal de invalidaciones de la cache L1 caido: %s", e)
+                self.clear()
+            finally:
+                pubsub.close()
+            time.sleep(1)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._lru),
+            "bytes": self._bytes,
+        }
+
+
+L1_CACHE = CacheL1()
+
+
+class RegistroAccesos:
+    """
+    Cuenta en memoria los documentos que devuelve find_by_id en los modelos
+    con track_access y cada intervalo segundos vuelca los contadores, con
+    un script por modelo, al zset accesos:<Modelo>. Leer no cuesta ningun
+    viaje a Redis. El zset lo usa calentar_cache para saber que precargar.
+    """
+
+    # Ids por llamada al script
+    _LOTE = 1000
+
+    def __init__(self, half_life: float = CACHE_ACCESS_HALF_LIFE, max_size: int = CACHE_ACCESS_MAX,
+                 intervalo: float = CACHE_ACCESS_FLUSH):
+        self.half_life = half_life
+        self.max_size = max_size
+        self.intervalo = intervalo
+        self._contadores: dict[type, Counter[str]] = {}
+        self._lock = threading.Lock()
+        self._hilo: threading.Thread | None = None
+
+    def registrar(self, model_class: type, id: str) -> None:
+        with self._lock:
+            contador = self._contadores.get(model_class)
+            if contador is None:
+                contador = self._contadores[model_class] = Counter()
+            contador[id] += 1
+        if self._hilo is None:
+            self.start()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name="registro-accesos", daemon=True)
+                self._hilo.start()
+
+    def _bucle(self) -> None:
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.flush()
+            except redis.exceptions.RedisError as e:
+                logger.warning("No se pudieron volcar los accesos: %s", e)
+
+    def flush(self) -> None:
+        """Vuelca ya los contadores acumulados."""
+        with self._lock:
+            contadores, self._contadores = self._contadores, {}
+        ahora = time.time()
+        for model_class, contador in contadores.items():
+            items = list(contador.items())
+            for i in range(0, len(items), self._LOTE):
+                args: list = [ahora, self.half_life, self.max_size]
+                for id, veces in items[i:i + self._LOTE]:
+                    args += [id, veces]
+                model_class._script_accesos(keys=[model_class._accesos_key(), model_class._accesos_key() + ":epoca"], args=args)
+
+    def top(self, model_class: type, n: int) -> list[str]:
+        """Los n ids mas leidos del modelo, de mas a menos."""
+        ids = model_class._redis.zrevrange(model_class._accesos_key(), 0, n - 1)
+        return [id.decode() if isinstance(id, bytes) else id for id in ids]
+
+
+ACCESOS = RegistroAccesos()
+
+
+# Unidad de trabajo activa en el contexto actual (None fuera de un bloque with)
+_unidad_de_trabajo: ContextVar["UnitOfWork | None"] = ContextVar("unidad_de_trabajo", default=None)
+
+
+def _registrar_identidad(model: "Model") -> "Model":
+    """Devuelve la instancia viva del modelo si hay una unidad de trabajo activa."""
+    unidad = _unidad_de_trabajo.get()
+    if unidad is None:
+        return model
+    return unidad.registrar(model)
+
+
+def _agrupar_por_clase(models: list) -> dict[type, list]:
+    grupos: dict[type, list] = {}
+    for model in models:
+        grupos.setdefault(type(model), []).append(model)
+    for model_class in grupos:
+        # Las operaciones en bloque son sincronas: con AsyncMongoClient no se escribiria nada
+        if model_class._asincrono:
+            raise TypeError(f"'{model_class.__name__}' es asincrono: guardalo o borralo con await save()/delete().")
+    return grupos
+
+
+# Tamaño fijo de cada tipo BSON; los de longitud variable se calculan aparte
+_BSON_FIJOS = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4,
+               0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0}
+_INT32 = struct.Struct("<i")
+# Tipos simples que se decodifican sin pasar por bson.decode
+_BSON_SIMPLES = {
+    0x01: lambda datos, pos: struct.unpack_from("<d", datos, pos)[0],
+    0x02: lambda datos, pos: datos[pos + 4:pos + 3 + _INT32.unpack_from(datos, pos)[0]].decode("utf-8"),
+    0x07: lambda datos, pos: ObjectId(datos[pos:pos + 12]),
+    0x08: lambda datos, pos: datos[pos] == 1,
+    0x0A: lambda datos, pos: None,
+    0x10: lambda datos, pos: _INT32.unpack_from(datos, pos)[0],
+    0x12: lambda datos, pos: struct.unpack_from("<q", datos, pos)[0],
+}
+
+
+def _siguiente_elemento(datos: bytes, pos: int) -> tuple[str, int]:
+    """Lee la cabecera del elemento BSON en pos y devuelve su campo y donde acaba."""
+    tipo = datos[pos]
+    fin_clave = datos.index(b"\x00", pos + 1)
+    campo = datos[pos + 1:fin_clave].decode("utf-8")
+    pos = fin_clave + 1
+    if tipo in _BSON_FIJOS:
+        return campo, pos + _BSON_FIJOS[tipo]
+    if tipo in (0x02, 0x0D, 0x0E):
+        return campo, pos + 4 + _INT32.unpack_from(datos, pos)[0]
+    if tipo in (0x03, 0x04, 0x0F):
+        return campo, pos + _INT32.unpack_from(datos, pos)[0]
+    if tipo == 0x05:
+        return campo, pos + 5 + _INT32.unpack_from(datos, pos)[0]
+    if tipo == 0x0B:
+        return campo, datos.index(b"\x00", datos.index(b"\x00", pos) + 1) + 1
+    if tipo == 0x0C:
+        return campo, pos + 4 + _INT32.unpack_from(datos, pos)[0] + 12
+    raise ValueError(f"Tipo BSON desconocido: {tipo:#x}")
+
+
+class _DocumentoLazy:
+    """
+    Documento BSON sin decodificar. Los elementos de primer nivel se indexan
+    a medida que se buscan (solo se leen sus cabeceras) y cada campo se
+    decodifica entero, con sus subdocumentos, solo cuando se pide.
+    """
+
+    __slots__ = ("_datos", "_indice", "_pos")
+
+    def __init__(self, datos: bytes):
+        self._datos = datos
+        self._indice: dict[str, tuple[int, int]] = {}
+        self._pos = 4
+
+    def _buscar(self, campo: str) -> tuple[int, int] | None:
+        indice = self._indice
+        if campo in indice:
+            return indice[campo]
+        datos = self._datos
+        pos = self._pos
+        fin_doc = len(datos) - 1
+        while pos < fin_doc:
+            clave, fin = _siguiente_elemento(datos, pos)
+            indice[clave] = (pos, fin)
+            pos = fin
+            if clave == campo:
+                self._pos = pos
+                return indice[clave]
+        self._pos = pos
+        return None
+
+    def __contains__(self, campo: object) -> bool:
+        return self._buscar(campo) is not None
+
+    def __getitem__(self, campo: str) -> Any:
+        limites = self._buscar(campo)
+        if limites is None:
+            raise KeyError(campo)
+        inicio, fin = limites
+        datos = self._datos
+        decodificar = _BSON_SIMPLES.get(datos[inicio])
+        if decodificar is not None:
+            # Valor justo despues del tipo y el nombre del campo
+            return decodificar(datos, inicio + len(campo.encode("utf-8")) + 2)
+        elemento = datos[inicio:fin]
+        return bson.decode(_INT32.pack(len(elemento) + 5) + elemento + b"\x00")[campo]
+
+
+class _VistaDatos(MutableMapping):
+    """
+    Vista tipo dict de los campos de un modelo. Los valores viven en los
+    slots de la instancia; _data solo traduce nombre de campo -> slot.
+    Escribir aqui no marca el campo como modificado.
+    """
+
+    __slots__ = ("_model", "_slots")
+
+    def __init__(self, model: "Model"):
+        self._model = model
+        self._slots = type(model)._slots
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return getattr(self._model, self._slots[name])
+        except (KeyError, AttributeError):
+            raise KeyError(name) from None
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        try:
+            slot = self._slots[name]
+        except KeyError:
+            raise KeyError(f"El atributo '{name}' no es admitido por el modelo.") from None
+        setattr(self._model, slot, value)
+
+    def __delitem__(self, name: str) -> None:
+        try:
+            delattr(self._model, self._slots[name])
+        except (KeyError, AttributeError):
+            raise KeyError(name) from None
+
+    def __contains__(self, name: object) -> bool:
+        slot = self._slots.get(name)
+        return slot is not None and hasattr(self._model, slot)
+
+    def __iter__(self) -> Iterator[str]:
+        model = self._model
+        return (name for name, slot in self._slots.items() if hasattr(model, slot))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def clear(self) -> None:
+        for name in list(self):
+            delattr(self._model, self._slots[name])
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class _CamposModificados(MutableSet):
+    """Vista tipo set de los campos modificados, guardados como mascara de bits."""
+
+    __slots__ = ("_model", "_bits")
+
+    def __init__(self, model: "Model"):
+        self._model = model
+        self._bits = type(model)._bits
+
+    def __contains__(self, name: object) -> bool:
+        return bool(self._model._dirty & self._bits.get(name, 0))
+
+    def __iter__(self) -> Iterator[str]:
+        dirty = self._model._dirty
+        return (name for name, bit in self._bits.items() if dirty & bit)
+
+    def __len__(self) -> int:
+        return self._model._dirty.bit_count()
+
+    def add(self, name: str) -> None:
+        _campo_entero(self._model, name)
+
+    def discard(self, name: str) -> None:
+        self._model._dirty &= ~self._bits.get(name, 0)
+
+    def clear(self) -> None:
+        self._model._dirty = 0
+        self._model._anidados = None
+
+    def __repr__(self) -> str:
+        return repr(set(self))
+
+
+# Cambios anidados. Los descriptores envuelven las listas y dicts de los campos
+# al leerlos en _ListaObservada/_DictObservado, que anotan en el modelo cada
+# cambio interno con su ruta (empresa.3.fecha_fin) para guardarlo con el
+# operador minimo: $set/$unset de la ruta, $push/$pull/$pop de una lista.
+# Lo que no se puede expresar asi, o choca con otro cambio pendiente del mismo
+# campo (un $push y un $set dentro de la misma lista), marca el campo entero
+# como modificado y se guarda con un $set de todo el campo, como antes.
+
+_ASIGNACIONES = ("$set", "$unset")
+
+
+def _anotar_cambio(modelo: "Model", campo: str, ruta: str, op: str, valor: Any) -> None:
+    bit = modelo._bits[campo]
+    if modelo._dirty & bit:
+        # El campo ya se va a guardar entero
+        return
+    if op == "$set" and ruta == campo:
+        _campo_entero(modelo, campo)
+        return
+    cambios = modelo._anidados
+    if cambios is None:
+        cambios = modelo._anidados = {}
+    prefijo = ruta + "."
+    for otra, (otro_op, otro_valor, otro_campo) in list(cambios.items()):
+        if otro_campo != campo:
+            continue
+        if otra == ruta:
+            if op in _ASIGNACIONES and otro_op in _ASIGNACIONES:
+                del cambios[otra]
+                continue
+            if op == otro_op and op in ("$push", "$pull"):
+                otro_valor.extend(valor)
+                return
+        elif otra.startswith(prefijo):
+            if op in _ASIGNACIONES:
+                # El $set de la ruta ya incluye lo que hubiera dentro
+                del cambios[otra]
+                continue
+        elif ruta.startswith(otra + "."):
+            if otro_op == "$set":
+                # _operaciones lee el valor actual de la ruta al guardar
+                return
+        else:
+            continue
+        _campo_entero(modelo, campo)
+        return
+    cambios[ruta] = (op, valor, campo)
+
+
+def _campo_entero(modelo: "Model", campo: str) -> None:
+    modelo._dirty |= modelo._bits[campo]
+    cambios = modelo._anidados
+    if cambios:
+        for ruta in [ruta for ruta, cambio in cambios.items() if cambio[2] == campo]:
+            del cambios[ruta]
+
+
+class _Observado:
+    """
+    Parte comun de las listas y dicts observados. Cada uno sabe a que modelo
+    pertenece y bajo que clave de su padre (o de que campo) esta, y antes de
+    anotar un cambio comprueba que sigue ahi. Si ha cambiado de posicion (un
+    insert en la lista padre) se busca la nueva, y los cambios de un valor
+    que ya no es del modelo no se guardan, como con un dict normal.
+    """
+
+    __slots__ = ()
+
+    def _anotar(self, op: str, clave: Any = None, valor: Any = None) -> None:
+        partes = [] if clave is None else [clave]
+        nodo = self
+        while nodo._padre is not None:
+            padre = nodo._padre
+            if not padre._contiene(nodo._clave, nodo):
+                nodo._clave = padre._localizar(nodo)
+                if nodo._clave is _NO_ESTA:
+                    return
+            partes.append(nodo._clave)
+            nodo = padre
+        modelo = nodo._modelo
+        campo = nodo._clave
+        if getattr(modelo, modelo._slots[campo], None) is not nodo:
+            return
+        partes.append(campo)
+        if not all(type(parte) is int or (type(parte) is str and parte and "." not in parte
+                                                    and parte[0] != "$") for parte in partes):
+            _campo_entero(modelo, campo)
+            return
+        _anotar_cambio(modelo, campo, ".".join(map(str, reversed(partes))), op, valor)
+
+    def _envolver(self, clave: Any, valor: Any) -> Any:
+        envoltorio = _OBSERVABLES[valor.__class__](valor, self._modelo, self, clave)
+        self._guardar(clave, envoltorio)
+        return envoltorio
+
+
+class _ListaObservada(_Observado, list):
+    """Lista de un campo del modelo que anota sus cambios (ver _anotar_cambio)."""
+
+    __slots__ = ("_modelo", "_padre", "_clave")
+
+    def __init__(self, valor: list, modelo: "Model", padre: _Observado | None, clave: Any):
+        list.__init__(self, valor)
+        self._modelo = modelo
+        self._padre = padre
+        self._clave = clave
+
+    def __reduce__(self) -> tuple:
+        return (list, (list.copy(self),))
+
+    def _contiene(self, clave: int, valor: Any) -> bool:
+        return clave < len(self) and list.__getitem__(self, clave) is valor
+
+    def _localizar(self, valor: Any) -> int | object:
+        for indice, elemento in enumerate(list.__iter__(self)):
+            if elemento is valor:
+                return indice
+        return _NO_ESTA
+
+    def _guardar(self, clave: int, valor: Any) -> None:
+        list.__setitem__(self, clave, valor)
+
+    def __getitem__(self, indice: Any) -> Any:
+        valor = list.__getitem__(self, indice)
+        if valor.__class__ in _OBSERVABLES and indice.__class__ is int:
+            valor = self._envolver(indice if indice >= 0 else indice + len(self), valor)
+        return valor
+
+    def __iter__(self) -> Iterator[Any]:
+        for indice, valor in enumerate(list.__iter__(self)):
+            if valor.__class__ in _OBSERVABLES:
+                self._envolver(indice, valor)
+        return list.__iter__(self)
+
+    def __setitem__(self, indice: Any, valor: Any) -> None:
+        list.__setitem__(self, indice, valor)
+        if indice.__class__ is int:
+            self._anotar("$set", indice if indice >= 0 else indice + len(self))
+        else:
+            self._anotar("$set")
+
+    def __delitem__(self, indice: Any) -> None:
+        list.__delitem__(self, indice)
+        self._anotar("$set")
+
+    def append(self, valor: Any) -> None:
+        list.append(self, valor)
+        self._anotar("$push", valor=[valor])
+
+    def extend(self, valores: Any) -> None:
+        valores = list(valores)
+        list.extend(self, valores)
+        if valores:
+            self._anotar("$push", valor=valores)
+
+    def __iadd__(self, valores: Any) -> Self:
+        self.extend(valores)
+        return self
+
+    def remove(self, valor: Any) -> None:
+        list.remove(self, valor)
+        # $pull quita todas las apariciones, y con un documento todos los que encajen
+        if isinstance(valor, (dict, list)) or valor in self:
+            self._anotar("$set")
+        else:
+            self._anotar("$pull", valor=[valor])
+
+    def pop(self, indice: int = -1) -> Any:
+        n = len(self)
+        valor = list.pop(self, indice)
+        if indice in (-1, n - 1):
+            self._anotar("$pop", valor=1)
+        elif indice in (0, -n):
+            self._anotar("$pop", valor=-1)
+        else:
+            self._anotar("$set")
+        return valor
+
+    def insert(self, indice: int, valor: Any) -> None:
+        list.insert(self, indice, valor)
+        self._anotar("$set")
+
+    def clear(self) -> None:
+        list.clear(self)
+        self._anotar("$set")
+
+    def sort(self, *args, **kwargs) -> None:
+        list.sort(self, *args, **kwargs)
+        self._anotar("$set")
+
+    def reverse(self) -> None:
+        list.reverse(self)
+        self._anotar("$set")
+
+    def __imul__(self, n: int) -> Self:
+        list.__imul__(self, n)
+        self._anotar("$set")
+        return self
+
+
+class _DictObservado(_Observado, dict):
+    """Dict de un campo del modelo que anota sus cambios (ver _anotar_cambio)."""
+
+    __slots__ = ("_modelo", "_padre", "_clave")
+
+    def __init__(self, valor: dict, modelo: "Model", padre: _Observado | None, clave: Any):
+        dict.__init__(self, valor)
+        self._modelo = modelo
+        self._padre = padre
+        self._clave = clave
+
+    def __reduce__(self) -> tuple:
+        return (dict, (dict.copy(self),))
+
+    def _contiene(self, clave: Any, valor: Any) -> bool:
+        return dict.get(self, clave, _NO_ESTA) is valor
+
+    def _localizar(self, valor: Any) -> Any:
+        for clave, elemento in dict.items(self):
+            if elemento is valor:
+                return clave
+        return _NO_ESTA
+
+    def _guardar(self, clave: Any, valor: Any) -> None:
+        dict.__setitem__(self, clave, valor)
+
+    def _envolver_todos(self) -> None:
+        for clave, valor in list(dict.items(self)):
+            if valor.__class__ in _OBSERVABLES:
+                self._envolver(clave, valor)
+
+    def __getitem__(self, clave: Any) -> Any:
+        valor = dict.__getitem__(self, clave)
+        if valor.__class__ in _OBSERVABLES:
+            valor = self._envolver(clave, valor)
+        return valor
+
+    def get(self, clave: Any, default: Any = None) -> Any:
+        return self[clave] if clave in self else default
+
+    def values(self) -> Any:
+        self._envolver_todos()
+        return dict.values(self)
+
+    def items(self) -> Any:
+        self._envolver_todos()
+        return dict.items(self)
+
+    def __setitem__(self, clave: Any, valor: Any) -> None:
+        dict.__setitem__(self, clave, valor)
+        self._anotar("$set", clave)
+
+    def __delitem__(self, clave: Any) -> None:
+        dict.__delitem__(self, clave)
+        self._anotar("$unset", clave)
+
+    def pop(self, clave: Any, *default: Any) -> Any:
+        if clave not in self:
+            return dict.pop(self, clave, *default)
+        valor = dict.pop(self, clave)
+        self._anotar("$unset", clave)
+        return valor
+
+    def popitem(self) -> tuple:
+        clave, valor = dict.popitem(self)
+        self._anotar("$unset", clave)
+        return clave, valor
+
+    def setdefault(self, clave: Any, default: Any = None) -> Any:
+        if clave not in self:
+            self[clave] = default
+        return self[clave]
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for clave, valor in dict(*args, **kwargs).items():
+            self[clave] = valor
+
+    def __ior__(self, otro: Any) -> Self:
+        self.update(otro)
+        return self
+
+    def clear(self) -> None:
+        dict.clear(self)
+        self._anotar("$set")
+
+
+_NO_ESTA = object()
+_OBSERVABLES: dict[type, type] = {list: _ListaObservada, dict: _DictObservado}
+
+
+def _observar(modelo: "Model", campo: str, valor: list | dict) -> _Observado:
+    # Lo llama el descriptor del campo la primera vez que se lee el valor
+    return _OBSERVABLES[valor.__class__](valor, modelo, None, campo)
+
+
+def _campo(campo: str, bit: int, slot: str, es_location: bool) -> property:
+    """
+    Descriptor de un campo: lectura del slot y escritura que marca el bit.
+    El getter y el setter se compilan con el nombre del slot y el bit como
+    literales, asi la asignacion es un STORE_ATTR normal sin busquedas en
+    diccionarios. El getter cambia las listas y dicts por su version
+    observada la primera vez que se leen (ver _anotar_cambio).
+    """
+    codigo = (f"def getter(self):\n    valor = self.{slot}\n"
+              f"    if valor.__class__ in _OBSERVABLES:\n        valor = self.{slot} = _observar(self, {campo!r}, valor)\n"
+              f"    return valor\n")
+    # Al asignar el campo entero sobran sus cambios internos pendientes
+    codigo += (f"def setter(self, value):\n    self.{slot} = value\n    self._dirty |= {bit}\n"
+               f"    if self._anidados:\n        _campo_entero(self, {campo!r})\n")
+    if es_location:
+        codigo += "    self._geocodificar(value)\n"
+    espacio: dict[str, Any] = {"_OBSERVABLES": _OBSERVABLES, "_observar": _observar, "_campo_entero": _campo_entero}
+    exec(codigo, espacio)
+    return property(espacio["getter"], espacio["setter"])
+
+
+def crear_modelo(class_name: str, base: type, admissible_vars: set[str], location_var: str | None = None) -> type:
+    """
+    Crea la clase de un modelo con __slots__: cada campo admisible tiene un
+    slot oculto y un descriptor con su nombre, y los campos modificados se
+    guardan en una mascara de bits. _data y _modified_vars siguen existiendo
+    como vistas, asi que la API de Model no cambia.
+    """
+    campos = sorted(admissible_vars)
+    for campo in campos:
+        if not campo.isidentifier():
+            raise ValueError(f"El campo '{campo}' de '{class_name}' no es un identificador valido.")
+    ocultos = {campo: f"_s_{campo}" for campo in campos}
+    cls = type(class_name, (base,), {"__slots__": tuple(ocultos.values())})
+
+    cls._slots = ocultos
+    cls._bits = {campo: 1 << i for i, campo in enumerate(campos)}
+    for campo in campos:
+        setattr(cls, campo, _campo(campo, cls._bits[campo], ocultos[campo], campo == location_var))
+
+    # _rellenar y _copiar compilados: una comprobacion y un STORE_ATTR por campo
+    codigo = "def _rellenar(self, kwargs):\n    n = 0\n"
+    for campo, oculto in ocultos.items():
+        codigo += f"    if {campo!r} in kwargs:\n        self.{oculto} = kwargs[{campo!r}]\n        n += 1\n"
+    codigo += "    if n != len(kwargs):\n        self._no_admisible(kwargs)\n"
+    codigo += "def _copiar(self, doc):\n    pass\n"
+    for campo, oculto in ocultos.items():
+        codigo += f"    if {campo!r} in doc:\n        self.{oculto} = doc[{campo!r}]\n"
+    espacio: dict[str, Any] = {}
+    exec(codigo, espacio)
+    cls._rellenar = espacio["_rellenar"]
+    cls._copiar = espacio["_copiar"]
+    return cls
+
+
 class Model:
+    """
+    Clase base de los modelos. Las clases concretas las crea initApp con
+    crear_modelo, que les da un slot y un descriptor por campo admisible.
+    """
+
+    __slots__ = ("_dirty", "_anidados", "_geocoding", "_raw", "_parcial", "__weakref__")
     
     _required_vars: set[str]
     _admissible_vars: set[str]
-    _location_var: None
+    _location_var: str | None = None
     _db: pymongo.collection.Collection
     _internal_vars: set[str]={}
     _redis = None
+    _geocode_async: bool = False
+    _asincrono: bool = False
+    _slots: dict[str, str] = {}
+    # Media movil de lo que tarda find_by_id en recargar de MongoDB, en segundos
+    _tiempo_recarga: float = 0.0
+    _script_leer_cache: Any = None
+    _script_parchear_cache: Any = None
+    _bits: dict[str, int] = {}
+    # Cache de resultados de find(cache=True)
+    _query_cache_ttl: int = QUERY_CACHE_TTL
+    _query_cache_max: int = QUERY_CACHE_MAX_RESULTS
+    # Politica de cache:<Modelo>:<id>, la seccion cache de models.yml (ver _configurar_cache)
+    _cache_enabled: bool = True
+    _cache_ttl: int = CACHE_TTL
+    # Ventana de caducidad servible de find_by_id, como mucho la mitad del TTL
+    _cache_stale: int = CACHE_STALE_TTL
+    _cache_sliding: bool = True
+    _cache_umbral: int = CACHE_COMPRESS_THRESHOLD
+    _cache_max_doc: int = 0
+    _cache_negative_ttl: int = CACHE_NEGATIVE_TTL
+    _cache_prefix: str = "cache"
+    _track_access: bool = False
+    _script_accesos: Any = None
+    # Escrituras diferidas, solo si el modelo tiene write_behind en models.yml
+    _write_behind: "WriteBehind | None" = None
 
     def __init__(self, **kwargs: dict[str, str | dict]):
         
-        self._data: dict[str, str | dict] = {}
-        
-        super().__setattr__("_data", {}) 
-        super().__setattr__("_modified_vars", set()) 
+        self._dirty = 0
+        self._anidados = None
+        self._geocoding = None
+        self._raw = None
+        self._parcial = False
 
-        for campo_requerido in self._required_vars:
-              if campo_requerido not in kwargs:
-                raise ValueError(f"El atributo requerido '{campo_requerido}' es obligatorio y no se ha proporcionado.")
-        
+        if not kwargs.keys() >= self._required_vars:
+            for campo_requerido in self._required_vars:
+                if campo_requerido not in kwargs:
+                    raise ValueError(f"El atributo requerido '{campo_requerido}' es obligatorio y no se ha proporcionado.")
         
+        self._rellenar(kwargs)
+
+    def _init_estado(self) -> None:
+        self._dirty = 0
+        self._anidados = None
+        self._geocoding = None
+        self._raw = None
+        self._parcial = False
+
+    @classmethod
+    def _hidratar(cls, doc: dict) -> Self:
+        """
+        Constructor interno para documentos de confianza (nuestra coleccion o
+        nuestra cache): no comprueba campos requeridos ni admisibles y los
+        campos que no son del modelo se ignoran.
+        """
+        model = cls.__new__(cls)
+        model._dirty = 0
+        model._anidados = None
+        model._geocoding = None
+        model._raw = None
+        model._parcial = False
+        model._copiar(doc)
+        return model
+
+    @classmethod
+    def _hidratar_lazy(cls, raw: RawBSONDocument | bytes) -> Self:
+        """
+        Como _hidratar pero sobre el BSON sin decodificar: solo se decodifica
+        _id y el resto de campos la primera vez que se leen.
+        """
+        documento = _DocumentoLazy(raw.raw if isinstance(raw, RawBSONDocument) else raw)
+        model = cls.__new__(cls)
+        model._dirty = 0
+        model._anidados = None
+        model._geocoding = None
+        model._raw = documento
+        model._parcial = False
+        if "_id" in documento:
+            model._s__id = documento["_id"]
+        return model
+
+    def _copiar(self, doc: dict) -> None:
+        # crear_modelo lo sustituye por una version compilada para cada clase
+        for campo, slot in self._slots.items():
+            if campo in doc:
+                setattr(self, slot, doc[campo])
+
+    def _materializar(self) -> None:
+        """Decodifica los campos que queden pendientes del documento BSON."""
+        raw = self._raw
+        self._raw = None
+        for campo, slot in self._slots.items():
+            if campo in raw and not hasattr(self, slot):
+                setattr(self, slot, raw[campo])
+
+    def _rellenar(self, kwargs: dict) -> None:
+        # crear_modelo lo sustituye por una version compilada para cada clase
+        slots = self._slots
+        for atributo_perimitido, value in kwargs.items():
+            if atributo_perimitido not in slots:
+                self._no_admisible(kwargs)
+            setattr(self, slots[atributo_perimitido], value)
+
+    def _no_admisible(self, kwargs: dict) -> None:
         for atributo_perimitido in kwargs:
-            if atributo_perimitido not in self._admissible_vars:
+            if atributo_perimitido not in self._slots:
                 raise ValueError(f"El atributo requerido '{atributo_perimitido}'no es admisible.")
-        
-    
-        self._data.update(kwargs)
 
+    @property
+    def _data(self) -> _VistaDatos:
+        if self._raw is not None:
+            self._materializar()
+        return _VistaDatos(self)
 
-    def __setattr__(self, name: str, value: str | dict) -> None:
+    @property
+    def _modified_vars(self) -> _CamposModificados:
+        return _CamposModificados(self)
 
-        if name in {'_modified_vars', '_required_vars', '_admissible_vars', '_db', '_location_var', '_data'}:
-            super().__setattr__(name, value)
-            return
 
-        
-        if name not in self._admissible_vars:
-            
-            raise AttributeError(f"El atributo '{name}' no es admitido por el modelo.")
 
+    def _geocodificar(self, value: str) -> None:
+        # Lo llama el descriptor del campo de localizacion al asignarlo
+        if GEOCODE_QUEUE.activo or self._geocode_async:
+            # Se geocodifica en segundo plano, save() espera si hace falta
+            future = GEOCODE_QUEUE.submit(value)
+            self._geocoding = future
+            future.add_done_callback(self._aplicar_geocodificacion)
+        else:
+            self._geocoding = None
+            self._set_location_point(getLocationPoint(value))
 
-        self._data[name] = value
-        
-        self._modified_vars.add(name)
+    def _set_location_point(self, location_point: Point | None) -> None:
+        # Sin coordenadas no guardamos nada, un texto romperia el indice 2dsphere
+        if location_point is None:
+            self._data.pop(f"{self._location_var}_loc", None)
+        else:
+            self._data[f"{self._location_var}_loc"] = location_point
 
-        
-        if name == self._location_var:
-            location_point = getLocationPoint(value)
-            if location_point is None:
-                self._data[f"{self._location_var}_loc"] = FAIL_MESSAGE
-            else:
-                self._data[f"{self._location_var}_loc"] = location_point
+    def _aplicar_geocodificacion(self, future: Future) -> None:
+        # Si se ha vuelto a asignar la direccion este resultado ya no vale
+        if self._geocoding is not future:
+            return
+        self._geocoding = None
+        if future.exception() is None:
+            self._set_location_point(future.result())
+        else:
+            self._set_location_point(None)
+
+    def _esperar_geocodificacion(self) -> None:
+        future = self._geocoding
+        if future is not None:
+            future.exception()
+            self._aplicar_geocodificacion(future)
 
 
     def __getattr__(self, name: str) -> Any:
+        # Solo se llega aqui si el campo no tiene valor o no existe.
+        # En los modelos lazy el valor puede estar aun sin decodificar
+        if name != "_raw" and name in self._slots:
+            raw = self._raw
+            if raw is not None and name in raw:
+                setattr(self, self._slots[name], raw[name])
+                return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' no tiene el atributo '{name}'")
         
-        if name in {'_modified_vars', '_required_vars', '_admissible_vars', '_db', '_data', '_location_var'}:
-            return super().__getattribute__(name)
-        try:
-            return self._data[name]
-        except KeyError:
-            raise AttributeError
-        
+    @classmethod
+    def _cache_key(cls, id: str | ObjectId) -> str:
+        return f"{cls._cache_prefix}:{cls.__name__}:{str(id)}"
+
+    @classmethod
+    def _version_key(cls) -> str:
+        # Contador de escrituras de la coleccion, invalida la cache de consultas
+        return f"version:{cls.__name__}"
+
+    @classmethod
+    def _query_key(cls, filter: dict, projection: list[str] | dict[str, int] | None,
+                   sort: str | list[tuple[str, int]] | None, limit: int, skip: int) -> str:
+        if projection is not None and not isinstance(projection, dict):
+            projection = sorted(projection)
+        consulta = json_util.dumps([_canonico(filter, True), _canonico(projection, True), sort, limit, skip])
+        return f"query:{cls.__name__}:{hashlib.sha1(consulta.encode()).hexdigest()}"
+
+    def _update_doc(self, anidados: bool = False) -> dict[str, Any]:
+        """
+        Campos modificados desde el ultimo guardado, listos para un $set. Con
+        anidados tambien van enteros los campos con cambios internos.
+        """
+        update_doc = {k: self._data[k] for k in getattr(self, "_modified_vars", set())}
+        if anidados and self._anidados:
+            for _, _, campo in self._anidados.values():
+                update_doc[campo] = self._data[campo]
+        # Si cambia la direccion tambien hay que guardar sus coordenadas
+        loc_field = f"{self._location_var}_loc"
+        if self._location_var in update_doc and loc_field in self._data:
+            update_doc[loc_field] = self._data[loc_field]
+        update_doc.pop("_id", None)
+        return update_doc
+
+    def _operaciones(self) -> dict[str, dict[str, Any]]:
+        """
+        Documento de actualizacion con los cambios desde el ultimo guardado:
+        $set de los campos asignados y los operadores anotados por las listas
+        y dicts observados para los cambios internos del resto.
+        """
+        operaciones: dict[str, dict[str, Any]] = {}
+        update_doc = self._update_doc()
+        if update_doc:
+            operaciones["$set"] = update_doc
+        for campo in self._quitados():
+            operaciones.setdefault("$unset", {})[campo] = ""
+        for ruta, (op, valor, campo) in (self._anidados or {}).items():
+            if op == "$set":
+                valor = self._valor_en(ruta)
+            elif op == "$unset":
+                valor = ""
+            elif op == "$push":
+                valor = {"$each": valor}
+            elif op == "$pull":
+                valor = valor[0] if len(valor) == 1 else {"$in": valor}
+            operaciones.setdefault(op, {})[ruta] = valor
+        return operaciones
+
+    def _quitados(self) -> list[str]:
+        """Campos a borrar en MongoDB: las coordenadas de una direccion nueva que no se ha podido geocodificar."""
+        if self._location_var is None or not self._dirty & self._bits.get(self._location_var, 0):
+            return []
+        loc_field = f"{self._location_var}_loc"
+        return [] if loc_field in self._data else [loc_field]
+
+    def _valor_en(self, ruta: str) -> Any:
+        # Valor actual de una ruta con puntos, las listas se indexan con enteros
+        campo, *partes = ruta.split(".")
+        valor = self._data[campo]
+        for parte in partes:
+            valor = list.__getitem__(valor, int(parte)) if isinstance(valor, list) else dict.__getitem__(valor, parte)
+        return valor
+
+    def _pendiente(self) -> bool:
+        """Si el modelo tiene cambios sin guardar, asignados o internos."""
+        return bool(self._dirty or self._anidados)
+
     def save(self) -> None:
 
+        self._esperar_geocodificacion()
+
+        # Dentro de una unidad de trabajo la escritura se aplaza hasta el flush
+        unidad = _unidad_de_trabajo.get()
+        if unidad is not None:
+            unidad.add(self)
+            return
         
         if "_id" in self._data:
         
             # Actualización
-            update_doc = {k: self._data[k] for k in getattr(self, "_modified_vars", set())}
-            update_doc.pop("_id", None)
+            if self._write_behind is not None:
+                # Se escribe en la cache y en el stream, MongoDB llegara con el flush.
+                # El stream junta $set, asi que los cambios internos van con el campo entero
+                update_doc = self._update_doc(anidados=True)
+                quitados = self._quitados()
+                if update_doc or quitados:
+                    self._write_behind.encolar(self, update_doc, quitados)
+                    self._modified_vars.clear()
+                return
 
-            if update_doc:
-                self._db.update_one({"_id": self._data["_id"]}, {"$set": update_doc})
+            operaciones = self._operaciones()
+            if operaciones:
+                self._db.update_one({"_id": self._data["_id"]}, operaciones)
                 
                 #Actualizar cache
                 if self._redis:
-                    cache_key = f"cache:{self.__class__.__name__}:{str(self._data['_id'])}"
-                    doc_serializable = dict(self._data)
-                    doc_serializable["_id"] = str(self._data["_id"])
-                    self._redis.setex(cache_key, 86400, json.dumps(doc_serializable))
+                    self._cachear(operaciones=operaciones)
                 
                 self._modified_vars.clear()
             
@@ -153,42 +1954,392 @@ class Model:
             
             #Guardar en cache
             if self._redis:
-                cache_key = f"cache:{self.__class__.__name__}:{str(result.inserted_id)}"
-                doc_serializable = dict(self._data)
-                doc_serializable["_id"] = str(self._data["_id"])
-                self._redis.setex(cache_key, 86400, json.dumps(doc_serializable))
+                self._cachear()
             
             self._modified_vars.clear()
 
 
     def delete(self) -> None:
         
+        unidad = _unidad_de_trabajo.get()
+        if unidad is not None and "_id" in self._data:
+            unidad.remove(self)
+            return
+
         if "_id" in self._data:
             # Eliminar de cache primero
             if self._redis:
-                cache_key = f"cache:{self.__class__.__name__}:{str(self._data['_id'])}"
-                self._redis.delete(cache_key)
+                self._descachear([self._cache_key(self._data['_id'])])
         
             # Eliminar de MongoDB
             self._db.delete_one({"_id": self._data["_id"]})
             self._data.clear()
             self._modified_vars.clear()
 
-        else:
-            raise ValueError("El modelo no existe en la base de datos.")
+        else:
+            raise ValueError("El modelo no existe en la base de datos.")
+
+    def _cachear(self, extra: Callable[[Any], None] | None = None, operaciones: dict | None = None) -> list:
+        """
+        Guarda el modelo en la cache de Redis y en la L1, invalida la cache de
+        consultas del modelo y avisa al resto de procesos para que descarten
+        su copia, todo en un solo viaje. extra puede añadir mas comandos al
+        pipeline; se devuelven las respuestas de todos.
+
+        Con operaciones (el update que se acaba de aplicar) la entrada no se
+        vuelve a serializar entera: se le añade un parche con esos cambios y
+        la L1 de este proceso la descarta. Si no hay entrada, o los parches
+        ya pesarian mas que el documento, se reescribe entera en un segundo
+        viaje. save_many, UnitOfWork y AsyncModel la reescriben siempre.
+        """
+        pipe = self._redis.pipeline(transaction=False)
+        cache_key = None
+        parche = None
+        if self._cache_enabled:
+            cache_key = self._cache_key(self._data["_id"])
+            if operaciones:
+                # EVALSHA a pelo: el script con client=pipe añadiria un SCRIPT EXISTS
+                parche = [self._parche(operaciones), self._cache_ttl, _CACHE_VERSION, _CACHE_PARCHES, self._cache_max_doc]
+                pipe.evalsha(self._script_parchear_cache.sha, 1, cache_key, *parche)
+                valor = None
+            else:
+                valor = self._poner_modelo_en_cache(pipe, cache_key)
+            pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje([cache_key]))
+        pipe.incr(self._version_key())
+        if extra is not None:
+            extra(pipe)
+        if parche is None:
+            resultados = pipe.execute()
+        else:
+            resultados = pipe.execute(raise_on_error=False)
+            for resultado in resultados[1:]:
+                if isinstance(resultado, Exception):
+                    raise resultado
+            if isinstance(resultados[0], redis.exceptions.NoScriptError):
+                resultados[0] = self._script_parchear_cache(keys=[cache_key], args=parche)
+            elif isinstance(resultados[0], Exception):
+                raise resultados[0]
+            if not resultados[0]:
+                CACHE_STATS[f"{type(self).__name__}:patch_rewrite"] += 1
+                pipe = self._redis.pipeline(transaction=False)
+                valor = self._poner_modelo_en_cache(pipe, cache_key)
+                pipe.execute()
+        if cache_key is not None:
+            if valor is not None:
+                L1_CACHE.actualizar(cache_key, valor)
+            else:
+                L1_CACHE.discard(cache_key)
+        return resultados
+
+    def _parche(self, operaciones: dict) -> bytes:
+        # Solo $set y $unset, que dan lo mismo aplicados dos veces: una recarga
+        # de MongoDB que ya tenga el cambio puede llegar a la cache antes que
+        # el parche. De $push, $pop y $pull va el valor final de la lista
+        parche = {op: dict(operaciones[op]) for op in ("$set", "$unset") if op in operaciones}
+        for op in ("$push", "$pop", "$pull"):
+            for ruta in operaciones.get(op, ()):
+                parche.setdefault("$set", {})[ruta] = self._valor_en(ruta)
+        return _segmento_cache(parche, umbral=self._cache_umbral)
+
+    @classmethod
+    def _descachear(cls, cache_keys: list[str]) -> None:
+        """
+        Quita claves de la L1 de todos los procesos y en Redis las sustituye
+        por la marca de inexistente, para que find_by_id no vaya a MongoDB.
+        """
+        if not cls._cache_enabled:
+            cls._redis.incr(cls._version_key())
+            return
+        L1_CACHE.discard(*cache_keys)
+        pipe = cls._redis.pipeline(transaction=False)
+        for cache_key in cache_keys:
+            pipe.setex(cache_key, cls._cache_negative_ttl, _NO_EXISTE)
+        pipe.incr(cls._version_key())
+        pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje(cache_keys))
+        pipe.execute()
+
+    @classmethod
+    def flush(cls) -> None:
+        """Aplica ya en MongoDB las actualizaciones diferidas (write-behind) del modelo."""
+        if cls._write_behind is not None:
+            cls._write_behind.flush()
+
+    @classmethod
+    def _serializar(cls, doc: dict) -> bytes:
+        return _serializar_cache(doc, umbral=cls._cache_umbral)
+
+    @classmethod
+    def _poner_en_cache(cls, pipe: Any, cache_key: str, valor: bytes) -> bool:
+        """
+        Añade al pipeline la escritura de una entrada segun la politica del
+        modelo y devuelve si se ha cacheado. Un documento que pasa de
+        _cache_max_doc bytes no se cachea y se borra la copia anterior.
+        """
+        if not cls._cache_enabled:
+            return False
+        if cls._cache_max_doc and len(valor) > cls._cache_max_doc:
+            pipe.delete(cache_key)
+            return False
+        pipe.setex(cache_key, cls._cache_ttl, valor)
+        return True
+
+    def _poner_modelo_en_cache(self, pipe: Any, cache_key: str) -> bytes | None:
+        """
+        Como _poner_en_cache con el documento del modelo; devuelve el valor
+        cacheado o None. Un modelo leido con proyeccion no tiene el documento
+        entero, asi que su entrada se borra y la siguiente lectura la recarga.
+        """
+        if self._parcial:
+            pipe.delete(cache_key)
+            return None
+        valor = self._serializar(self._data)
+        return valor if self._poner_en_cache(pipe, cache_key, valor) else None
+
+    @classmethod
+    def _ttl_lectura(cls) -> int:
+        # TTL a renovar en cada lectura, 0 si la caducidad es fija
+        return cls._cache_ttl if cls._cache_sliding else 0
+
+    @classmethod
+    def save_many(cls, models: list["Model"]) -> list[tuple["Model", str]]:
+        """
+        Guarda varios modelos en bloque. Por cada coleccion se manda un unico
+        bulk_write desordenado con las inserciones y las actualizaciones
+        parciales de los campos modificados, y la cache se actualiza con un
+        solo pipeline.
+        Un fallo (por ejemplo un dni duplicado) no aborta el resto.
+
+        Parameters
+        ----------
+            models : list[Model]
+                modelos a guardar, pueden ser de clases distintas
+        Returns
+        -------
+            list[tuple[Model, str]]
+                Modelos que no se pudieron guardar junto con el error
+        """
+        fallidos: list[tuple[Model, str]] = []
+
+        for model_class, grupo in _agrupar_por_clase(models).items():
+            operaciones = []
+            afectados: list[Model] = []
+            nuevos: set[int] = set()
+
+            for model in grupo:
+                model._esperar_geocodificacion()
+                if "_id" in model._data:
+                    cambios = model._operaciones()
+                    if not cambios:
+                        continue
+                    operaciones.append(UpdateOne({"_id": model._data["_id"]}, cambios))
+                else:
+                    # Asignamos el _id aqui para no depender de la respuesta
+                    model._data["_id"] = ObjectId()
+                    nuevos.add(len(operaciones))
+                    operaciones.append(InsertOne(dict(model._data)))
+                afectados.append(model)
+
+            if not operaciones:
+                continue
+
+            # Lo diferido va antes, o pisaria estos cambios al aplicarse despues
+            model_class.flush()
+
+            errores: dict[int, str] = {}
+            try:
+                model_class._db.bulk_write(operaciones, ordered=False)
+            except BulkWriteError as e:
+                errores = {error["index"]: error.get("errmsg", "") for error in e.details.get("writeErrors", [])}
+            except Exception:
+                # Sin respuesta no se sabe que se inserto: los nuevos vuelven a no
+                # tener _id, o un save() posterior haria update_one de un documento
+                # que no existe. Si alguno si llego, el reintento dara duplicado
+                for indice in nuevos:
+                    del afectados[indice]._data["_id"]
+                raise
+
+            pipe = model_class._redis.pipeline(transaction=False) if model_class._redis else None
+            cacheados: dict[str, bytes | None] = {}
+            for indice, model in enumerate(afectados):
+                if indice in errores:
+                    if indice in nuevos:
+                        # La insercion fallo, el modelo sigue sin existir
+                        del model._data["_id"]
+                    fallidos.append((model, errores[indice]))
+                    continue
+
+                if pipe is not None:
+                    cache_key = model_class._cache_key(model._data["_id"])
+                    cacheados[cache_key] = model._poner_modelo_en_cache(pipe, cache_key)
+                model._modified_vars.clear()
+
+            if pipe is not None:
+                if cacheados:
+                    pipe.incr(model_class._version_key())
+                    pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje(list(cacheados)))
+                pipe.execute()
+                for cache_key, valor in cacheados.items():
+                    if valor is None:
+                        L1_CACHE.discard(cache_key)
+                    else:
+                        L1_CACHE.actualizar(cache_key, valor)
+
+        return fallidos
+
+    @classmethod
+    def delete_many_models(cls, models: list["Model"]) -> list[tuple["Model", str]]:
+        """
+        Elimina varios modelos en bloque: un DEL para todas sus claves de cache
+        y un bulk_write desordenado de DeleteOne por coleccion.
+
+        Parameters
+        ----------
+            models : list[Model]
+                modelos a eliminar, pueden ser de clases distintas
+        Returns
+        -------
+            list[tuple[Model, str]]
+                Modelos que no se pudieron eliminar junto con el error
+        """
+        fallidos: list[tuple[Model, str]] = []
+
+        for model_class, grupo in _agrupar_por_clase(models).items():
+            existentes = []
+            for model in grupo:
+                if "_id" in model._data:
+                    existentes.append(model)
+                else:
+                    fallidos.append((model, "El modelo no existe en la base de datos."))
+
+            if not existentes:
+                continue
+
+            # Eliminar de cache primero
+            if model_class._redis:
+                model_class._descachear([model_class._cache_key(model._data["_id"]) for model in existentes])
+
+            errores: dict[int, str] = {}
+            try:
+                model_class._db.bulk_write([DeleteOne({"_id": model._data["_id"]}) for model in existentes], ordered=False)
+            except BulkWriteError as e:
+                errores = {error["index"]: error.get("errmsg", "") for error in e.details.get("writeErrors", [])}
+
+            for indice, model in enumerate(existentes):
+                if indice in errores:
+                    fallidos.append((model, errores[indice]))
+                    continue
+                model._data.clear()
+                model._modified_vars.clear()
+
+        return fallidos
     
     @classmethod
     def delete_all(cls) -> None:
         """
         SOLO POR COMODIDAD Y NO CAMBIAR EL DNI DEL USUARIO DE PRUEBA EN CADA TEST
         """
+        if cls._redis:
+            cls._redis.incr(cls._version_key())
         return cls._db.delete_many({})
     
     @classmethod
-    def find(cls, filter: dict[str, str | dict]) -> Any:
-        
-        cursor = cls._db.find(filter)
-        return ModelCursor(cls, cursor) 
+    def find(cls, filter: dict[str, str | dict], projection: list[str] | dict[str, int] | None = None,
+             sort: str | list[tuple[str, int]] | None = None, limit: int = 0, skip: int = 0,
+             batch_size: int | None = None, raw: bool = False, lazy: bool = False,
+             cache: bool = False) -> Any:
+        """
+        Busca documentos que cumplan el filtro.
+
+        Parameters
+        ----------
+            filter : dict
+                filtro de MongoDB
+            projection : list[str] | dict[str, int]
+                campos a traer, p.ej. ["nombre", "dni"]
+            sort : str | list[tuple[str, int]]
+                orden, p.ej. [("nombre", pymongo.ASCENDING)]
+            limit, skip : int
+                paginacion, 0 es sin limite
+            batch_size : int
+                documentos por lote que devuelve el servidor
+            raw : bool
+                si es True el cursor devuelve diccionarios en vez de modelos.
+                Con proyeccion los modelos son parciales: se pueden guardar,
+                pero no se cachean ni entran en la unidad de trabajo
+            lazy : bool
+                lee los documentos como RawBSONDocument y decodifica cada
+                campo la primera vez que se accede a el
+            cache : bool
+                guarda en Redis la lista ordenada de ids del resultado y los
+                documentos en la cache de find_by_id. La entrada deja de valer
+                en cuanto se guarda o borra cualquier documento del modelo.
+                Los modelos se devuelven completos aunque haya proyeccion,
+                que solo se aplica con raw (y solo a campos de primer nivel)
+        Returns
+        -------
+            ModelCursor
+        """
+        if cache and cls._redis:
+            return ModelCursor(cls, cls._find_cacheado(filter, projection, sort, limit, skip, raw), raw=raw)
+
+        collection = cls._db.with_options(codec_options=CodecOptions(document_class=RawBSONDocument)) if lazy else cls._db
+        cursor = collection.find(filter, projection, limit=limit, skip=skip)
+        if sort:
+            cursor = cursor.sort(sort)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return ModelCursor(cls, cursor, raw=raw, parcial=projection is not None, lazy=lazy)
+
+    @classmethod
+    def _find_cacheado(cls, filter: dict, projection: list[str] | dict[str, int] | None,
+                       sort: str | list[tuple[str, int]] | None, limit: int, skip: int,
+                       raw: bool) -> Generator[dict, None, None]:
+        """
+        Documentos de find(cache=True). Con la entrada de la consulta vigente
+        se cargan por id como en find_by_ids; si no, se lanza la consulta y,
+        si el resultado no pasa de _query_cache_max documentos, al terminar
+        de recorrerlo se guardan sus ids con la version leida al empezar.
+        """
+        if projection and any("." in campo or campo.startswith("$") for campo in projection):
+            raise ValueError("La cache de consultas solo admite proyecciones de campos de primer nivel.")
+
+        query_key = cls._query_key(filter, projection, sort, limit, skip)
+        version, guardado = cls._redis.mget([cls._version_key(), query_key])
+        version = int(version or 0)
+
+        if guardado:
+            entrada = _deserializar_cache(guardado)
+            if entrada["v"] == version:
+                CACHE_STATS[f"{cls.__name__}:query_hit"] += 1
+                ids = [str(id) for id in entrada["ids"]]
+                encontrados = cls._docs_por_ids(ids)
+                for id in ids:
+                    # Si ha desaparecido es que ha cambiado la version, se omite
+                    if id in encontrados:
+                        yield _proyectar(encontrados[id], projection) if raw else encontrados[id]
+                return
+
+        CACHE_STATS[f"{cls.__name__}:query_miss"] += 1
+        cursor = cls._db.find(filter, limit=limit, skip=skip)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        ids: list[ObjectId] | None = []
+        pipe = cls._redis.pipeline(transaction=False)
+        for doc in cursor:
+            if ids is not None:
+                if len(ids) < cls._query_cache_max:
+                    ids.append(doc["_id"])
+                    cls._poner_en_cache(pipe, cls._cache_key(doc["_id"]), cls._serializar(doc))
+                else:
+                    # Demasiado grande para cachearlo
+                    ids = None
+                    pipe.reset()
+            yield _proyectar(doc, projection) if raw else doc
+
+        if ids is not None:
+            pipe.setex(query_key, cls._query_cache_ttl, _serializar_cache({"v": version, "ids": ids}))
+            pipe.execute()
 
     @classmethod
     def aggregate(cls, pipeline: list[dict]) -> pymongo.command_cursor.CommandCursor:
@@ -212,49 +2363,339 @@ class Model:
         """ 
         #TODO
 
+        # Si hay unidad de trabajo y ya tenemos la instancia, ni Redis ni Mongo
+        unidad = _unidad_de_trabajo.get()
+        if unidad is not None:
+            existente = unidad.get(cls, id)
+            if existente is not None:
+                return existente
+
+        # Un id que no es un ObjectId no puede existir
+        if not ObjectId.is_valid(id):
+            logger.debug("No existe el documento con id: %s", id)
+            return None
+
+        # Modelo sin cache, directamente a MongoDB
+        if not cls._cache_enabled:
+            doc = cls._db.find_one({"_id": ObjectId(id)})
+            return cls._encontrado(id, doc) if doc else None
+
         # Construir la clave para buscar en Redis
-        cache_key = f"cache:{cls.__name__}:{id}"
+        cache_key = cls._cache_key(id)
 
-        # Intentar obtener del USUARIO en Redis
-        cached_data = cls._redis.get(cache_key)
+        # Primero la cache local, sin salir del proceso
+        cached_data = L1_CACHE.get(cache_key)
+        if cached_data is not None:
+            CACHE_STATS[f"{cls.__name__}:l1_hit"] += 1
+            return cls._encontrado(id, _deserializar_cache(cached_data))
+
+        # Intentar obtener del USUARIO en Redis, con su TTL y renovandolo, en un solo viaje
+        marca = L1_CACHE.marca()
+        cached_data, pttl = cls._leer_cache(cache_key)
         
+        if cached_data == _NO_EXISTE:
+            # Ya sabemos que no existe, no hace falta preguntar a MongoDB
+            CACHE_STATS[f"{cls.__name__}:negative_hit"] += 1
+            logger.debug("No existe el documento con id: %s", id)
+            return None
+
         if cached_data:
             #CACHE HIT
-            # Renovar el TTL
-            cls._redis.expire(cache_key, 86400)
-            
-            # Convertir el JSON de Redis a diccionario Python
-            doc_dict = json.loads(cached_data)
-            
-            # Convertir _id de string a ObjectId
-            if "_id" in doc_dict:
-                doc_dict["_id"] = ObjectId(doc_dict["_id"])
+            # Convertir los datos de Redis a diccionario Python (con _id como ObjectId)
+            doc_dict = _deserializar_cache(cached_data)
+
+            # Si la entrada esta caducando, solo un proceso la recarga y el resto sirve la que hay
+            if cls._debe_refrescar(pttl):
+                doc_dict = cls._recargar(id, cache_key, stale=doc_dict)
+                if doc_dict is None:
+                    return None
+            else:
+                L1_CACHE.set(cache_key, cached_data, marca)
             
             # Devolver la información del usuario en cache
-            return cls(**doc_dict)
+            return cls._encontrado(id, doc_dict)
         
         #CACHE MISS
-        # Ahora buscamos en MongoDB
-        doc = cls._db.find_one({"_id": ObjectId(id)})
+        # Ahora buscamos en MongoDB, solo un proceso a la vez por clave
+        doc = cls._recargar(id, cache_key)
         
         if not doc:
             # No existe ni en cache ni en MongoDB
-            print("No existe el documento con id: ", id)
+            logger.debug("No existe el documento con id: %s", id)
             return None
         
-        # Usuario encontrado en MongoDB
-        # Preparar los datos para guardar en Redis
-        doc_serializable = dict(doc)
-        doc_serializable["_id"] = str(doc["_id"])
-        
-        # Cachear en Redis, cache key -> la clave que hemos construido, 86k -> ttl, json.dumps -> convertir a string
-        cls._redis.setex(cache_key, 86400,json.dumps(doc_serializable))
-        
         # Devolver la información del usuario esta vez de mongo
-        return cls(**doc)
+        return cls._encontrado(id, doc)
+
+    @classmethod
+    def _encontrado(cls, id: str, doc: dict) -> Self:
+        # Salida de find_by_id con documento: cuenta el acceso y pasa por la unidad de trabajo
+        if cls._track_access:
+            ACCESOS.registrar(cls, id)
+        return _registrar_identidad(cls._hidratar(doc))
+
+    @classmethod
+    def _accesos_key(cls) -> str:
+        return f"accesos:{cls.__name__}"
+
+    @classmethod
+    def _leer_cache(cls, cache_key: str) -> tuple[bytes | None, int | None]:
+        """Lee una entrada y su TTL y renueva el TTL si la entrada no esta caducando."""
+        resultado = cls._script_leer_cache(keys=[cache_key], args=[cls._ttl_lectura(), cls._cache_stale * 1000, _NO_EXISTE])
+        if not resultado:
+            return None, None
+        return resultado[0], resultado[1]
+
+    @classmethod
+    def _debe_refrescar(cls, pttl: int) -> bool:
+        """
+        Indica si una entrada leida de la cache hay que recargarla: cuando ha
+        entrado en la ventana de caducidad o, con XFetch, de forma
+        anticipada con mas probabilidad cuanto menos le queda.
+        """
+        if pttl is None or pttl < 0:
+            return False
+        restante = pttl / 1000 - cls._cache_stale
+        if restante <= 0:
+            return True
+        if CACHE_EARLY_REFRESH_BETA > 0:
+            if cls._tiempo_recarga * CACHE_EARLY_REFRESH_BETA * -math.log(1.0 - random.random()) >= restante:
+                CACHE_STATS[f"{cls.__name__}:early_refresh"] += 1
+                return True
+        return False
+
+    @classmethod
+    def _recargar(cls, id: str, cache_key: str, stale: dict | None = None) -> dict | None:
+        """
+        Carga el documento de MongoDB y lo cachea, con un lock corto en Redis
+        para que solo un proceso recargue cada clave. Quien no consigue el
+        lock devuelve el valor caducado si lo tiene o espera un poco a que
+        aparezca en la cache antes de ir a MongoDB por su cuenta. Si el
+        documento no existe se deja una marca de inexistente.
+        """
+        lock = cls._redis.lock(f"lock:{cache_key}", timeout=CACHE_LOCK_TIMEOUT)
+
+        if lock.acquire(blocking=False):
+            try:
+                marca = L1_CACHE.marca()
+                inicio = time.monotonic()
+                doc = cls._db.find_one({"_id": ObjectId(id)})
+                # Media movil del coste de recarga, la usa XFetch
+                cls._tiempo_recarga = 0.8 * cls._tiempo_recarga + 0.2 * (time.monotonic() - inicio)
+                if doc:
+                    valor = cls._serializar(doc)
+                    pipe = cls._redis.pipeline(transaction=False)
+                    cacheado = cls._poner_en_cache(pipe, cache_key, valor)
+                    pipe.execute()
+                    if cacheado:
+                        L1_CACHE.set(cache_key, valor, marca)
+                else:
+                    # Sin valor previo con nx, para no pisar una insercion que acabe de cachearse
+                    cls._redis.set(cache_key, _NO_EXISTE, ex=cls._cache_negative_ttl, nx=stale is None)
+                CACHE_STATS[f"{cls.__name__}:reload"] += 1
+                return doc
+            finally:
+                try:
+                    lock.release()
+                except redis.exceptions.LockError:
+                    # El lock caduco mientras recargabamos
+                    pass
+
+        if stale is not None:
+            CACHE_STATS[f"{cls.__name__}:stale"] += 1
+            return stale
+
+        limite = time.monotonic() + CACHE_LOCK_WAIT
+        while time.monotonic() < limite:
+            time.sleep(0.01)
+            cached_data = cls._redis.get(cache_key)
+            if cached_data:
+                CACHE_STATS[f"{cls.__name__}:coalesced"] += 1
+                return None if cached_data == _NO_EXISTE else _deserializar_cache(cached_data)
+
+        CACHE_STATS[f"{cls.__name__}:lock_timeout"] += 1
+        return cls._db.find_one({"_id": ObjectId(id)})
+
+    @classmethod
+    def find_by_ids(cls, ids: list[str]) -> list[Self | None]:
+        """
+        Busca varios documentos por id en bloque. Las claves de cache se leen
+        con un solo MGET, los TTL se renuevan en un pipeline, los fallos se
+        cargan de MongoDB con una unica consulta $in y se vuelven a cachear
+        con otro pipeline.
+
+        Parameters
+        ----------
+            ids : list[str]
+                ids de los documentos a buscar
+        Returns
+        -------
+            list[Self | None]
+                Modelos en el mismo orden que ids, None para los que no existen
+        """
+        if not ids:
+            return []
+
+        ids = [str(id) for id in ids]
+        vivos: dict[str, Self] = {}
+
+        # Las instancias que ya estan en la unidad de trabajo no se vuelven a pedir
+        unidad = _unidad_de_trabajo.get()
+        if unidad is not None:
+            for id in ids:
+                existente = unidad.get(cls, id)
+                if existente is not None:
+                    vivos[id] = existente
+
+        encontrados = cls._docs_por_ids([id for id in dict.fromkeys(ids) if id not in vivos])
+
+        for id, doc in encontrados.items():
+            vivos[id] = cls._encontrado(id, doc)
+
+        return [vivos.get(id) for id in ids]
+
+    @classmethod
+    def _docs_por_ids(cls, ids: list[str]) -> dict[str, dict]:
+        """
+        Documentos de los ids indicados (sin repetidos): primero la L1, luego
+        Redis en un solo viaje (un pipeline de GETEX si la caducidad es
+        deslizante, un MGET si es fija) y los que falten con una sola
+        consulta $in que se vuelve a cachear con otro pipeline.
+        """
+        if not cls._cache_enabled:
+            validos = [ObjectId(id) for id in ids if ObjectId.is_valid(id)]
+            return {str(doc["_id"]): doc for doc in cls._db.find({"_id": {"$in": validos}})} if validos else {}
+
+        # Lo que este en la L1 no sale del proceso
+        encontrados: dict[str, dict] = {}
+        unicos = []
+        for id in ids:
+            data = L1_CACHE.get(cls._cache_key(id))
+            if data is not None:
+                CACHE_STATS[f"{cls.__name__}:l1_hit"] += 1
+                encontrados[id] = _deserializar_cache(data)
+            else:
+                unicos.append(id)
+        cache_keys = [cls._cache_key(id) for id in unicos]
+        pendientes: list[str] = []
+
+        marca = L1_CACHE.marca()
+        if not cache_keys:
+            cached_data = []
+        elif cls._cache_sliding:
+            # Leer y renovar los TTL de golpe
+            pipe = cls._redis.pipeline(transaction=False)
+            for cache_key in cache_keys:
+                pipe.getex(cache_key, ex=cls._cache_ttl)
+            cached_data = pipe.execute()
+        else:
+            cached_data = cls._redis.mget(cache_keys)
+
+        negativos = []
+        for id, cache_key, data in zip(unicos, cache_keys, cached_data):
+            if data == _NO_EXISTE:
+                CACHE_STATS[f"{cls.__name__}:negative_hit"] += 1
+                negativos.append(cache_key)
+            elif data:
+                #CACHE HIT
+                encontrados[id] = _deserializar_cache(data)
+                L1_CACHE.set(cache_key, data, marca)
+            elif ObjectId.is_valid(id):
+                pendientes.append(id)
+
+        pipe = cls._redis.pipeline(transaction=False)
+        if negativos and cls._cache_sliding:
+            # GETEX tambien ha alargado las marcas de inexistente, se devuelven a su TTL
+            for cache_key in negativos:
+                pipe.expire(cache_key, cls._cache_negative_ttl)
+
+        cargados: dict[str, bytes] = {}
+        if pendientes:
+            #CACHE MISS, una sola consulta a MongoDB para todos
+            marca = L1_CACHE.marca()
+            for doc in cls._db.find({"_id": {"$in": [ObjectId(id) for id in pendientes]}}):
+                cache_key = cls._cache_key(doc["_id"])
+                valor = cls._serializar(doc)
+                if cls._poner_en_cache(pipe, cache_key, valor):
+                    cargados[cache_key] = valor
+                encontrados[str(doc["_id"])] = doc
+            for id in pendientes:
+                if id not in encontrados:
+                    pipe.set(cls._cache_key(id), _NO_EXISTE, ex=cls._cache_negative_ttl, nx=True)
+        if len(pipe):
+            pipe.execute()
+        for cache_key, valor in cargados.items():
+            L1_CACHE.set(cache_key, valor, marca)
+
+        return encontrados
+
+    @classmethod
+    def _configurar_cache(cls, cache: dict | None) -> None:
+        """
+        Aplica la seccion cache de models.yml. Todas las claves son opcionales:
+
+            cache:
+              enabled: true            # false: find_by_id va siempre a MongoDB
+              ttl: 86400               # segundos; si no pasa de 2 * CACHE_STALE_TTL la ventana
+                                       # de caducidad servible se reduce a la mitad del ttl
+              expiry: sliding          # sliding renueva el TTL al leer, fixed no
+              compress_threshold: 1024 # bytes a partir de los que se comprime
+              max_doc_size: 0          # bytes, los documentos mayores no se cachean (0 sin limite)
+              negative_ttl: 30         # segundos que se recuerda un id inexistente
+              prefix: cache            # las claves quedan <prefix>:<Modelo>:<id>
+              track_access: false      # cuenta las lecturas para calentar_cache
+        """
+        cache = cache or {}
+        expiry = cache.get("expiry", "sliding")
+        if expiry not in ("sliding", "fixed"):
+            raise ValueError(f"expiry de la cache de {cls.__name__} debe ser 'sliding' o 'fixed', no '{expiry}'.")
+        cls._cache_enabled = bool(cache.get("enabled", True))
+        cls._cache_ttl = int(cache.get("ttl", CACHE_TTL))
+        if cls._cache_ttl <= 0:
+            raise ValueError(f"ttl de la cache de {cls.__name__} debe ser mayor que 0, no {cls._cache_ttl}.")
+        # Con un ttl dentro de la ventana de caducidad cada lectura contaria
+        # como caducada y recargaria de MongoDB
+        cls._cache_stale = min(CACHE_STALE_TTL, cls._cache_ttl // 2)
+        if cls._cache_stale < CACHE_STALE_TTL:
+            logger.warning("ttl de la cache de %s (%ss) no supera 2 * CACHE_STALE_TTL: la ventana de caducidad queda en %ss",
+                           cls.__name__, cls._cache_ttl, cls._cache_stale)
+        cls._cache_sliding = expiry == "sliding"
+        cls._cache_umbral = int(cache.get("compress_threshold", CACHE_COMPRESS_THRESHOLD))
+        cls._cache_max_doc = int(cache.get("max_doc_size", 0))
+        cls._cache_negative_ttl = int(cache.get("negative_ttl", CACHE_NEGATIVE_TTL))
+        cls._cache_prefix = cache.get("prefix", "cache")
+        cls._track_access = bool(cache.get("track_access", False))
 
     @classmethod
-    def init_class(cls, redis_client:None, db_collection: pymongo.collection.Collection, indexes:dict[str,str], required_vars: set[str], admissible_vars: set[str]) -> None:
+    def _configurar_write_behind(cls, write_behind: dict | None) -> None:
+        """
+        Aplica la seccion write_behind de models.yml:
+
+            write_behind:
+              enabled: true
+              batch_size: 500     # actualizaciones por bulk_write
+              max_wait: 1         # segundos desde la primera pendiente
+              max_pending: 10000  # save() hace flush si hay mas sin aplicar
+        """
+        if cls._write_behind is not None:
+            cls._write_behind.stop()
+            cls._write_behind = None
+        write_behind = write_behind or {}
+        if not write_behind.get("enabled", False) or not cls._redis:
+            return
+        if not cls._cache_enabled:
+            # Sin cache las lecturas irian a MongoDB y no verian lo pendiente hasta el flush
+            raise ValueError(f"write_behind de {cls.__name__} necesita la cache activada.")
+        cls._write_behind = WriteBehind(
+            cls,
+            batch_size=int(write_behind.get("batch_size", WRITE_BEHIND_BATCH)),
+            max_wait=float(write_behind.get("max_wait", WRITE_BEHIND_WAIT)),
+            max_pending=int(write_behind.get("max_pending", WRITE_BEHIND_MAX_PENDING)),
+        )
+        cls._write_behind.start()
+
+    @classmethod
+    def init_class(cls, redis_client:None, db_collection: pymongo.collection.Collection, indexes:dict[str,str], required_vars: set[str], admissible_vars: set[str], query_cache: dict | None = None, cache: dict | None = None, write_behind: dict | None = None) -> None:
       
 
         cls._db = db_collection
@@ -262,6 +2703,15 @@ class Model:
         cls._required_vars = required_vars
         cls._admissible_vars = admissible_vars
         cls._location_var = indexes.get("location_index", None)
+        if redis_client:
+            cls._script_leer_cache = redis_client.register_script(_LUA_LEER_CACHE)
+            cls._script_parchear_cache = redis_client.register_script(_LUA_PARCHEAR_CACHE)
+            cls._script_accesos = redis_client.register_script(_LUA_REGISTRAR_ACCESOS)
+        query_cache = query_cache or {}
+        cls._query_cache_ttl = int(query_cache.get("ttl", QUERY_CACHE_TTL))
+        cls._query_cache_max = int(query_cache.get("max_results", QUERY_CACHE_MAX_RESULTS))
+        cls._configurar_cache(cache)
+        cls._configurar_write_behind(write_behind)
 
         
         if "unique_indexes" in indexes:
@@ -283,32 +2733,846 @@ class ModelCursor:
     model_class: Model
     cursor: pymongo.cursor.Cursor
 
-    def __init__(self, model_class: Model, cursor: pymongo.cursor.Cursor):
+    def __init__(self, model_class: Model, cursor: pymongo.cursor.Cursor, raw: bool = False, parcial: bool = False, lazy: bool = False):
 
         self.model_class = model_class
         self.cursor = cursor
+        self.raw = raw
+        self.parcial = parcial
+        self.lazy = lazy
     
     def __iter__(self) -> Generator:
         
-        while(self.cursor.alive == True):
-            document = next(self.cursor)
-            yield self.model_class(**document)
+        # Iterar el cursor directamente termina limpio al agotarse
+        if self.raw:
+            yield from self.cursor
+            return
+
+        # Los documentos vienen de nuestra coleccion, no hace falta validarlos
+        construir = self.model_class._hidratar_lazy if self.lazy else self.model_class._hidratar
+        for document in self.cursor:
+            model = construir(document)
+            if self.parcial:
+                # Sin el documento entero no puede ser la instancia canonica de su _id
+                model._parcial = True
+                yield model
+            else:
+                yield _registrar_identidad(model)
 
      
             
 
 
-def initApp(definitions_path: str = "./models.yml", db_name=None, mongodb_uri=None, scope=globals()) -> None:
+class AsyncModel(Model):
+    """
+    Version asyncio de Model sobre AsyncMongoClient y redis.asyncio. Usa las
+    mismas claves de cache (cache:<Modelo>:<id>), el mismo TTL y el mismo
+    formato, asi que workers sincronos y asincronos comparten la cache.
+    La direccion se geocodifica siempre en segundo plano para no bloquear
+    el bucle de eventos. save_many, delete_many_models y UnitOfWork son
+    solo para modelos sincronos y lanzan TypeError con estos.
+
+        p = await persona.find_by_id(id)
+        p.telefono = "+34 600 000 000"
+        await p.save()
+        async for p in persona.find({"nombre": "Lucia"}):
+            ...
+    """
+
+    __slots__ = ()
+
+    _db: Any
+    _geocode_async = True
+    _asincrono = True
+    # Modelo sincrono de la misma coleccion: los accesos se vuelcan con su
+    # cliente desde el hilo de ACCESOS, en la misma clave accesos:<Modelo>
+    _modelo_sincrono: Any = None
+
+    def _geocodificar(self, value: str) -> None:
+        # La cache de geocodificacion usa el cliente sincrono de Redis: la consulta el hilo de la cola
+        future = GEOCODE_QUEUE.submit(value, consultar_cache=False)
+        self._geocoding = future
+        future.add_done_callback(self._aplicar_geocodificacion)
+
+    async def _esperar_geocodificacion_async(self) -> None:
+        future = self._geocoding
+        if future is not None:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception:
+                pass
+            self._aplicar_geocodificacion(future)
+
+    async def _cachear_async(self) -> None:
+        # Como Model._cachear, los workers sincronos tambien escuchan el canal
+        if not self._cache_enabled:
+            await self._redis.incr(self._version_key())
+            return
+        cache_key = self._cache_key(self._data["_id"])
+        pipe = self._redis.pipeline(transaction=False)
+        valor = self._poner_modelo_en_cache(pipe, cache_key)
+        pipe.incr(self._version_key())
+        pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje([cache_key]))
+        await pipe.execute()
+        if valor is not None:
+            L1_CACHE.actualizar(cache_key, valor)
+        else:
+            L1_CACHE.discard(cache_key)
+
+    async def save(self) -> None:
+
+        await self._esperar_geocodificacion_async()
+
+        if "_id" in self._data:
+            # Actualización
+            operaciones = self._operaciones()
+            if operaciones:
+                await self._db.update_one({"_id": self._data["_id"]}, operaciones)
+                if self._redis:
+                    await self._cachear_async()
+                self._modified_vars.clear()
+        else:
+            # Inserción nueva
+            result = await self._db.insert_one(dict(self._data))
+            self._data["_id"] = result.inserted_id
+            if self._redis:
+                await self._cachear_async()
+            self._modified_vars.clear()
+
+    async def delete(self) -> None:
+
+        if "_id" not in self._data:
+            raise ValueError("El modelo no existe en la base de datos.")
+
+        if self._redis:
+            cache_key = self._cache_key(self._data["_id"])
+            pipe = self._redis.pipeline(transaction=False)
+            if self._cache_enabled:
+                L1_CACHE.discard(cache_key)
+                pipe.setex(cache_key, self._cache_negative_ttl, _NO_EXISTE)
+                pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje([cache_key]))
+            pipe.incr(self._version_key())
+            await pipe.execute()
+        await self._db.delete_one({"_id": self._data["_id"]})
+        self._data.clear()
+        self._modified_vars.clear()
+
+    @classmethod
+    async def delete_all(cls) -> Any:
+        if cls._redis:
+            await cls._redis.incr(cls._version_key())
+        return await cls._db.delete_many({})
+
+    @classmethod
+    def find(cls, filter: dict[str, str | dict], projection: list[str] | dict[str, int] | None = None,
+             sort: str | list[tuple[str, int]] | None = None, limit: int = 0, skip: int = 0,
+             batch_size: int | None = None, raw: bool = False,
+             lazy: bool = False) -> "AsyncModelCursor":
+        """Igual que Model.find pero el cursor se recorre con async for."""
+        collection = cls._db.with_options(codec_options=CodecOptions(document_class=RawBSONDocument)) if lazy else cls._db
+        cursor = collection.find(filter, projection, limit=limit, skip=skip)
+        if sort:
+            cursor = cursor.sort(sort)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return AsyncModelCursor(cls, cursor, raw=raw, parcial=projection is not None, lazy=lazy)
+
+    @classmethod
+    async def find_by_id(cls, id: str) -> Self | None:
+        """Version asincrona de Model.find_by_id."""
+        if not ObjectId.is_valid(id):
+            logger.debug("No existe el documento con id: %s", id)
+            return None
+
+        if not cls._cache_enabled:
+            doc = await cls._db.find_one({"_id": ObjectId(id)})
+            return cls._encontrado_async(id, doc) if doc else None
+
+        cache_key = cls._cache_key(id)
+
+        # La L1 es la misma que la de los modelos sincronos
+        cached_data = L1_CACHE.get(cache_key)
+        if cached_data is not None:
+            CACHE_STATS[f"{cls.__name__}:l1_hit"] += 1
+            return cls._encontrado_async(id, _deserializar_cache(cached_data))
+
+        # El mismo script que Model._leer_cache: GET y renovar el TTL en un viaje
+        marca = L1_CACHE.marca()
+        resultado = await cls._script_leer_cache(keys=[cache_key], args=[cls._ttl_lectura(), cls._cache_stale * 1000, _NO_EXISTE])
+        cached_data, pttl = (resultado[0], resultado[1]) if resultado else (None, None)
+        if cached_data == _NO_EXISTE:
+            CACHE_STATS[f"{cls.__name__}:negative_hit"] += 1
+            logger.debug("No existe el documento con id: %s", id)
+            return None
+        if cached_data:
+            #CACHE HIT
+            doc_dict = _deserializar_cache(cached_data)
+            # Si la entrada esta caducando, solo uno la recarga y el resto sirve la que hay
+            if cls._debe_refrescar(pttl):
+                doc_dict = await cls._recargar_async(id, cache_key, stale=doc_dict)
+                if doc_dict is None:
+                    return None
+            else:
+                L1_CACHE.set(cache_key, cached_data, marca)
+            return cls._encontrado_async(id, doc_dict)
+
+        #CACHE MISS
+        doc = await cls._recargar_async(id, cache_key)
+        if not doc:
+            logger.debug("No existe el documento con id: %s", id)
+            return None
+        return cls._encontrado_async(id, doc)
+
+    @classmethod
+    def _encontrado_async(cls, id: str, doc: dict) -> Self:
+        # Como Model._encontrado, sin unidad de trabajo
+        if cls._track_access and cls._modelo_sincrono is not None:
+            ACCESOS.registrar(cls._modelo_sincrono, id)
+        return cls._hidratar(doc)
+
+    @classmethod
+    async def _recargar_async(cls, id: str, cache_key: str, stale: dict | None = None) -> dict | None:
+        """Model._recargar sin bloquear el bucle de eventos, con el mismo lock en Redis."""
+        lock = cls._redis.lock(f"lock:{cache_key}", timeout=CACHE_LOCK_TIMEOUT)
+
+        if await lock.acquire(blocking=False):
+            try:
+                marca = L1_CACHE.marca()
+                inicio = time.monotonic()
+                doc = await cls._db.find_one({"_id": ObjectId(id)})
+                cls._tiempo_recarga = 0.8 * cls._tiempo_recarga + 0.2 * (time.monotonic() - inicio)
+                if doc:
+                    valor = cls._serializar(doc)
+                    pipe = cls._redis.pipeline(transaction=False)
+                    cacheado = cls._poner_en_cache(pipe, cache_key, valor)
+                    await pipe.execute()
+                    if cacheado:
+                        L1_CACHE.set(cache_key, valor, marca)
+                else:
+                    await cls._redis.set(cache_key, _NO_EXISTE, ex=cls._cache_negative_ttl, nx=stale is None)
+                CACHE_STATS[f"{cls.__name__}:reload"] += 1
+                return doc
+            finally:
+                try:
+                    await lock.release()
+                except redis.exceptions.LockError:
+                    pass
+
+        if stale is not None:
+            CACHE_STATS[f"{cls.__name__}:stale"] += 1
+            return stale
+
+        limite = time.monotonic() + CACHE_LOCK_WAIT
+        while time.monotonic() < limite:
+            await asyncio.sleep(0.01)
+            cached_data = await cls._redis.get(cache_key)
+            if cached_data:
+                CACHE_STATS[f"{cls.__name__}:coalesced"] += 1
+                return None if cached_data == _NO_EXISTE else _deserializar_cache(cached_data)
+
+        CACHE_STATS[f"{cls.__name__}:lock_timeout"] += 1
+        return await cls._db.find_one({"_id": ObjectId(id)})
+
+    @classmethod
+    async def find_by_ids(cls, ids: list[str]) -> list[Self | None]:
+        """Version asincrona de Model.find_by_ids."""
+        if not ids:
+            return []
+
+        ids = [str(id) for id in ids]
+        unicos = [id for id in dict.fromkeys(ids) if ObjectId.is_valid(id)]
+        encontrados: dict[str, dict] = {}
+        pendientes: list[str] = []
+
+        if not cls._cache_enabled:
+            if unicos:
+                async for doc in cls._db.find({"_id": {"$in": [ObjectId(id) for id in unicos]}}):
+                    encontrados[str(doc["_id"])] = doc
+            modelos = {id: cls._encontrado_async(id, doc) for id, doc in encontrados.items()}
+            return [modelos.get(id) for id in ids]
+
+        # Como Model._docs_por_ids, lo que este en la L1 no sale del proceso
+        en_redis = []
+        for id in unicos:
+            data = L1_CACHE.get(cls._cache_key(id))
+            if data is not None:
+                CACHE_STATS[f"{cls.__name__}:l1_hit"] += 1
+                encontrados[id] = _deserializar_cache(data)
+            else:
+                en_redis.append(id)
+        cache_keys = [cls._cache_key(id) for id in en_redis]
+
+        marca = L1_CACHE.marca()
+        if not cache_keys:
+            cached_data = []
+        elif cls._cache_sliding:
+            pipe = cls._redis.pipeline(transaction=False)
+            for cache_key in cache_keys:
+                pipe.getex(cache_key, ex=cls._cache_ttl)
+            cached_data = await pipe.execute()
+        else:
+            cached_data = await cls._redis.mget(cache_keys)
+
+        pipe = cls._redis.pipeline(transaction=False)
+        for id, cache_key, data in zip(en_redis, cache_keys, cached_data):
+            if data == _NO_EXISTE:
+                if cls._cache_sliding:
+                    pipe.expire(cache_key, cls._cache_negative_ttl)
+            elif data:
+                encontrados[id] = _deserializar_cache(data)
+                L1_CACHE.set(cache_key, data, marca)
+            else:
+                pendientes.append(id)
+
+        cargados: dict[str, bytes] = {}
+        if pendientes:
+            marca = L1_CACHE.marca()
+            async for doc in cls._db.find({"_id": {"$in": [ObjectId(id) for id in pendientes]}}):
+                cache_key = cls._cache_key(doc["_id"])
+                valor = cls._serializar(doc)
+                if cls._poner_en_cache(pipe, cache_key, valor):
+                    cargados[cache_key] = valor
+                encontrados[str(doc["_id"])] = doc
+            for id in pendientes:
+                if id not in encontrados:
+                    pipe.set(cls._cache_key(id), _NO_EXISTE, ex=cls._cache_negative_ttl, nx=True)
+        if len(pipe):
+            await pipe.execute()
+        for cache_key, valor in cargados.items():
+            L1_CACHE.set(cache_key, valor, marca)
+
+        modelos = {id: cls._encontrado_async(id, doc) for id, doc in encontrados.items()}
+        return [modelos.get(id) for id in ids]
+
+    @classmethod
+    def init_class(cls, redis_client: None, db_collection: Any, indexes: dict[str, str], required_vars: set[str], admissible_vars: set[str], cache: dict | None = None, modelo_sincrono: Any = None) -> None:
+        # Los indices ya los crea la clase sincrona, aqui solo se enlaza
+        cls._db = db_collection
+        cls._modelo_sincrono = modelo_sincrono
+        cls._redis = redis_client
+        cls._required_vars = required_vars
+        cls._admissible_vars = admissible_vars
+        cls._location_var = indexes.get("location_index", None)
+        cls._configurar_cache(cache)
+        if cls._track_access and modelo_sincrono is None:
+            logger.warning("%s: track_access sin modelo sincrono, sus accesos no se registran", cls.__name__)
+        if redis_client:
+            cls._script_leer_cache = redis_client.register_script(_LUA_LEER_CACHE)
+
+
+class AsyncModelCursor(ModelCursor):
+
+    def __aiter__(self) -> AsyncGenerator:
+        return self._recorrer()
+
+    async def _recorrer(self) -> AsyncGenerator:
+        construir = self.model_class._hidratar_lazy if self.lazy else self.model_class._hidratar
+        async for document in self.cursor:
+            if self.raw:
+                yield document
+                continue
+            model = construir(document)
+            model._parcial = self.parcial
+            yield model
+
+
+class UnitOfWork:
+    """
+    Unidad de trabajo con mapa de identidad. Dentro del bloque with cada
+    (clase, _id) corresponde a una unica instancia viva, save() y delete()
+    se aplazan y al salir se escribe todo de golpe: un bulk_write por
+    coleccion y un pipeline de Redis. Si el bloque lanza una excepcion
+    no se escribe nada.
+
+        with UnitOfWork():
+            p = persona.find_by_id(id)
+            p.telefono = "+34 600 000 000"
+            persona.find_by_id(id).descripcion = "..."   # misma instancia
+
+    Los modelos con campos modificados, tambien dentro de sus listas o
+    subdocumentos, se guardan aunque no se llame a save().
+    """
+
+    def __init__(self):
+        self._identidades: dict[tuple[type, str], Model] = {}
+        self._nuevos: list[Model] = []
+        # Modelos leidos con proyeccion: se guardan, pero no estan en el mapa de identidad
+        self._parciales: list[Model] = []
+        self._eliminados: list[Model] = []
+        self.fallidos: list[tuple[Model, str]] = []
+        self._tokens = []
+
+    def __enter__(self) -> Self:
+        self._tokens.append(_unidad_de_trabajo.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        _unidad_de_trabajo.reset(self._tokens.pop())
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def get(self, model_class: type, id: str | ObjectId) -> Model | None:
+        return self._identidades.get((model_class, str(id)))
+
+    def registrar(self, model: Model) -> Model:
+        """Registra el modelo y devuelve la instancia canonica para su _id."""
+        if "_id" not in model._data or model._parcial:
+            return model
+        return self._identidades.setdefault((type(model), str(model._data["_id"])), model)
+
+    def add(self, model: Model) -> None:
+        if model._parcial:
+            if not any(model is parcial for parcial in self._parciales):
+                self._parciales.append(model)
+        elif "_id" in model._data:
+            self.registrar(model)
+        elif not any(model is nuevo for nuevo in self._nuevos):
+            self._nuevos.append(model)
+
+    def remove(self, model: Model) -> None:
+        if not any(model is eliminado for eliminado in self._eliminados):
+            self._eliminados.append(model)
+
+    def flush(self) -> list[tuple[Model, str]]:
+        """Escribe los cambios pendientes y devuelve los modelos que fallaron."""
+        eliminados = {id(model) for model in self._eliminados}
+        pendientes = list(self._nuevos) + [model for model in self._parciales if id(model) not in eliminados]
+        pendientes += [model for model in self._identidades.values()
+                       if model._pendiente() and id(model) not in eliminados]
+
+        fallidos = Model.save_many(pendientes) if pendientes else []
+        for model in self._nuevos:
+            self.registrar(model)
+
+        if self._eliminados:
+            claves = [(type(model), str(model._data["_id"])) for model in self._eliminados]
+            fallidos += Model.delete_many_models(self._eliminados)
+            for clave in claves:
+                self._identidades.pop(clave, None)
+
+        self._nuevos.clear()
+        self._parciales.clear()
+        self._eliminados.clear()
+        self.fallidos += fallidos
+        return fallidos
+
+
+class WriteBehind:
+    """
+    Escrituras diferidas de un modelo. save() de un documento existente
+    actualiza la cache y añade el $set al stream wb:<Modelo> en el mismo
+    viaje a Redis, y un hilo las aplica en MongoDB: junta las de un lote
+    (hasta batch_size o max_wait segundos desde la primera) en un $set por
+    _id y las manda en un solo bulk_write. Las inserciones siguen siendo
+    sincronas, para que los errores de indices unicos lleguen a quien guarda.
+
+    Solo un proceso aplica lotes a la vez (lock en Redis), asi que las
+    actualizaciones de un mismo _id se aplican en orden. Las entradas se
+    confirman (XACK) y borran tras escribirlas; las que quedan pendientes
+    porque un proceso murio o MongoDB fallo se reclaman y se aplican antes
+    que las nuevas en el siguiente lote. save_many hace flush antes de su
+    bulk_write; AsyncModel no usa write-behind y escribe directamente.
+    Tras aplicar un lote se borran de la cache los _id sin cambios
+    posteriores, por si una lectura cacheo el documento de antes. Necesita
+    la cache del modelo: sin ella las lecturas no ven lo pendiente.
+    """
+
+    GRUPO = "flusher"
+
+    def __init__(self, model: type, batch_size: int = WRITE_BEHIND_BATCH, max_wait: float = WRITE_BEHIND_WAIT,
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.stream = f"wb:{model.__name__}"
+        self._redis = model._redis
+        self._consumidor = uuid.uuid4().hex
+        self._lock_timeout = max(30.0, 10 * max_wait)
+        self._parar = threading.Event()
+        self._hilo: threading.Thread | None = None
+        self._crear_grupo()
+
+    def _crear_grupo(self) -> None:
+        try:
+            # Desde 0: lo que quedara en el stream de antes tambien se aplica
+            self._redis.xgroup_create(self.stream, self.GRUPO, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def encolar(self, model: "Model", update_doc: dict, quitados: list[str] = ()) -> None:
+        """Actualiza la cache y añade el cambio al stream; si hay demasiados sin aplicar, flush."""
+        entrada = {"id": str(model._data["_id"]), "set": bson.encode(update_doc)}
+        if quitados:
+            entrada["unset"] = " ".join(quitados)
+        operaciones = {"$set": update_doc, "$unset": dict.fromkeys(quitados, "")}
+        resultados = model._cachear(lambda pipe: (pipe.xadd(self.stream, entrada), pipe.xlen(self.stream)),
+                                    operaciones={op: rutas for op, rutas in operaciones.items() if rutas})
+        if resultados[-1] > self.max_pending:
+            CACHE_STATS[f"{self.model.__name__}:wb_backpressure"] += 1
+            self.flush()
+
+    def start(self) -> None:
+        if self._hilo is None:
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._bucle, name=f"write-behind-{self.model.__name__}", daemon=True)
+            self._hilo.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout)
+            self._hilo = None
+
+    def flush(self) -> None:
+        """Aplica desde este hilo todo lo que haya en el stream."""
+        while self._ciclo(esperar=False, blocking_timeout=None):
+            pass
+
+    def _bucle(self) -> None:
+        while not self._parar.is_set():
+            try:
+                if not self._ciclo(esperar=True, blocking_timeout=self.max_wait):
+                    # Sin nada que hacer o con otro proceso aplicando
+                    self._parar.wait(self.max_wait / 10)
+            except (pymongo.errors.PyMongoError, redis.exceptions.RedisError) as e:
+                logger.warning("Error aplicando las escrituras diferidas de %s: %s", self.model.__name__, e)
+                self._parar.wait(1)
+
+    def _ciclo(self, esperar: bool, blocking_timeout: float | None) -> int:
+        """Aplica un lote con el lock. Devuelve cuantas entradas se han aplicado."""
+        lock = self._redis.lock(f"lock:{self.stream}", timeout=self._lock_timeout, blocking_timeout=blocking_timeout)
+        if not lock.acquire():
+            return 0
+        try:
+            # Con el lock nadie esta aplicando: lo pendiente es de un intento fallido
+            mensajes = self._reclamar() or self._leer_lote(esperar)
+            if mensajes:
+                self._aplicar(mensajes)
+            return len(mensajes)
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                pass
+
+    def _reclamar(self) -> list:
+        respuesta = self._redis.xautoclaim(self.stream, self.GRUPO, self._consumidor, min_idle_time=0,
+                                           start_id="0-0", count=self.batch_size)
+        # Las entradas borradas del stream pero aun pendientes llegan vacias
+        return [mensaje for mensaje in respuesta[1] if mensaje and mensaje[1]]
+
+    def _leer_lote(self, esperar: bool) -> list:
+        mensajes: list = []
+        limite = None
+        while len(mensajes) < self.batch_size:
+            bloqueo = None
+            if esperar:
+                espera = self.max_wait if limite is None else limite - time.monotonic()
+                if espera <= 0:
+                    break
+                # block=0 en Redis es esperar para siempre
+                bloqueo = max(1, int(espera * 1000))
+            leidos = self._redis.xreadgroup(self.GRUPO, self._consumidor, {self.stream: ">"},
+                                            count=self.batch_size - len(mensajes), block=bloqueo)
+            if not leidos or not leidos[0][1]:
+                break
+            if limite is None:
+                limite = time.monotonic() + self.max_wait
+            mensajes.extend(leidos[0][1])
+        return mensajes
+
+    def _aplicar(self, mensajes: list) -> None:
+        # Un $set (y $unset) por _id con los campos de todas sus entradas, en orden
+        cambios: dict[ObjectId, dict[str, dict]] = {}
+        for _, campos in mensajes:
+            id = ObjectId(campos[b"id"].decode())
+            cambio = cambios.setdefault(id, {"$set": {}, "$unset": {}})
+            for campo, valor in bson.decode(campos[b"set"]).items():
+                cambio["$set"][campo] = valor
+                cambio["$unset"].pop(campo, None)
+            for campo in campos.get(b"unset", b"").decode().split():
+                cambio["$unset"][campo] = ""
+                cambio["$set"].pop(campo, None)
+
+        ids = list(cambios)
+        fallidos: list[ObjectId] = []
+        try:
+            self.model._db.bulk_write([UpdateOne({"_id": id}, {op: campos for op, campos in cambio.items() if campos})
+                                       for id, cambio in cambios.items()], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                logger.error("Escritura diferida de %s con _id %s descartada: %s",
+                             self.model.__name__, ids[error["index"]], error.get("errmsg", ""))
+                fallidos.append(ids[error["index"]])
+
+        nombre = self.model.__name__
+        CACHE_STATS[f"{nombre}:wb_applied"] += len(cambios) - len(fallidos)
+        CACHE_STATS[f"{nombre}:wb_coalesced"] += len(mensajes) - len(cambios)
+
+        # La cache tiene un valor que MongoDB ha rechazado: fuera, para que se relea.
+        # Y las aplicadas tambien: si la entrada se desalojo antes del flush, una
+        # lectura pudo cachear el documento de MongoDB sin estos cambios. Las que
+        # tienen cambios posteriores en el stream se quedan, su entrada es la buena
+        CACHE_STATS[f"{nombre}:wb_failed"] += len(fallidos)
+        posteriores = {ObjectId(campos[b"id"].decode()) for _, campos in
+                       self._redis.xrange(self.stream, min=f"({mensajes[-1][0].decode()}", count=self.max_pending)}
+        releer = fallidos + [id for id in ids if id not in posteriores and id not in fallidos]
+        pipe = self._redis.pipeline(transaction=False)
+        if releer:
+            claves = [self.model._cache_key(id) for id in releer]
+            L1_CACHE.discard(*claves)
+            pipe.delete(*claves)
+            pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje(claves))
+        ids_stream = [id for id, _ in mensajes]
+        pipe.xack(self.stream, self.GRUPO, *ids_stream)
+        pipe.xdel(self.stream, *ids_stream)
+        pipe.execute()
+
+
+class CacheWatcher:
+    """
+    Mantiene la cache al dia con las escrituras que no pasan por Model
+    (otros servicios, migraciones, delete_all) siguiendo el change stream
+    de la base de datos en un hilo en segundo plano.
+
+    Los eventos se aplican en lotes de hasta batch_size o cada max_wait
+    segundos con un solo pipeline: los borrados dejan la marca de
+    inexistente y el resto borra la entrada (modo "invalidate") o la
+    sustituye por el documento actual (modo "refresh"). Tambien se invalida
+    la cache de consultas y la L1 de todos los procesos. Tras cada lote se
+    guarda el resume token en Redis para continuar desde ahi al reiniciar.
+
+    Los change streams necesitan un replica set; para probarlo en local
+    basta un nodo: mongod --replSet rs0 y rs.initiate().
+    """
+
+    MODOS = ("invalidate", "refresh")
+    # ChangeStreamHistoryLost y ChangeStreamFatalError: el token ya no sirve
+    _TOKEN_PERDIDO = (280, 286)
+
+    def __init__(self, db: pymongo.database.Database, models: list[type], modo: str = "invalidate",
+                 batch_size: int = CACHE_WATCH_BATCH, max_wait: float = CACHE_WATCH_WAIT, redis_client=None):
+        if modo not in self.MODOS:
+            raise ValueError(f"Modo de CacheWatcher desconocido: '{modo}'.")
+        self._db = db
+        self._modelos = {model._db.name: model for model in models}
+        self.modo = modo
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._redis = redis_client if redis_client is not None else redis_cache_client
+        self._clave_token = f"watcher:{db.name}:resume_token"
+        self._parar = threading.Event()
+        self._hilo: threading.Thread | None = None
+        self.eventos = 0
+        self.lotes = 0
+
+    def start(self) -> None:
+        if self._hilo is None:
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._bucle, name="cache-watcher", daemon=True)
+            self._hilo.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout)
+            self._hilo = None
+
+    def _abrir(self) -> Any:
+        pipeline = [{"$match": {"$or": [
+            {"ns.coll": {"$in": list(self._modelos)}},
+            {"operationType": {"$in": ["dropDatabase", "invalidate"]}},
+        ]}}]
+        opciones: dict[str, Any] = {"max_await_time_ms": int(self.max_wait * 1000)}
+        if self.modo == "refresh":
+            opciones["full_document"] = "updateLookup"
+        token = self._redis.get(self._clave_token)
+        if token:
+            opciones["resume_after"] = bson.decode(token)
+        return self._db.watch(pipeline, **opciones)
+
+    def _bucle(self) -> None:
+        while not self._parar.is_set():
+            try:
+                with self._abrir() as stream:
+                    lote: list[dict] = []
+                    inicio = 0.0
+                    while not self._parar.is_set() and stream.alive:
+                        evento = stream.try_next()
+                        if evento is not None:
+                            if not lote:
+                                inicio = time.monotonic()
+                            lote.append(evento)
+                        if lote and (len(lote) >= self.batch_size or time.monotonic() - inicio >= self.max_wait):
+                            self._aplicar(lote, stream.resume_token)
+                            lote = []
+                    if lote:
+                        self._aplicar(lote, stream.resume_token)
+            except pymongo.errors.OperationFailure as e:
+                if e.code not in self._TOKEN_PERDIDO:
+                    logger.warning("Error en el change stream de la cache: %s", e)
+                    self._parar.wait(1)
+                    continue
+                # Nos hemos perdido eventos: lo de la cache ya no es de fiar
+                logger.warning("Resume token caducado, se vacia la cache de los modelos vigilados")
+                self._redis.delete(self._clave_token)
+                for model in self._modelos.values():
+                    self._purgar(model)
+            except (pymongo.errors.PyMongoError, redis.exceptions.RedisError) as e:
+                logger.warning("Error en el change stream de la cache: %s", e)
+                self._parar.wait(1)
+
+    def _aplicar(self, lote: list[dict], token: Any) -> None:
+        # Tras un invalidate el stream se cierra y su token no vale para
+        # resume_after: se guarda sin token y se reabre desde ahora
+        if not self.procesar(lote) and token is not None:
+            self._redis.set(self._clave_token, bson.encode(token))
+
+    def procesar(self, eventos: list[dict]) -> bool:
+        """
+        Aplica a la cache un lote de eventos del change stream. Devuelve si
+        el lote invalida el stream (dropDatabase o invalidate).
+        """
+        pipe = self._redis.pipeline(transaction=False)
+        claves: list[str] = []
+        cambiados: set[type] = set()
+        invalidado = False
+
+        for evento in eventos:
+            tipo = evento["operationType"]
+            if tipo in ("dropDatabase", "invalidate"):
+                for model in self._modelos.values():
+                    self._purgar(model)
+                    cambiados.add(model)
+                self._redis.delete(self._clave_token)
+                invalidado = True
+                continue
+            model = self._modelos.get(evento.get("ns", {}).get("coll"))
+            if model is None:
+                continue
+            cambiados.add(model)
+            if tipo in ("drop", "rename"):
+                self._purgar(model)
+                continue
+            if not model._cache_enabled or "documentKey" not in evento:
+                continue
+
+            cache_key = model._cache_key(evento["documentKey"]["_id"])
+            claves.append(cache_key)
+            if tipo == "delete":
+                pipe.setex(cache_key, model._cache_negative_ttl, _NO_EXISTE)
+            elif self.modo == "refresh" and evento.get("fullDocument"):
+                model._poner_en_cache(pipe, cache_key, model._serializar(evento["fullDocument"]))
+            else:
+                pipe.delete(cache_key)
+
+        for model in cambiados:
+            pipe.incr(model._version_key())
+        if claves:
+            # Nuestra L1 a mano, el resto de procesos por el canal
+            L1_CACHE.discard(*claves)
+            pipe.publish(CacheL1.CANAL, L1_CACHE.mensaje(claves))
+        if len(pipe):
+            pipe.execute()
+        self.eventos += len(eventos)
+        self.lotes += 1
+        return invalidado
+
+    def _purgar(self, model: type) -> None:
+        """Borra todas las entradas cache de un modelo con SCAN, sin bloquear Redis."""
+        L1_CACHE.clear()
+        self._redis.publish(CacheL1.CANAL, L1_CACHE.mensaje([CacheL1.VACIAR]))
+        patron = f"{model._cache_prefix}:{model.__name__}:*"
+        claves = []
+        for clave in self._redis.scan_iter(match=patron, count=1000):
+            claves.append(clave)
+            if len(claves) >= 1000:
+                self._redis.delete(*claves)
+                claves = []
+        if claves:
+            self._redis.delete(*claves)
+
+
+def calentar_cache(model_class: type, top: int = 1000, rate: float = CACHE_WARMUP_RATE, batch_size: int = 100) -> int:
+    """
+    Precarga en la cache los top documentos mas leidos del modelo (segun
+    track_access), p.ej. tras un despliegue o una caida de Redis. Por cada
+    lote de batch_size ids se mira en un pipeline cuales faltan, se leen
+    con una consulta $in y se cachean con otro pipeline. Como mucho se
+    cargan rate documentos por segundo para no saturar MongoDB.
+
+    Parameters
+    ----------
+        model_class : type
+            modelo a precargar
+        top : int
+            numero de ids mas leidos a precargar
+        rate : float
+            documentos por segundo como maximo
+        batch_size : int
+            ids por consulta a MongoDB
+    Returns
+    -------
+        int
+            documentos cargados en la cache
+    """
+    if not model_class._cache_enabled:
+        return 0
+    ids = [id for id in ACCESOS.top(model_class, top) if ObjectId.is_valid(id)]
+    limitador = TokenBucket(rate=rate / batch_size)
+    cargados = 0
+
+    for i in range(0, len(ids), batch_size):
+        lote = ids[i:i + batch_size]
+        pipe = model_class._redis.pipeline(transaction=False)
+        for id in lote:
+            pipe.exists(model_class._cache_key(id))
+        faltan = [ObjectId(id) for id, existe in zip(lote, pipe.execute()) if not existe]
+        if not faltan:
+            continue
+
+        limitador.acquire()
+        pipe = model_class._redis.pipeline(transaction=False)
+        for doc in model_class._db.find({"_id": {"$in": faltan}}):
+            if model_class._poner_en_cache(pipe, model_class._cache_key(doc["_id"]), model_class._serializar(doc)):
+                cargados += 1
+        pipe.execute()
+
+    CACHE_STATS[f"{model_class.__name__}:warmup"] += cargados
+    return cargados
+
+
+# Vigilante creado por initApp si CACHE_WATCH esta activo
+CACHE_WATCHER: CacheWatcher | None = None
+
+
+def initApp(definitions_path: str = "./models.yml", db_name=None, mongodb_uri=None, scope=globals(), async_scope: dict | None = None) -> None:
+    """
+    Crea las clases de models.yml en scope. Si se pasa async_scope se crean
+    ademas sus versiones AsyncModel (mismo nombre) en ese diccionario, junto
+    con AsyncSesiones y AsyncHelpDesk sobre redis.asyncio.
+    """
    
     #TODO 
     # Establecer configuración inicial de la Base de Datos REDIS
     # hacer la conexion y checkear y si tiene una cookie de sesión
     
+    with open(definitions_path, 'r', encoding='utf-8') as file:
+        models_definitions = yaml.safe_load(file)
+
+    # La seccion redis no es un modelo: configuracion del servidor. Sin ella
+    # se mantiene la de siempre, con "redis: {}" no se toca nada
+    redis_def = models_definitions.pop("redis", {"maxmemory": "150mb", "maxmemory_policy": "volatile-ttl"}) or {}
+
     redis_cache = redis_client
     try:
-        redis_cache.config_set("maxmemory", "150mb")
-        redis_cache.config_set("maxmemory-policy", "volatile-ttl")
-        print("Config Redis aplicada (maxmemory + volatile-ttl)")
+        for opcion, valor in redis_def.items():
+            redis_cache.config_set(opcion.replace("_", "-"), valor)
+        if redis_def:
+            logger.info("Config Redis aplicada (%s)", ", ".join(f"{opcion}={valor}" for opcion, valor in redis_def.items()))
     except redis.exceptions.ResponseError as e:
         # Aquí estás en un Redis que no deja cambiar config en runtime
         print(" No se pudo aplicar config de Redis desde código:", e)
@@ -330,18 +3594,22 @@ def initApp(definitions_path: str = "./models.yml", db_name=None, mongodb_uri=No
     except Exception as e:
         print(e)
 
-    
-    with open(definitions_path, 'r', encoding='utf-8') as file:
-        models_definitions = yaml.safe_load(file)
+    async_db = None
+    if async_scope is not None:
+        # El cliente asincrono conecta de forma perezosa dentro del bucle de eventos
+        async_db = AsyncMongoClient(mongodb_uri, server_api = ServerApi('1'))[db_name]
+
+    modelos: list[type] = []
+
+    # La seccion geocoder no es un modelo, configura los backends (GEOCODER manda)
+    geocoder_def = models_definitions.pop("geocoder", None) or {}
+    backends = GEOCODER.split(",") if GEOCODER else geocoder_def.get("backends")
+    if backends:
+        configurar_geocoders([b.strip() for b in backends], GAZETTEER_PATH or geocoder_def.get("gazetteer_path"))
 
     
     for class_name, class_def in models_definitions.items():
         
-        new_cls = type(class_name, (Model,), {})
-        
-        scope[class_name] = new_cls
-
-        
         db_collection = db[class_name]
         
         required_vars   = set(class_def.get("required_vars", []))
@@ -361,6 +3629,11 @@ def initApp(definitions_path: str = "./models.yml", db_name=None, mongodb_uri=No
         if loc_field:
             admissible_vars.add(f"{loc_field}_loc")
 
+        new_cls = crear_modelo(class_name, Model, admissible_vars, loc_field)
+        
+        scope[class_name] = new_cls
+        modelos.append(new_cls)
+
         
         indexes = {
             "unique_indexes": class_def.get("unique_indexes", []) or [],
@@ -371,15 +3644,51 @@ def initApp(definitions_path: str = "./models.yml", db_name=None, mongodb_uri=No
         
         new_cls.init_class(
             db_collection=db_collection,
-            redis_client = redis_client,
+            redis_client = redis_cache_client,
             indexes=indexes,
             required_vars=required_vars,
-            admissible_vars=admissible_vars
+            admissible_vars=admissible_vars,
+            query_cache=class_def.get("query_cache"),
+            cache=class_def.get("cache"),
+            write_behind=class_def.get("write_behind")
         )
 
+        if async_db is not None:
+            async_cls = crear_modelo(class_name, AsyncModel, admissible_vars, loc_field)
+            async_scope[class_name] = async_cls
+            async_cls.init_class(
+                db_collection=async_db[class_name],
+                redis_client=async_redis_cache_client,
+                indexes=indexes,
+                required_vars=required_vars,
+                admissible_vars=admissible_vars,
+                cache=class_def.get("cache"),
+                modelo_sincrono=new_cls
+            )
+
+    if async_scope is not None:
+        AsyncSesiones.initRedis(async_redis_client, SESSION_TOKEN_CACHE_TTL, SESSION_TOKEN_CACHE_SIZE)
+        AsyncHelpDesk.initRedis(async_redis_client, HELPDESK_SHARDS, HELPDESK_AGING)
     
-    Sesiones.initRedis(redis_client)
-    HelpDesk.initRedis(redis_client)
+    Sesiones.initRedis(redis_client, SESSION_TOKEN_CACHE_TTL, SESSION_TOKEN_CACHE_SIZE)
+    HelpDesk.initRedis(redis_client, HELPDESK_SHARDS, HELPDESK_AGING)
+    CACHE.initRedis(redis_client)
+    L1_CACHE.initRedis(redis_client)
+    if GEOCODE_ASYNC:
+        GEOCODE_QUEUE.start()
+    if CACHE_WARMUP_TOP > 0:
+        # En segundo plano, para no retrasar el arranque
+        def calentar() -> None:
+            for model in modelos:
+                if model._track_access:
+                    calentar_cache(model, top=CACHE_WARMUP_TOP)
+        threading.Thread(target=calentar, name="calentar-cache", daemon=True).start()
+    if CACHE_WATCH:
+        global CACHE_WATCHER
+        if CACHE_WATCHER is not None:
+            CACHE_WATCHER.stop()
+        CACHE_WATCHER = CacheWatcher(db, modelos, modo=CACHE_WATCH)
+        CACHE_WATCHER.start()
 
 def generate_token():
         #math.random
@@ -472,9 +3781,10 @@ if __name__ == '__main__':
         else:
             print("token invalido")
     
-    # mostrar claves de sesiones
-    sesion_keys = redis_client.keys('sesiones:*')
-    print(f"claves de sesiones en redis: {len(sesion_keys)}\n")
+    # sesiones activas, sin recorrer el keyspace
+    print(f"sesiones activas de {usuario}: {Sesiones.sesiones_activas(usuario)}")
+    print(f"sesiones activas en total: {Sesiones.sesiones_activas()}")
+    print(f"sesiones cerradas al revocar a {usuario}: {Sesiones.revocar(usuario)}\n")
     
     #Test helpdesk
     # registrar peticiones
@@ -489,7 +3799,7 @@ if __name__ == '__main__':
     print(f"atendiendo 3: {HelpDesk.atender_usuario()} ")
     
     # verificar cola vacia
-    pendientes = redis_client.zcard("sesiones:helpdesk_queue")
+    pendientes = sum(shard["pendientes"] for shard in HelpDesk.estadisticas())
     print(f"peticiones pendientes: {pendientes}\n")
     
     #Test de cache miss por si falla la expiracion
@@ -528,8 +3838,8 @@ if __name__ == '__main__':
     p6.delete()
     print("persona eliminada de mongodb")
     
-    # verificar que se elimino de cache
-    print(f"en cache despues de delete: {bool(redis_client.exists(cache_key_p5))}")
+    # delete deja en la cache la marca de inexistente en lugar del documento
+    print(f"marcada como inexistente en cache: {redis_cache_client.get(cache_key_p5) == _NO_EXISTE}")
     
     # intentar buscar
     p7 = persona.find_by_id(id_p5)
@@ -542,25 +3852,17 @@ if __name__ == '__main__':
     print(f"total de claves en redis: {redis_client.dbsize()}")
     
     # cache
-    cache_keys = redis_client.keys('cache:*')
-    print(f"\nclaves de cache: {len(cache_keys)}")
-    for key in cache_keys:
-        ttl = redis_client.ttl(key)
+    print("\nclaves de cache:")
+    for key, tipo, ttl in escanear_claves(redis_client, 'cache:*'):
         print(f"  {key} (ttl: {ttl}s)")
     
     # sesiones
-    sesion_keys = redis_client.keys('sesiones:*')
-    print(f"\nclaves de sesiones: {len(sesion_keys)}")
-    for key in sesion_keys:
-        tipo = redis_client.type(key)
-        if tipo == 'string':
-            ttl = redis_client.ttl(key)
-            print(f"  {key} (ttl: {ttl}s)")
-        elif tipo == 'hash':
-            print(f"  {key} (hash)")
-        elif tipo == 'zset':
-            size = redis_client.zcard(key)
-            print(f"  {key} (zset, {size} items)")
+    print("\nclaves de sesiones:")
+    for key, tipo, ttl in escanear_claves(redis_client, '{sesiones}:*'):
+        if ttl >= 0:
+            print(f"  {key} ({tipo}, ttl: {ttl}s)")
+        else:
+            print(f"  {key} ({tipo})")
     
     print("\ntests completados")
     
@@ -1,10 +1,23 @@
+import os
+import time
+import json
+import datetime
+import asyncio
 import pytest
 from unittest.mock import patch, MagicMock
 from geojson import Point
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
 from geopy.exc import GeocoderTimedOut
 from pymongo import MongoClient
 from pymongo.server_api import ServerApi
-from ODM import initApp, getLocationPoint, ModelCursor
+from pymongo.errors import AutoReconnect
+from redis.crc import key_slot
+from sesiones import Sesiones
+from helpdesk import HelpDesk
+from importar import importar, leer_registros
+from ODM import initApp, getLocationPoint, ModelCursor, Model, AsyncModel, crear_modelo, _serializar_cache, _deserializar_cache, cache_stats, UnitOfWork, GeocodeCache, normalizar_direccion, GeocodeQueue, TokenBucket, GazetteerGeocoder, NominatimGeocoder, CacheL1, CacheWatcher, ACCESOS, calentar_cache, L1_CACHE
 
 # ─────────────────────────────────────────────────────────────
 # 🔧 Configuration Constants
@@ -126,11 +139,636 @@ def test_find_multiple_model_instances(db_scope):
     assert len(docs) == 10
     assert type(docs[0]) is User
 
+def test_find_with_projection_sort_and_limit(db_scope):
+    """Test projected, sorted and limited reads return partial models or raw dicts."""
+    User = db_scope["User"]
+    for i in range(5):
+        User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=18+i).save()
+    docs = list(User.find({}, projection=["name"], sort=[("age", -1)], limit=2))
+    assert [doc.name for doc in docs] == ["Paco4", "Paco3"]
+    assert "email" not in docs[0]._data
+    raw = list(User.find({"age": 18}, projection={"email": 1, "_id": 0}, raw=True))
+    assert raw == [{"email": "paco0@gmail.com"}]
+
+def test_find_cache_invalidated_by_writes(db_scope):
+    """Test cached find results are reused until any save of the model bumps the version."""
+    User = db_scope["User"]
+    for i in range(3):
+        User(name=f"Paco{i}", email="paco@gmail.com", age=18+i).save()
+    query = lambda: [doc.name for doc in User.find({"email": "paco@gmail.com", "age": {"$gte": 18}}, sort=[("age", -1)], cache=True)]
+    assert query() == ["Paco2", "Paco1", "Paco0"]
+    # Mismo filtro con los campos en otro orden, misma entrada
+    assert list(User.find({"age": {"$gte": 18}, "email": "paco@gmail.com"}, sort=[("age", -1)], cache=True))[0].name == "Paco2"
+    assert cache_stats(User)["query_hit"] >= 1
+    User(name="Paco3", email="paco@gmail.com", age=30).save()
+    assert query() == ["Paco3", "Paco2", "Paco1", "Paco0"]
+
+def test_projected_models_do_not_overwrite_cache(db_scope):
+    """Test saving a model read with a projection patches its cache entry instead of overwriting it and keeps it out of the identity map."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    with UnitOfWork():
+        parcial = next(iter(User.find({"name": "Paco"}, projection=["name"])))
+        completo = User.find_by_id(str(user._id))
+        assert completo is not parcial and completo.email == "paco@gmail.com"
+    parcial.name = "Paco2"
+    parcial.save()
+    cacheado = _deserializar_cache(User._redis.get(User._cache_key(user._id)))
+    assert cacheado["name"] == "Paco2" and cacheado["email"] == "paco@gmail.com"
+    L1_CACHE.clear()
+    found = User.find_by_id(str(user._id))
+    assert found.name == "Paco2" and found.email == "paco@gmail.com"
+
+def test_find_by_ids_keeps_order(db_scope):
+    """Test bulk lookup returns models in the requested order and None for missing ids."""
+    User = db_scope["User"]
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com", age=18+i) for i in range(3)]
+    for user in users:
+        user.save()
+    ids = [str(users[2]._id), "000000000000000000000000", str(users[0]._id)]
+    docs = User.find_by_ids(ids)
+    assert len(docs) == 3
+    assert docs[0].name == "Paco2"
+    assert docs[1] is None
+    assert docs[2].name == "Paco0"
+
+def test_save_many_reports_failures(db_scope):
+    """Test batch save inserts valid models and reports duplicates without aborting."""
+    User = db_scope["User"]
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com") for i in range(5)]
+    users.append(User(name="Paco0", email="duplicado@gmail.com"))
+    fallidos = User.save_many(users)
+    assert len(fallidos) == 1
+    assert fallidos[0][0] is users[-1]
+    assert "_id" not in users[-1]._data
+    assert get_collection().count_documents({}) == 5
+
+def test_delete_many_models(db_scope):
+    """Test batch deletion of saved models."""
+    User = db_scope["User"]
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com") for i in range(3)]
+    User.save_many(users)
+    assert User.delete_many_models(users) == []
+    assert get_collection().count_documents({}) == 0
+
+def test_unit_of_work_identity_and_flush(db_scope):
+    """Test the unit of work returns one instance per id and writes only at exit."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    with UnitOfWork():
+        first = User.find_by_id(str(user._id))
+        second = User.find_by_id(str(user._id))
+        assert first is second
+        first.age = 18
+        first.save()
+        assert get_collection().find_one({"_id": user._id}).get("age") is None
+    assert get_collection().find_one({"_id": user._id})["age"] == 18
+
+def test_find_by_id_serves_stale_while_other_reloads(db_scope):
+    """Test a caller that cannot take the reload lock gets the stale cached value."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    cache_key = User._cache_key(user._id)
+    get_collection().update_one({"_id": user._id}, {"$set": {"age": 18}})
+    User._redis.expire(cache_key, 1)
+    lock = User._redis.lock(f"lock:{cache_key}", timeout=5)
+    assert lock.acquire(blocking=False)
+    try:
+        found = User.find_by_id(str(user._id))
+    finally:
+        lock.release()
+    assert found.name == "Paco"
+    assert not hasattr(found, "age")
+    assert cache_stats(User)["stale"] >= 1
+    assert User.find_by_id(str(user._id)).age == 18
+
+def test_find_by_id_caches_missing_ids(db_scope):
+    """Test a missing or deleted id is answered from the cache without querying MongoDB again."""
+    User = db_scope["User"]
+    missing = "000000000000000000000000"
+    assert User.find_by_id(missing) is None
+    assert User.find_by_id(missing) is None
+    assert cache_stats(User)["negative_hit"] >= 1
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    user_id = str(user._id)
+    user.delete()
+    with patch.object(User._db, "find_one") as find_one:
+        assert User.find_by_id(user_id) is None
+        find_one.assert_not_called()
+
+def test_cache_policy_fixed_expiry_and_max_size(db_scope):
+    """Test a fixed-expiry policy does not renew TTLs and oversized documents skip Redis."""
+    User = db_scope["User"]
+    User._configurar_cache({"ttl": 600, "expiry": "fixed", "prefix": "test"})
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    cache_key = User._cache_key(user._id)
+    assert cache_key.startswith("test:User:")
+    User._redis.expire(cache_key, 300)
+    assert User.find_by_id(str(user._id)).name == "Paco"
+    assert User._redis.ttl(cache_key) <= 300
+    User._configurar_cache({"max_doc_size": 10, "prefix": "test"})
+    user.age = 18
+    user.save()
+    assert not User._redis.exists(cache_key)
+    assert User.find_by_id(str(user._id)).age == 18
+    User._configurar_cache(None)
+
+def test_cache_watcher_applies_change_events(db_scope):
+    """Test change events from other writers invalidate, refresh and mark deleted cache entries."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    cache_key = User._cache_key(user._id)
+    watcher = CacheWatcher(User._db.database, [User], redis_client=User._redis)
+    watcher.procesar([{"operationType": "update", "ns": {"coll": "User"}, "documentKey": {"_id": user._id}}])
+    assert not User._redis.exists(cache_key)
+    watcher.modo = "refresh"
+    watcher.procesar([{"operationType": "replace", "ns": {"coll": "User"}, "documentKey": {"_id": user._id},
+                       "fullDocument": {"_id": user._id, "name": "Pepe", "email": "paco@gmail.com"}}])
+    assert User.find_by_id(str(user._id)).name == "Pepe"
+    watcher.procesar([{"operationType": "delete", "ns": {"coll": "User"}, "documentKey": {"_id": user._id}}])
+    assert User.find_by_id(str(user._id)) is None
+    # El token de un invalidate no sirve para reanudar, no se guarda
+    watcher._aplicar([{"operationType": "invalidate"}], {"_data": "invalidate"})
+    assert not User._redis.exists(watcher._clave_token)
+    watcher._aplicar([{"operationType": "update", "ns": {"coll": "User"}, "documentKey": {"_id": user._id}}], {"_data": "siguiente"})
+    assert bson.decode(User._redis.get(watcher._clave_token)) == {"_data": "siguiente"}
+    User._redis.delete(watcher._clave_token)
+
+@pytest.mark.skipif(not os.getenv("MONGO_RS_URI"), reason="necesita un replica set (MONGO_RS_URI), p.ej. mongod --replSet rs0")
+def test_cache_watcher_follows_replica_set():
+    """Test the watcher invalidates entries written behind the ODM's back on a real replica set."""
+    scope = {}
+    initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=os.getenv("MONGO_RS_URI"), db_name=DB_NAME, scope=scope)
+    User = scope["User"]
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+    watcher = CacheWatcher(User._db.database, [User], max_wait=0.1, redis_client=User._redis)
+    watcher.start()
+    try:
+        time.sleep(1)
+        User._db.update_one({"_id": user._id}, {"$set": {"age": 18}})
+        for _ in range(50):
+            if not User._redis.exists(User._cache_key(user._id)):
+                break
+            time.sleep(0.1)
+        assert User.find_by_id(str(user._id)).age == 18
+    finally:
+        watcher.stop()
+        User._db.database.client.drop_database(DB_NAME)
+
+def test_write_behind_coalesces_until_flush(db_scope):
+    """Test write-behind updates are served from cache and reach MongoDB as one $set on flush."""
+    User = db_scope["User"]
+    User._configurar_write_behind({"enabled": True, "max_wait": 60})
+    try:
+        user = User(name="Paco", email="paco@gmail.com")
+        user.save()
+        for age in (18, 19, 20):
+            user.age = age
+            user.save()
+        assert User.find_by_id(str(user._id)).age == 20
+        User.flush()
+        assert get_collection().find_one({"_id": user._id})["age"] == 20
+        assert cache_stats(User)["wb_coalesced"] >= 2
+        # Una lectura con la entrada desalojada cachea MongoDB sin lo pendiente; el flush la quita
+        user.age = 21
+        user.save()
+        User._redis.delete(User._cache_key(user._id))
+        L1_CACHE.clear()
+        assert User.find_by_id(str(user._id)).age == 20
+        User.flush()
+        L1_CACHE.clear()
+        assert User.find_by_id(str(user._id)).age == 21
+    finally:
+        User._configurar_write_behind(None)
+    User._configurar_cache({"enabled": False})
+    with pytest.raises(ValueError):
+        User._configurar_write_behind({"enabled": True})
+    User._configurar_cache(None)
+
+def test_access_tracking_and_warm_up(db_scope):
+    """Test the most read ids are ranked first and warm-up reloads them into an empty cache."""
+    User = db_scope["User"]
+    User._configurar_cache({"track_access": True})
+    users = [User(name=f"Paco{i}", email=f"paco{i}@gmail.com") for i in range(3)]
+    for user in users:
+        user.save()
+    for i, user in enumerate(users):
+        for _ in range(i + 1):
+            User.find_by_id(str(user._id))
+    ACCESOS.flush()
+    assert ACCESOS.top(User, 2) == [str(users[2]._id), str(users[1]._id)]
+    User._redis.delete(*[User._cache_key(user._id) for user in users])
+    assert calentar_cache(User, top=2) == 2
+    assert User._redis.exists(User._cache_key(users[2]._id))
+    assert not User._redis.exists(User._cache_key(users[0]._id))
+    User._configurar_cache(None)
+
+def test_nested_changes_saved_in_place(db_scope):
+    """Test in-place changes to lists and subdocuments are saved and reach the cache."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", phones=["600"], jobs=[{"empresa": "Google", "fin": None}])
+    user.save()
+    user.phones.append("611")
+    user.jobs[0]["fin"] = "2024-01-31"
+    assert user._operaciones() == {"$push": {"phones": {"$each": ["611"]}}, "$set": {"jobs.0.fin": "2024-01-31"}}
+    user.save()
+    assert not user._pendiente()
+    doc = get_collection().find_one({"_id": user._id})
+    assert doc["phones"] == ["600", "611"]
+    assert doc["jobs"] == [{"empresa": "Google", "fin": "2024-01-31"}]
+    L1_CACHE.clear()
+    found = User.find_by_id(str(user._id))
+    assert found.phones == ["600", "611"] and found.jobs[0]["fin"] == "2024-01-31"
+
+def test_nested_changes_patch_the_cache_entry(db_scope):
+    """Test saving in-place changes appends a patch to the cache entry and rewrites it once patches outgrow it."""
+    User = db_scope["User"]
+    user = User(name="Paco", email="paco@gmail.com", phones=["600", "611"], jobs=[{"empresa": "Google", "fin": None}])
+    user.save()
+    cache_key = User._cache_key(user._id)
+    user.phones.remove("600")
+    user.jobs[0]["fin"] = "2024-01-31"
+    user.save()
+    assert User._redis.get(cache_key)[:1] == b"\x02"
+    L1_CACHE.clear()
+    found = User.find_by_id(str(user._id))
+    assert found.phones == ["611"] and found.jobs == [{"empresa": "Google", "fin": "2024-01-31"}]
+    for i in range(20):
+        user.phones.append(f"6{i:02}")
+        user.save()
+    assert cache_stats(User)["patch_rewrite"] >= 1
+    assert _deserializar_cache(User._redis.get(cache_key)) == get_collection().find_one({"_id": user._id})
+
+def test_bulk_import_rejects_and_resumes(db_scope, tmp_path):
+    """Test the import validates rows, reports rejected ones and resumes from its checkpoint."""
+    User = db_scope["User"]
+    fichero = tmp_path / "users.ndjson"
+    filas = [{"name": "Paco", "email": "paco@gmail.com"}, {"name": "Ana"}, {"name": "Eva", "email": "eva@gmail.com", "dni": "1"},
+             {"name": "Paco", "email": "otro@gmail.com"}, {"name": "Luis", "email": "luis@gmail.com", "phones": ["600"]}]
+    fichero.write_text("".join(json.dumps(fila) + "\n" for fila in filas[:4]) + "{roto\n")
+    checkpoint, rechazos = tmp_path / "checkpoint.json", tmp_path / "rechazos.ndjson"
+    resumen = importar(User, str(fichero), batch_size=2, geocodificar_direcciones=False,
+                       checkpoint=str(checkpoint), rechazos=str(rechazos), progreso=0)
+    assert (resumen["registros"], resumen["insertados"], resumen["rechazados"]) == (5, 1, 4)
+    assert [json.loads(linea)["registro"] for linea in rechazos.read_text().splitlines()] == [2, 3, 4, 5]
+    # Lo escrito tras el checkpoint por un proceso que se corto no se duplica al reanudar
+    with open(rechazos, "a") as f:
+        f.write(json.dumps({"registro": 6, "error": "a medias"}) + "\n")
+    with open(fichero, "a") as f:
+        f.write(json.dumps(filas[4]) + "\n")
+    resumen = importar(User, str(fichero), geocodificar_direcciones=False, checkpoint=str(checkpoint),
+                       reanudar=True, rechazos=str(rechazos), progreso=0)
+    assert (resumen["registros"], resumen["insertados"], resumen["rechazados"]) == (6, 2, 4)
+    assert len(rechazos.read_text().splitlines()) == 4
+    assert [user.phones for user in User.find({"name": "Luis"})] == [["600"]]
+    assert get_collection().count_documents({}) == 2
+
+def test_async_model_shares_cache(db_scope):
+    """Test async models read what sync models wrote and vice versa."""
+    User = db_scope["User"]
+    async_scope = {}
+    initApp(definitions_path=TEST_YML_FILE_PATH, mongodb_uri=MONGO_URI, db_name=DB_NAME, scope={}, async_scope=async_scope)
+    AsyncUser = async_scope["User"]
+    # Los accesos asincronos se vuelcan con el modelo sincrono
+    assert AsyncUser._modelo_sincrono.__name__ == "User"
+    user = User(name="Paco", email="paco@gmail.com")
+    user.save()
+
+    async def run():
+        found = await AsyncUser.find_by_id(str(user._id))
+        found.age = 18
+        await found.save()
+        return [doc.name async for doc in AsyncUser.find({})]
+
+    assert asyncio.run(run()) == ["Paco"]
+    assert User.find_by_id(str(user._id)).age == 18
+
+def test_session_login_scripts(db_scope):
+    """Test login and login_token run as scripts and the token cache survives an expired session."""
+    redis_client = Sesiones._redis
+    assert Sesiones("test_sesiones", "pw", "Test", 7).registrar()
+    token = ""
+    try:
+        activas = Sesiones.sesiones_activas()
+        assert Sesiones.login("test_sesiones", "otra") == -1
+        assert Sesiones.sesiones_activas() == activas
+        privilegios, token = Sesiones.login("test_sesiones", "pw")
+        assert Sesiones.sesiones_activas() == activas + 1
+        assert privilegios == 7
+        assert Sesiones.login_token(token) == 7
+        Sesiones.initRedis(redis_client, token_cache_ttl=60)
+        privilegios, token = Sesiones.login("test_sesiones", "pw")
+        redis_client.zrem(Sesiones._indice("test_sesiones"), token)
+        assert Sesiones.login_token(token) == 7
+    finally:
+        Sesiones.initRedis(redis_client)
+        Sesiones.revocar("test_sesiones")
+        redis_client.delete(Sesiones._clave_usuario("test_sesiones"))
+
+def test_session_index_and_revocation(db_scope):
+    """Test sessions are counted per user and revoked in bulk without scanning keys."""
+    for nombre in ("test_sesiones_a", "test_sesiones_b"):
+        Sesiones(nombre, "pw", "Test", 5).registrar()
+    try:
+        activas = Sesiones.sesiones_activas()
+        tokens = [Sesiones.login("test_sesiones_a", "pw")[1] for _ in range(2)]
+        Sesiones.login("test_sesiones_b", "pw")
+        assert len(tokens[0]) >= 32 and tokens[0] != tokens[1]
+        assert Sesiones.sesiones_activas("test_sesiones_a") == 2
+        assert Sesiones.logout(tokens[0])
+        assert Sesiones.login_token(tokens[0]) == -1
+        assert Sesiones.sesiones_activas("test_sesiones_a") == 1
+        assert Sesiones.revocar("test_sesiones_a", "test_sesiones_b") == 2
+        assert Sesiones.sesiones_activas() == activas
+        assert Sesiones.login_token(tokens[1]) == -1
+        assert Sesiones.sesiones_activas("test_sesiones_b") == 0
+    finally:
+        Sesiones.revocar("test_sesiones_a", "test_sesiones_b")
+        Sesiones._redis.delete(Sesiones._clave_usuario("test_sesiones_a"), Sesiones._clave_usuario("test_sesiones_b"))
+
+def test_session_keys_share_a_slot(db_scope):
+    """Test a user's session keys share a cluster slot and old user keys are migrated on login."""
+    assert len({key_slot(clave.encode()) for clave in Sesiones._claves_login("test_sesiones")}) == 1
+    redis_client = Sesiones._redis
+    redis_client.hset("sesiones:user:test_sesiones", mapping={"contrasenia": "pw", "privilegios": 3, "tokenSesion": "viejo"})
+    try:
+        assert Sesiones.login("test_sesiones", "otra") == -1
+        assert not redis_client.exists("sesiones:user:test_sesiones")
+        assert Sesiones.login_token("viejo") == -1
+        privilegios, token = Sesiones.login("test_sesiones", "pw")
+        assert privilegios == 3 and Sesiones._usuario_token(token) == "test_sesiones"
+        assert Sesiones.logout(token) and not Sesiones.logout(token)
+    finally:
+        Sesiones.revocar("test_sesiones")
+        redis_client.delete("sesiones:user:test_sesiones", Sesiones._clave_usuario("test_sesiones"))
+
+class HelpDeskTest(HelpDesk):
+    _prefijo = "test"
+    _cola = "test:helpdesk_queue"
+    _en_curso = "test:helpdesk_inflight"
+    _peticiones = "test:helpdesk_requests"
+    _desde = "test:helpdesk_since"
+    _suma = "test:helpdesk_since_sum"
+
+def test_helpdesk_claims_are_requeued_until_confirmed(db_scope):
+    """Test claimed requests stay in flight until confirmed and return to the queue when they expire."""
+    for usuario, prioridad in (("a", 5), ("b", 10), ("c", 3)):
+        HelpDeskTest.solicitar_ayuda(usuario, prioridad)
+    try:
+        assert HelpDeskTest.reclamar(2, visibilidad=0.2) == [("b", 10.0), ("a", 5.0)]
+        assert HelpDeskTest.confirmar("b") == 1
+        time.sleep(0.3)
+        assert HelpDeskTest.reclamar(5) == [("a", 5.0), ("c", 3.0)]
+        assert HelpDeskTest.confirmar("a", "c") == 2
+        assert HelpDeskTest.reclamar(5) == []
+    finally:
+        HelpDesk._redis.delete(*HelpDeskTest._claves(0))
+
+def test_helpdesk_shards_and_aging(db_scope):
+    """Test requests spread over shards are claimed from all of them and old requests overtake new ones."""
+    HelpDeskTest.initRedis(HelpDesk._redis, shards=4)
+    try:
+        for i in range(20):
+            HelpDeskTest.solicitar_ayuda(f"u{i}", i)
+        estadisticas = HelpDeskTest.estadisticas()
+        assert len(estadisticas) == 4 and sum(shard["pendientes"] for shard in estadisticas) == 20
+        assert all(shard["espera_max"] >= 0 for shard in estadisticas)
+        lote = HelpDeskTest.reclamar(8)
+        assert len(lote) == 8 and lote == sorted(lote, key=lambda reclamada: reclamada[1], reverse=True)
+        assert HelpDeskTest.confirmar(*[usuario for usuario, _ in lote]) == 8
+        assert len(HelpDeskTest.reclamar(100)) == 12
+
+        HelpDeskTest.initRedis(HelpDesk._redis, shards=2, envejecimiento=100.0)
+        HelpDeskTest.solicitar_ayuda("viejo", 1)
+        time.sleep(0.2)
+        HelpDeskTest.solicitar_ayuda("nuevo", 10)
+        assert [usuario for usuario, _ in HelpDeskTest.reclamar(2)] == ["viejo", "nuevo"]
+    finally:
+        HelpDesk._redis.delete(*[clave for shard in range(4) for clave in HelpDeskTest._claves(shard)])
+        HelpDeskTest.initRedis(HelpDesk._redis)
+
+def test_helpdesk_claims_find_skewed_shards(db_scope):
+    """Test claiming fewer requests than shards still finds work sitting in a single shard."""
+    HelpDeskTest.initRedis(HelpDesk._redis, shards=4)
+    try:
+        usuarios = [usuario for usuario in (f"u{i}" for i in range(200)) if HelpDeskTest._shard(usuario) == 3][:5]
+        for prioridad, usuario in enumerate(usuarios):
+            HelpDeskTest.solicitar_ayuda(usuario, prioridad)
+        for _ in range(2):
+            assert len(HelpDeskTest.reclamar(2)) == 2
+        assert HelpDeskTest.reclamar(1) == [(usuarios[0], 0.0)]
+        assert HelpDeskTest.reclamar(1) == []
+    finally:
+        HelpDesk._redis.delete(*[clave for shard in range(4) for clave in HelpDeskTest._claves(shard)])
+        HelpDeskTest.initRedis(HelpDesk._redis)
+
+def test_helpdesk_attends_sharded_queue_in_batches(db_scope):
+    """Test atender_usuario claims batches across shards and scripts survive a SCRIPT FLUSH."""
+    HelpDeskTest.initRedis(HelpDesk._redis, shards=4)
+    try:
+        for i in range(15):
+            HelpDeskTest.solicitar_ayuda(f"u{i}", i)
+        assert [HelpDeskTest.atender_usuario() for _ in range(3)] == ["u14", "u13", "u12"]
+        assert len(HelpDeskTest._reservadas) == HelpDeskTest._lote_atender - 3
+        HelpDesk._redis.script_flush()
+        assert sum(shard["en_curso"] for shard in HelpDeskTest.estadisticas()) == HelpDeskTest._lote_atender - 3
+    finally:
+        HelpDesk._redis.delete(*[clave for shard in range(4) for clave in HelpDeskTest._claves(shard)])
+        HelpDeskTest.initRedis(HelpDesk._redis)
+
+def test_helpdesk_single_shard_is_tagged_and_migrates_old_keys(db_scope):
+    """Test one shard still uses hash-tagged keys and requests left in the old keys are moved there."""
+    assert len({key_slot(clave.encode()) for clave in HelpDeskTest._claves(0)}) == 1
+    redis_client = HelpDesk._redis
+    redis_client.zadd(HelpDeskTest._cola, {"a": 5})
+    redis_client.zadd(HelpDeskTest._en_curso, {"b": 0})
+    redis_client.hset(HelpDeskTest._peticiones, mapping={"b": "8 0"})
+    try:
+        HelpDeskTest.initRedis(redis_client)
+        assert not any(redis_client.exists(clave) for clave in HelpDeskTest._claves_antiguas())
+        assert HelpDeskTest.reclamar(5) == [("b", 8.0), ("a", 5.0)]
+        assert HelpDeskTest.migrar_cola() == 0
+    finally:
+        redis_client.delete(*HelpDeskTest._claves(0), *HelpDeskTest._claves_antiguas())
+
+def test_compiled_model_tracks_changes():
+    """Generated slot-based classes keep the _data / _modified_vars API."""
+    Item = crear_modelo("Item", Model, {"_id", "name", "age"})
+    Item._required_vars = {"name"}
+    Item._admissible_vars = {"_id", "name", "age"}
+    item = Item(name="Paco")
+    assert not hasattr(item, "__dict__")
+    assert dict(item._data) == {"name": "Paco"}
+    assert set(item._modified_vars) == set()
+    item.age = 18
+    assert item.age == 18
+    assert set(item._modified_vars) == {"age"}
+    assert item._update_doc() == {"age": 18}
+    with pytest.raises(AttributeError):
+        item.unknown = 1
+    with pytest.raises(ValueError):
+        Item(name="Paco", unknown=1)
+
+def test_lazy_hydration_decodes_on_access():
+    """Lazy models keep the raw BSON and decode each field on first access."""
+    Item = crear_modelo("Item", Model, {"_id", "name", "jobs"})
+    raw = RawBSONDocument(bson.encode({"_id": 1, "name": "Paco", "jobs": [{"nombre": "Google"}], "extra": True}))
+    item = Item._hidratar_lazy(raw)
+    assert item._id == 1
+    assert item._raw is not None
+    assert item.jobs == [{"nombre": "Google"}]
+    # Decodificado a dict; al leerlo por el atributo llega observado
+    assert type(Item._hidratar_lazy(raw)._data["jobs"][0]) is dict
+    assert isinstance(item.jobs[0], dict)
+    assert dict(item._data) == {"_id": 1, "name": "Paco", "jobs": [{"nombre": "Google"}]}
+    assert item._raw is None
+
+def test_nested_changes_build_minimal_updates():
+    """Nested changes become path operators, and conflicting ones fall back to the whole field."""
+    Item = crear_modelo("Item", Model, {"_id", "phones", "jobs"})
+    item = Item._hidratar({"_id": 1, "phones": ["600", "611"], "jobs": [{"empresa": "A"}, {"empresa": "B"}]})
+    item.phones.remove("600")
+    del item.jobs[1]["empresa"]
+    assert item._operaciones() == {"$pull": {"phones": "600"}, "$unset": {"jobs.1.empresa": ""}}
+    item._modified_vars.clear()
+    job = item.jobs[1]
+    item.jobs.insert(0, {"empresa": "C"})
+    job["fin"] = "2024"
+    assert item._operaciones() == {"$set": {"jobs": [{"empresa": "C"}, {"empresa": "A"}, {"fin": "2024"}]}}
+    item._modified_vars.clear()
+    job["cargo"] = "CTO"
+    assert item._operaciones() == {"$set": {"jobs.2.cargo": "CTO"}}
+    item._modified_vars.clear()
+    phones = item.phones
+    item.phones = []
+    item._modified_vars.clear()
+    phones.append("622")
+    assert item._operaciones() == {}
+
+def test_nested_changes_dropped_when_field_is_assigned():
+    """Assigning a field after changing it in place saves only the new value."""
+    Item = crear_modelo("Item", Model, {"_id", "phones", "jobs"})
+    item = Item._hidratar({"_id": 1, "phones": ["600"], "jobs": [{"a": 1}]})
+    item.phones.append("611")
+    item.phones = ["700"]
+    item.jobs[0]["a"] = 2
+    item.jobs = []
+    assert item._operaciones() == {"$set": {"phones": ["700"], "jobs": []}}
+    assert item._update_doc(anidados=True) == {"phones": ["700"], "jobs": []}
+
+def test_import_readers_stream_records(tmp_path):
+    """Test the CSV and JSON readers yield one document per record."""
+    csv_file = tmp_path / "users.csv"
+    csv_file.write_text('name,email,phones\nPaco,paco@gmail.com,"[""600""]"\nAna,,\n')
+    with open(csv_file, newline="") as f:
+        assert list(leer_registros(f, "csv")) == [(1, {"name": "Paco", "email": "paco@gmail.com", "phones": ["600"]}), (2, {"name": "Ana"})]
+    json_file = tmp_path / "users.json"
+    json_file.write_text(json.dumps([{"name": f"Paco{i}", "bio": "x" * 5000} for i in range(100)]))
+    with open(json_file) as f:
+        registros = list(leer_registros(f, "json", saltar=98))
+    assert [(numero, doc["name"]) for numero, doc in registros] == [(99, "Paco98"), (100, "Paco99")]
+    # Un elemento mal formado para la lectura en el, sin cargar el resto del fichero
+    json_file.write_text('[{"name": "Paco"}, {"name": Paco2}, ' + ", ".join(['{"bio": "' + "x" * 5000 + '"}'] * 100) + "]")
+    with open(json_file) as f, pytest.raises(ValueError, match="caracter 28"):
+        list(leer_registros(f, "json"))
+
+def test_save_many_forgets_ids_when_bulk_write_fails():
+    """Test new models get their _id removed again when the bulk write fails without a write-error report."""
+    Item = crear_modelo("Item", Model, {"_id", "name"})
+    Item._required_vars = set()
+    Item._db = MagicMock()
+    Item._db.bulk_write.side_effect = AutoReconnect("connection reset")
+    nuevo, existente = Item(name="nuevo"), Item._hidratar({"_id": ObjectId(), "name": "viejo"})
+    existente.name = "otro"
+    with pytest.raises(AutoReconnect):
+        Model.save_many([nuevo, existente])
+    assert "_id" not in nuevo._data and "_id" in existente._data
+    assert existente._pendiente()
+
+def test_async_models_reject_bulk_writes_and_geocode_off_the_loop():
+    """Test async models refuse the sync bulk operations and leave the geocoding cache to the queue thread."""
+    Item = crear_modelo("AsyncItem", AsyncModel, {"_id", "address", "address_loc"}, "address")
+    Item._required_vars = set()
+    Item._location_var = "address"
+    item = Item._hidratar({"_id": ObjectId()})
+    with pytest.raises(TypeError):
+        Model.save_many([item])
+    with pytest.raises(TypeError):
+        Item.delete_many_models([item])
+    with patch("ODM.CACHE") as cache, patch("ODM.getLocationPoint", return_value=Point((-3.7, 40.4))):
+        item.address = "Calle de Prueba Asincrona 1, Madrid"
+        cache.get.assert_not_called()
+        asyncio.run(item._esperar_geocodificacion_async())
+    assert item.address_loc == Point((-3.7, 40.4))
+
+def test_short_cache_ttl_shrinks_stale_window():
+    """A per-model ttl inside the stale window shrinks the window instead of making every hit stale."""
+    Item = crear_modelo("Item", Model, {"_id", "name"})
+    Item._configurar_cache({"ttl": 30})
+    assert Item._cache_stale == 15
+    assert not Item._debe_refrescar(25_000) and Item._debe_refrescar(10_000)
+    with pytest.raises(ValueError):
+        Item._configurar_cache({"ttl": 0})
+
+def test_unresolved_address_unsets_old_coordinates():
+    """Changing the address to one that cannot be geocoded removes the stored coordinates."""
+    Item = crear_modelo("Item", Model, {"_id", "address", "address_loc"}, "address")
+    Item._location_var = "address"
+    item = Item._hidratar({"_id": 1, "address": "Calle Gran Via 1, Madrid", "address_loc": Point((-3.7, 40.4))})
+    with patch("ODM.getLocationPoint", return_value=None), patch("ODM.CACHE.get", return_value=(True, None)):
+        item.address = "Calle que no existe 99"
+        item._esperar_geocodificacion()
+    assert item._operaciones() == {"$set": {"address": "Calle que no existe 99"}, "$unset": {"address_loc": ""}}
+
+def test_cache_serialization_roundtrip():
+    """Cache entries keep BSON types, compress large payloads and still read old JSON."""
+    doc = {"_id": ObjectId(), "name": "Paco", "born": datetime.datetime(2000, 1, 1), "bio": "x" * 4096}
+    data = _serializar_cache(doc)
+    assert data[:3] == b"\x01bz"
+    assert len(data) < 1024
+    assert _deserializar_cache(data) == doc
+    small = {"_id": doc["_id"], "name": "Paco"}
+    assert _deserializar_cache(_serializar_cache(small)) == small
+    legacy = json.dumps({"_id": str(doc["_id"]), "name": "Paco"})
+    assert _deserializar_cache(legacy) == small
+    # En JSON tambien sobreviven los ObjectId y fechas fuera del _id
+    query = {"_id": "consulta", "ids": [ObjectId(), ObjectId()], "born": doc["born"]}
+    assert _deserializar_cache(_serializar_cache(query, "json")) == query
+    assert _deserializar_cache(_serializar_cache(doc, "json")) == doc
+
+def test_cache_l1_bounds_and_invalidation():
+    """The local cache is bounded by entries and bytes and drops keys published by other processes."""
+    l1 = CacheL1(maxsize=2, maxbytes=100, ttl=60)
+    l1.set("a", b"1", l1.marca())
+    l1.set("b", b"2", l1.marca())
+    l1.set("c", b"3", l1.marca())
+    assert l1.get("a") is None and l1.get("c") == b"3"
+    l1.actualizar("big", b"x" * 200)
+    assert l1.get("big") is None
+    # Una lectura que empezo antes de una invalidacion no se guarda
+    marca = l1.marca()
+    l1._invalidar("otro-proceso c")
+    l1.set("c", b"viejo", marca)
+    assert l1.get("c") is None
+    # Nuestras propias publicaciones se ignoran
+    l1.actualizar("b", b"nuevo")
+    l1._invalidar(l1.mensaje(["b"]))
+    assert l1.get("b") == b"nuevo"
+    l1._invalidar("otro-proceso " + CacheL1.VACIAR)
+    assert len(l1) == 0
+
 # ─────────────────────────────────────────────────────────────
 # 🌍 Geolocation Tests
 # ─────────────────────────────────────────────────────────────
 
-@patch("ODM.Nominatim")
+@patch("ODM._get_geocoder")
 def test_get_location_point_success(mock_nominatim):
     mock_geolocator = MagicMock()
     mock_geolocator.geocode.return_value = MagicMock(latitude=40.7128, longitude=-74.0060)
@@ -140,7 +778,7 @@ def test_get_location_point_success(mock_nominatim):
     assert isinstance(result, Point)
     assert result.coordinates == [-74.0060, 40.7128]
 
-@patch("ODM.Nominatim")
+@patch("ODM._get_geocoder")
 def test_get_location_point_timeout_recovery(mock_nominatim):
     """Test geolocation with a recoverable timeout."""
     mock_geolocator = MagicMock()
@@ -151,7 +789,7 @@ def test_get_location_point_timeout_recovery(mock_nominatim):
     assert isinstance(result, Point)
     assert result.coordinates == [2.3522, 48.8566]
 
-@patch("ODM.Nominatim")
+@patch("ODM._get_geocoder")
 def test_get_location_point_timeout_failure(mock_nominatim):
     """Test geolocation with repeated timeouts leading to failure."""
     mock_geolocator = MagicMock()
@@ -159,4 +797,83 @@ def test_get_location_point_timeout_failure(mock_nominatim):
     mock_nominatim.return_value = mock_geolocator
 
     with pytest.raises(ValueError, match="No se pudieron obtener coordenadas"):
-        getLocationPoint("Dirección que falla")
\ No newline at end of file
+        getLocationPoint("Dirección que falla")
+
+@patch("ODM._get_geocoder")
+def test_get_location_point_not_found_is_cached(mock_nominatim):
+    """Test an address the geocoder cannot find returns None and is not asked again."""
+    mock_geolocator = MagicMock()
+    mock_geolocator.geocode.return_value = None
+    mock_nominatim.return_value = mock_geolocator
+
+    assert getLocationPoint("Calle que no existe 99") is None
+    assert getLocationPoint("calle que no existe 99") is None
+    assert mock_geolocator.geocode.call_count == 1
+
+def test_normalizar_direccion():
+    """Equivalent spellings of an address share the same cache key."""
+    assert normalizar_direccion("C/ Gran Vía 12,Madrid") == normalizar_direccion("calle gran via 12, madrid")
+    assert normalizar_direccion("  Avda.  América  ") == "avenida america"
+
+def test_geocode_cache_is_bounded():
+    """The in-process geocode cache evicts the least recently used entries."""
+    cache = GeocodeCache(maxsize=2)
+    cache.set("a", Point((1, 1)))
+    cache.set("b", Point((2, 2)))
+    cache.get("a")
+    cache.set("c", Point((3, 3)))
+    assert "a" in cache
+    assert "b" not in cache
+    assert len(cache) == 2
+    # Las comprobaciones con "in" no cuentan en las estadisticas
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 0
+
+def test_token_bucket_limits_rate():
+    """The token bucket spaces calls according to its rate."""
+    bucket = TokenBucket(rate=20, capacity=1)
+    inicio = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - inicio >= 0.19
+
+@patch("ODM._get_geocoder")
+def test_geocode_queue_deduplicates(mock_nominatim):
+    """Repeated addresses in the background queue are geocoded only once."""
+    mock_geolocator = MagicMock()
+    mock_geolocator.geocode.return_value = MagicMock(latitude=40.4168, longitude=-3.7038)
+    mock_nominatim.return_value = mock_geolocator
+
+    cola = GeocodeQueue()
+    futures = [cola.submit("Puerta del Sol 1, Madrid") for _ in range(10)]
+    assert cola.wait(timeout=30)
+    assert all(future.result().coordinates == [-3.7038, 40.4168] for future in futures)
+    assert mock_geolocator.geocode.call_count == 1
+
+def test_gazetteer_geocoder(tmp_path):
+    """The offline gazetteer resolves exact, street prefix and postal code lookups."""
+    callejero = tmp_path / "callejero.csv"
+    callejero.write_text(
+        "direccion,codigo_postal,localidad,lon,lat\n"
+        "Calle Gran Via,,Madrid,-3.7058,40.4203\n"
+        "Calle Alcala 50,,,-3.6950,40.4189\n"
+        "Calle Mayor,28013,,-3.7090,40.4155\n"
+        ",08001,,2.1700,41.3800\n",
+        encoding="utf-8",
+    )
+    gazetteer = GazetteerGeocoder(str(callejero))
+    assert gazetteer.geocode("calle alcalá 50").coordinates == [-3.6950, 40.4189]
+    assert gazetteer.geocode("C/ Gran Vía 12, Madrid, 28013").coordinates == [-3.7058, 40.4203]
+    assert gazetteer.geocode("Carrer de Pelai 1, 08001 Barcelona").coordinates == [2.1700, 41.3800]
+    assert gazetteer.geocode("Plaza Mayor, Salamanca") is None
+    # Un prefijo de calle sin su codigo postal ni su localidad no vale
+    assert gazetteer.geocode("Calle Mayor 1, 28013 Madrid").coordinates == [-3.7090, 40.4155]
+    assert gazetteer.geocode("Calle Mayor 1, Salamanca") is None
+
+@patch("ODM._get_geocoder")
+def test_gazetteer_before_nominatim(mock_nominatim, tmp_path):
+    """Addresses found in the gazetteer never reach Nominatim."""
+    callejero = tmp_path / "callejero.csv"
+    callejero.write_text("direccion,codigo_postal,lon,lat\nCalle Mayor 1,,-3.70,40.41\n", encoding="utf-8")
+    with patch("ODM.GEOCODERS", [GazetteerGeocoder(str(callejero)), NominatimGeocoder()]):
+        assert getLocationPoint("Calle Mayor 1").coordinates == [-3.70, 40.41]
+    mock_nominatim.return_value.geocode.assert_not_called()
@@ -0,0 +1,151 @@
+"""
+Micro-benchmarks del ODM. No necesitan MongoDB ni Redis.
+
+    python benchmark.py            # todos
+    python benchmark.py modelos    # solo acceso a atributos y memoria
+    python benchmark.py hidratacion
+    python benchmark.py serializacion
+"""
+
+import sys
+import timeit
+import tracemalloc
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from ODM import Model, crear_modelo, _serializar_cache, _deserializar_cache
+
+PERSONA = {
+    "nombre": "Lucia Alonso",
+    "dni": "00000001C",
+    "mail": "lucia.alonso@example.com",
+    "universidad": [{"codigo": "UPM01", "nombre": "UPM", "titulo": "Grado en Ingenieria Informatica", "fecha_fin": "2018-06-30"}],
+    "telefono": "+34 611 111 111",
+    "contactos_emergencia": ["+34 691 111 111"],
+    "empresa": [{"nombre": "Google", "cargo": "Data Scientist", "fecha_inicio": "2021-02-01", "fecha_fin": None, "ciudad": "Madrid"}],
+    "descripcion": "Cientifica de datos en Google",
+}
+REQUIRED = {"nombre", "dni", "mail", "universidad"}
+ADMISSIBLE = set(PERSONA) | {"_id", "direccion", "direccion_loc"}
+
+
+class ModeloDict:
+    """Modelo con la implementacion anterior: _data, _modified_vars y __getattr__/__setattr__."""
+
+    _required_vars = REQUIRED
+    _admissible_vars = ADMISSIBLE
+    _location_var = "direccion"
+
+    def __init__(self, **kwargs):
+        super().__setattr__("_data", {})
+        super().__setattr__("_modified_vars", set())
+        for campo_requerido in self._required_vars:
+            if campo_requerido not in kwargs:
+                raise ValueError(campo_requerido)
+        for atributo in kwargs:
+            if atributo not in self._admissible_vars:
+                raise ValueError(atributo)
+        self._data.update(kwargs)
+
+    def __setattr__(self, name, value):
+        if name in {'_modified_vars', '_required_vars', '_admissible_vars', '_db', '_location_var', '_data'}:
+            super().__setattr__(name, value)
+            return
+        if name not in self._admissible_vars:
+            raise AttributeError(name)
+        self._data[name] = value
+        self._modified_vars.add(name)
+
+    def __getattr__(self, name):
+        if name in {'_modified_vars', '_required_vars', '_admissible_vars', '_db', '_data', '_location_var'}:
+            return super().__getattribute__(name)
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError
+
+
+def _memoria_por_instancia(cls, n: int = 10000) -> float:
+    tracemalloc.start()
+    antes = tracemalloc.take_snapshot()
+    # Los valores se comparten para medir solo el coste de la instancia
+    instancias = [cls(**PERSONA) for _ in range(n)]
+    despues = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in despues.compare_to(antes, "filename"))
+    del instancias
+    return (total - 8 * n) / n  # sin contar la lista
+
+
+def bench_modelos(repeticiones: int = 1_000_000) -> None:
+    Compacto = _persona_compacta()
+
+    print(f"{'':12}{'get (ns)':>10}{'set (ns)':>10}{'init (us)':>11}{'bytes/inst':>12}")
+    for nombre, cls in (("dict", ModeloDict), ("slots", Compacto)):
+        p = cls(**PERSONA)
+        get = timeit.timeit("p.telefono", globals={"p": p}, number=repeticiones) / repeticiones * 1e9
+        set_ = timeit.timeit("p.telefono = '+34 622 222 222'", globals={"p": p}, number=repeticiones) / repeticiones * 1e9
+        init = timeit.timeit("cls(**PERSONA)", globals={"cls": cls, "PERSONA": PERSONA}, number=repeticiones // 10) / (repeticiones // 10) * 1e6
+        print(f"{nombre:12}{get:>10.1f}{set_:>10.1f}{init:>11.2f}{_memoria_por_instancia(cls):>12.0f}")
+
+
+def _persona_compacta() -> type:
+    cls = crear_modelo("persona", Model, ADMISSIBLE, "direccion")
+    cls._required_vars = REQUIRED
+    cls._admissible_vars = ADMISSIBLE
+    cls._location_var = "direccion"
+    return cls
+
+
+def bench_hidratacion(repeticiones: int = 100_000) -> None:
+    Persona = _persona_compacta()
+    # Como en MongoDB, _id va primero; una persona con un historial largo
+    doc = {"_id": bson.ObjectId(), **PERSONA, "empresa": PERSONA["empresa"] * 20}
+    datos = bson.encode(doc)
+
+    casos = {
+        "cls(**doc)": lambda: Persona(**doc),
+        "_hidratar": lambda: Persona._hidratar(doc),
+        "decode + _hidratar": lambda: Persona._hidratar(bson.decode(datos)).nombre,
+        "raw + lazy": lambda: Persona._hidratar_lazy(RawBSONDocument(datos)).nombre,
+    }
+    print(f"{'':22}{'us/doc':>8}")
+    for nombre, caso in casos.items():
+        tiempo = timeit.timeit(caso, number=repeticiones) / repeticiones * 1e6
+        print(f"{nombre:22}{tiempo:>8.2f}")
+
+
+def bench_serializacion(repeticiones: int = 20_000) -> None:
+    """
+    Coste de codificar y decodificar una persona para la cache y tamaño del
+    valor guardado en Redis (la memoria real añade la cabecera de la clave).
+    """
+    corta = {"_id": bson.ObjectId(), **PERSONA}
+    larga = {**corta, "empresa": PERSONA["empresa"] * 20}
+    formatos = {
+        "json": {"serializer": "json", "umbral": 1 << 30},
+        "bson": {"serializer": "bson", "umbral": 1 << 30},
+        "bson + zlib": {"serializer": "bson", "umbral": 0},
+    }
+
+    print(f"{'':32}{'enc (us)':>10}{'dec (us)':>10}{'bytes':>8}")
+    for nombre_doc, doc in (("persona", corta), ("persona 20 empresas", larga)):
+        for nombre, opciones in formatos.items():
+            datos = _serializar_cache(doc, **opciones)
+            enc = timeit.timeit(lambda: _serializar_cache(doc, **opciones), number=repeticiones) / repeticiones * 1e6
+            dec = timeit.timeit(lambda: _deserializar_cache(datos), number=repeticiones) / repeticiones * 1e6
+            print(f"{nombre_doc + ' ' + nombre:32}{enc:>10.2f}{dec:>10.2f}{len(datos):>8}")
+
+
+BENCHMARKS = {
+    "modelos": bench_modelos,
+    "hidratacion": bench_hidratacion,
+    "serializacion": bench_serializacion,
+}
+
+
+if __name__ == "__main__":
+    for nombre in sys.argv[1:] or BENCHMARKS:
+        print(f"== {nombre}")
+        BENCHMARKS[nombre]()
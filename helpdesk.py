@@ -1,46 +1,637 @@
+import asyncio
+import collections
+import itertools
+import logging
+import threading
+import time
+import zlib
 import redis
 
+logger = logging.getLogger(__name__)
+
+# Cada shard de la cola de ayuda son cinco claves con el mismo hash tag
+# (<prefijo>:{helpdesk:<shard>}:..., tambien con un solo shard), asi que en
+# Redis Cluster caen en el mismo slot y los scripts pueden usarlas juntas:
+#   cola       zset usuario -> prioridad efectiva
+#   en curso   zset usuario -> plazo para confirmar (ms)
+#   peticiones hash usuario -> "prioridad desde", de las pendientes y en curso
+#   desde      zset usuario -> cuando pidio ayuda, solo las pendientes
+#   suma       suma de los "desde" de las pendientes, para la espera media
+# Los tiempos son ms desde 2024-01-01 segun el reloj de Redis (TIME), el mismo
+# para todos los procesos. Con envejecimiento la prioridad efectiva es
+# prioridad + envejecimiento * segundos esperando; como el segundo termino
+# crece igual para todas, en la cola basta guardar prioridad - envejecimiento * desde.
+_LUA_AHORA = """
+local reloj = redis.call('TIME')
+local ahora = (tonumber(reloj[1]) - 1704067200) * 1000 + math.floor(tonumber(reloj[2]) / 1000)
+local function efectiva(prioridad, desde)
+    return prioridad - tonumber(ARGV[#ARGV]) * desde / 1000
+end
+local function leer(usuario, defecto)
+    local peticion = redis.call('HGET', KEYS[3], usuario)
+    if not peticion then
+        return defecto, ahora
+    end
+    local prioridad, desde = string.match(peticion, '(%S+) (%S+)')
+    return tonumber(prioridad), tonumber(desde)
+end
+local function encolar(usuario, prioridad, desde)
+    redis.call('ZADD', KEYS[1], efectiva(prioridad, desde), usuario)
+    if redis.call('ZADD', KEYS[4], 'NX', desde, usuario) == 1 then
+        redis.call('INCRBY', KEYS[5], desde)
+    end
+end
+local function desencolar(usuario)
+    local desde = redis.call('ZSCORE', KEYS[4], usuario)
+    if desde then
+        redis.call('ZREM', KEYS[4], usuario)
+        if redis.call('DECRBY', KEYS[5], desde) == 0 then
+            redis.call('DEL', KEYS[5])
+        end
+    end
+end
+"""
+
+# Nueva peticion. Si el usuario ya tenia una se queda la prioridad mayor y la
+# espera de la primera. ARGV: usuario, prioridad, envejecimiento
+_LUA_SOLICITAR = _LUA_AHORA + """
+local prioridad, desde = leer(ARGV[1], tonumber(ARGV[2]))
+prioridad = math.max(prioridad, tonumber(ARGV[2]))
+redis.call('HSET', KEYS[3], ARGV[1], prioridad .. ' ' .. desde)
+encolar(ARGV[1], prioridad, desde)
+return 1
+"""
+
+# Reclama hasta ARGV[1] peticiones: las pasa de la cola a en curso con su
+# plazo (ahora + ARGV[2] ms). Antes devuelve a la cola, con su espera
+# original, hasta ARGV[3] reclamadas cuyo plazo ha vencido (su trabajador
+# murio o no confirmo a tiempo).
+# ARGV: n, visibilidad, max vencidas, envejecimiento.
+# Devuelve {usuario, prioridad, prioridad efectiva, ...}
+_LUA_RECLAMAR = _LUA_AHORA + """
+local vencidas = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ahora, 'LIMIT', 0, tonumber(ARGV[3]))
+for _, usuario in ipairs(vencidas) do
+    redis.call('ZREM', KEYS[2], usuario)
+    if not redis.call('ZSCORE', KEYS[1], usuario) then
+        local prioridad, desde = leer(usuario, 0)
+        encolar(usuario, prioridad, desde)
+    end
+end
+local n = tonumber(ARGV[1])
+if n == 0 then
+    return {}
+end
+local sacadas = redis.call('ZPOPMAX', KEYS[1], n)
+local plazo = ahora + tonumber(ARGV[2])
+local reclamadas = {}
+for i = 1, #sacadas, 2 do
+    local usuario = sacadas[i]
+    local prioridad = leer(usuario, tonumber(sacadas[i + 1]))
+    redis.call('ZADD', KEYS[2], plazo, usuario)
+    desencolar(usuario)
+    table.insert(reclamadas, usuario)
+    table.insert(reclamadas, tostring(prioridad))
+    -- Efectiva en el momento de reclamar, comparable entre shards
+    table.insert(reclamadas, tostring(sacadas[i + 1] + tonumber(ARGV[#ARGV]) * ahora / 1000))
+end
+return reclamadas
+"""
+
+# Confirma peticiones en curso. ARGV: usuarios..., envejecimiento
+_LUA_CONFIRMAR = _LUA_AHORA + """
+local confirmadas = 0
+for i = 1, #ARGV - 1 do
+    if redis.call('ZREM', KEYS[2], ARGV[i]) == 1 then
+        confirmadas = confirmadas + 1
+        -- Si ha vuelto a pedir ayuda mientras tanto sigue haciendo falta
+        if not redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+            redis.call('HDEL', KEYS[3], ARGV[i])
+        end
+    end
+end
+return confirmadas
+"""
+
+# Limpia lo que sabemos de una peticion sacada con BZPOPMAX. ARGV: usuario, envejecimiento
+_LUA_OLVIDAR = _LUA_AHORA + """
+desencolar(ARGV[1])
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+# Amplia el plazo de peticiones en curso. ARGV: ms, usuarios..., envejecimiento
+_LUA_EXTENDER = _LUA_AHORA + """
+local plazo = ahora + tonumber(ARGV[1])
+local extendidas = 0
+for i = 2, #ARGV - 1 do
+    extendidas = extendidas + redis.call('ZADD', KEYS[2], 'XX', 'CH', plazo, ARGV[i])
+end
+return extendidas
+"""
+
+# Estado de un shard en O(1). ARGV: envejecimiento.
+# Devuelve {pendientes, en curso, desde de la mas antigua o -1, suma de desde, ahora}
+_LUA_ESTADISTICAS = _LUA_AHORA + """
+local antigua = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+return {redis.call('ZCARD', KEYS[1]), redis.call('ZCARD', KEYS[2]), tonumber(antigua[2] or -1),
+        tonumber(redis.call('GET', KEYS[5]) or 0), ahora}
+"""
+
+
 class HelpDesk:
     _redis = None
+    _asincrono = False
+    _shards = 1
+    _envejecimiento = 0.0
+    _turno = itertools.count()
+    _prefijo = "sesiones"
+    # Claves de antes de los shards, sin hash tag. Lo que quede en ellas se
+    # pasa a las del shard 0 en adelante con migrar_cola
+    _cola = "sesiones:helpdesk_queue"
+    _en_curso = "sesiones:helpdesk_inflight"
+    _peticiones = "sesiones:helpdesk_requests"
+    _desde = "sesiones:helpdesk_since"
+    _suma = "sesiones:helpdesk_since_sum"
+    _script_solicitar = None
+    _script_reclamar = None
+    _script_confirmar = None
+    _script_olvidar = None
+    _script_extender = None
+    _script_estadisticas = None
+    # Segundos que tiene un trabajador para confirmar una peticion antes de que vuelva a la cola
+    visibilidad = 30.0
+    # Reclamadas vencidas que cada llamada a reclamar devuelve a la cola como maximo
+    _max_vencidas = 1000
+    # Con varios shards atender_usuario reclama lotes de este tamaño y guarda
+    # aqui las que aun no ha devuelto, siguen en curso hasta que las devuelve
+    _lote_atender = 10
+    _reservadas = collections.deque()
+    # Espera maxima (s) entre intentos de atender_usuario con la cola vacia
+    _espera_max = 1.0
 
     @classmethod
-    def initRedis(cls, redis_client):
+    def initRedis(cls, redis_client, shards=1, envejecimiento=0.0):
+        """
+        Guarda el cliente y registra los scripts de la cola. Con el cliente
+        sincrono migra tambien lo que quede en las claves sin hash tag.
+
+        Args:
+            redis_client: cliente de Redis con decode_responses=True.
+            shards (int): Claves entre las que se reparten las peticiones.
+            envejecimiento (float): Prioridad que gana una peticion por cada
+                segundo que espera, 0 para ordenar solo por prioridad. Cambiarlo
+                con peticiones pendientes desordena las que ya estan en la cola.
+        """
         cls._redis = redis_client
+        cls._shards = shards
+        cls._envejecimiento = envejecimiento
+        cls._script_solicitar = redis_client.register_script(_LUA_SOLICITAR)
+        cls._script_reclamar = redis_client.register_script(_LUA_RECLAMAR)
+        cls._script_confirmar = redis_client.register_script(_LUA_CONFIRMAR)
+        cls._script_olvidar = redis_client.register_script(_LUA_OLVIDAR)
+        cls._script_extender = redis_client.register_script(_LUA_EXTENDER)
+        cls._script_estadisticas = redis_client.register_script(_LUA_ESTADISTICAS)
+        cls._reservadas = collections.deque()
+        if not cls._asincrono:
+            cls.migrar_cola()
+
+    @classmethod
+    def migrar_cola(cls):
+        """
+        Pasa a las claves con hash tag las peticiones pendientes y en curso
+        que queden en las de antes, con su prioridad. La espera cuenta desde
+        la migracion y las que estaban en curso vuelven a la cola.
+
+        Returns:
+            int: Peticiones migradas.
+        """
+        pipe = cls._redis.pipeline(transaction=False)
+        pipe.zrange(cls._cola, 0, -1, withscores=True)
+        pipe.zrange(cls._en_curso, 0, -1)
+        pipe.hgetall(cls._peticiones)
+        peticiones = cls._peticiones_antiguas(*pipe.execute())
+        if not peticiones:
+            return 0
+        for usuario_id, prioridad in peticiones.items():
+            cls.solicitar_ayuda(usuario_id, prioridad)
+        pipe = cls._redis.pipeline(transaction=False)
+        for clave in cls._claves_antiguas():
+            pipe.delete(clave)
+        pipe.execute()
+        return len(peticiones)
 
     @classmethod
     def solicitar_ayuda(cls, usuario_id, prioridad):
         """
         Registra una petición de ayuda de un usuario con una prioridad.
+        Cada usuario va siempre al mismo shard.
         
         Args:
             usuario_id (str): Identificador del usuario.
             prioridad (int): Prioridad de la petición (mayor valor = mayor prioridad).
         """
         if cls._redis:
-            # Usamos un Sorted Set
-            # Clave: "helpdesk_queue"
-            # Valor: usuario_id
-            # Score: prioridad
-            cls._redis.zadd("sesiones:helpdesk_queue", {str(usuario_id): prioridad})
+            usuario_id = str(usuario_id)
+            cls._script_solicitar(keys=cls._claves(cls._shard(usuario_id)),
+                                  args=[usuario_id, prioridad, cls._envejecimiento])
 
     @classmethod
     def atender_usuario(cls):
         """
         Obtiene la petición de mayor prioridad y la elimina de la cola.
         Si no hay peticiones, se bloquea hasta que llegue una.
+        Si el trabajador cae despues, la petición se pierde: para un grupo
+        de agentes es mejor reclamar/confirmar o despachar. Con varios
+        shards reclama lotes y guarda el resto en el proceso; si cae con
+        ellas guardadas vuelven a la cola al vencer su visibilidad.
         
         Returns:
             str: El usuario_id de la petición atendida.
         """
+        if not cls._redis:
+            return None
+        if cls._shards > 1:
+            # BZPOPMAX de varias claves no vale en Redis Cluster
+            espera = 0.05
+            while True:
+                usuario_id = cls._siguiente_reservada()
+                if usuario_id is not None:
+                    return usuario_id
+                if not cls._reservar():
+                    time.sleep(espera)
+                    espera = min(espera * 2, cls._espera_max)
+        # bzpopmax elimina y devuelve el miembro con mayor score de un sorted set.
+        # Bloquea si está vacío. timeout=0 indica bloqueo indefinido.
+        # Retorna una tupla key, member, score
+        resultado = cls._redis.bzpopmax(cls._claves(0)[0], timeout=0)
+        if resultado:
+            # resultado[1] es el miembro usuario_id
+            cls._script_olvidar(keys=cls._claves(0), args=[resultado[1], cls._envejecimiento])
+            return resultado[1]
+        return None
+
+    @classmethod
+    def reclamar(cls, n=1, visibilidad=None):
+        """
+        Reclama de una vez hasta n peticiones, las de mayor prioridad. No se
+        borran: pasan a estar en curso hasta que se confirman, y si no se
+        confirman en visibilidad segundos vuelven a la cola para otro agente.
+        De paso devuelve a la cola las reclamadas que hayan vencido.
+
+        Con varios shards n se reparte entre todos a partes iguales, con el
+        resto empezando cada vez por un shard distinto, en un viaje; lo
+        que no tengan los shards vacios se pide a los demas, tambien a los
+        que no se pidio nada, hasta tener n o que todos esten vacios.
+
+        Args:
+            n (int): Peticiones a reclamar como maximo.
+            visibilidad (float): Segundos para confirmarlas, por defecto HelpDesk.visibilidad.
+
+        Returns:
+            list[tuple[str, float]]: (usuario_id, prioridad) de las reclamadas, de mayor a menor prioridad efectiva.
+        """
+        reclamadas = []
+        candidatos = cls._orden_shards()
+        while n > len(reclamadas) and candidatos:
+            cuotas = cls._cuotas(n - len(reclamadas), candidatos)
+            respuestas = cls._ejecutar(cls._script_reclamar, [
+                (cls._claves(shard), cls._args_reclamo(cuota, visibilidad)) for shard, cuota in cuotas])
+            candidatos = cls._agotados(candidatos, cuotas, respuestas, reclamadas)
+        return cls._ordenar(reclamadas)
+
+    @classmethod
+    def confirmar(cls, *usuario_ids):
+        """
+        Confirma que las peticiones reclamadas se han atendido.
+
+        Returns:
+            int: Peticiones confirmadas; las que ya habian vuelto a la cola no cuentan.
+        """
+        return sum(cls._ejecutar(cls._script_confirmar, [
+            (cls._claves(shard), [*usuarios, cls._envejecimiento]) for shard, usuarios in cls._por_shard(usuario_ids).items()]))
+
+    @classmethod
+    def extender(cls, *usuario_ids, visibilidad=None):
+        """
+        Da visibilidad segundos mas a peticiones en curso, para atenciones largas.
+
+        Returns:
+            int: Peticiones que seguian en curso y se han extendido.
+        """
+        return sum(cls._ejecutar(cls._script_extender, [
+            (cls._claves(shard), [cls._ms(visibilidad), *usuarios, cls._envejecimiento])
+            for shard, usuarios in cls._por_shard(usuario_ids).items()]))
+
+    @classmethod
+    def reencolar_vencidas(cls):
+        """Devuelve a la cola las peticiones reclamadas cuyo plazo ha vencido."""
+        cls._ejecutar(cls._script_reclamar,
+                      [(cls._claves(shard), cls._args_reclamo(0, None)) for shard in range(cls._shards)])
+
+    @classmethod
+    def estadisticas(cls):
+        """
+        Estado de cada shard, con un script O(1) por shard en un solo viaje.
+
+        Returns:
+            list[dict]: Por shard: pendientes, en_curso, y espera_max y
+            espera_media en segundos de las pendientes.
+        """
+        respuestas = cls._ejecutar(cls._script_estadisticas,
+                                   [(cls._claves(shard), [cls._envejecimiento]) for shard in range(cls._shards)])
+        return [cls._estadistica(shard, respuesta) for shard, respuesta in enumerate(respuestas)]
+
+    @classmethod
+    def despachar(cls, atender, n=10, visibilidad=None, espera=1.0, parar=None):
+        """
+        Bucle de un agente: reclama lotes de hasta n peticiones, llama a
+        atender(usuario_id, prioridad) con cada una y confirma el lote. Una
+        peticion cuyo atender falla no se confirma y vuelve a la cola al
+        vencer, asi que cada peticion se atiende al menos una vez. Se pueden
+        lanzar tantos agentes (hilos o procesos) como haga falta.
+
+        Args:
+            atender (Callable[[str, float], Any]): Atiende una peticion.
+            n (int): Peticiones por lote.
+            visibilidad (float): Segundos para atender un lote.
+            espera (float): Segundos entre intentos con la cola vacia.
+            parar (threading.Event): Termina el bucle al activarse.
+        """
+        parar = parar or threading.Event()
+        while not parar.is_set():
+            lote = cls.reclamar(n, visibilidad)
+            if not lote:
+                parar.wait(espera)
+                continue
+            atendidas = []
+            for usuario_id, prioridad in lote:
+                try:
+                    atender(usuario_id, prioridad)
+                    atendidas.append(usuario_id)
+                except Exception:
+                    logger.exception("Error atendiendo la peticion de %s, se reintentara", usuario_id)
+            if atendidas:
+                cls.confirmar(*atendidas)
+
+    @classmethod
+    def _ejecutar(cls, script, llamadas):
+        # Un viaje para varias llamadas a un script. Pasar el script con
+        # client=pipe añade un SCRIPT EXISTS antes de cada pipeline, asi que va
+        # con EVALSHA y solo las que Redis no conoce se repiten cargandolo
+        if len(llamadas) == 1:
+            claves, args = llamadas[0]
+            return [script(keys=claves, args=args)]
+        pipe = cls._redis.pipeline(transaction=False)
+        for claves, args in llamadas:
+            pipe.evalsha(script.sha, len(claves), *claves, *args)
+        respuestas = pipe.execute(raise_on_error=False)
+        for i, respuesta in enumerate(respuestas):
+            if isinstance(respuesta, redis.exceptions.NoScriptError):
+                claves, args = llamadas[i]
+                respuestas[i] = script(keys=claves, args=args)
+            elif isinstance(respuesta, Exception):
+                raise respuesta
+        return respuestas
+
+    @classmethod
+    def _reservar(cls):
+        reclamadas = cls.reclamar(cls._lote_atender)
+        cls._reservadas.extend(usuario_id for usuario_id, _ in reclamadas)
+        return bool(reclamadas)
+
+    @classmethod
+    def _siguiente_reservada(cls):
+        # Las que han vencido mientras esperaban ya son de otro agente
+        while cls._reservadas:
+            usuario_id = cls._reservadas.popleft()
+            if cls.confirmar(usuario_id):
+                return usuario_id
+        return None
+
+    @classmethod
+    def _claves(cls, shard):
+        prefijo = f"{cls._prefijo}:{{helpdesk:{shard}}}"
+        return [f"{prefijo}:queue", f"{prefijo}:inflight", f"{prefijo}:requests", f"{prefijo}:since", f"{prefijo}:since_sum"]
+
+    @classmethod
+    def _claves_antiguas(cls):
+        return [cls._cola, cls._en_curso, cls._peticiones, cls._desde, cls._suma]
+
+    @staticmethod
+    def _peticiones_antiguas(cola, en_curso, peticiones):
+        # La prioridad guardada en peticiones ("prioridad desde") si la hay,
+        # si no el score de la cola, que antes de envejecer era la prioridad
+        migradas = {usuario: prioridad for usuario, prioridad in cola}
+        migradas.update(dict.fromkeys(en_curso, 0))
+        for usuario in migradas:
+            if usuario in peticiones:
+                migradas[usuario] = float(peticiones[usuario].split()[0])
+        return migradas
+
+    @classmethod
+    def _shard(cls, usuario_id):
+        return zlib.crc32(usuario_id.encode()) % cls._shards if cls._shards > 1 else 0
+
+    @classmethod
+    def _por_shard(cls, usuario_ids):
+        grupos = {}
+        for usuario_id in map(str, usuario_ids):
+            grupos.setdefault(cls._shard(usuario_id), []).append(usuario_id)
+        return grupos
+
+    @classmethod
+    def _orden_shards(cls):
+        # Cada llamada empieza por un shard distinto para repartir el resto
+        inicio = next(cls._turno) % cls._shards
+        return [(inicio + i) % cls._shards for i in range(cls._shards)]
+
+    @staticmethod
+    def _cuotas(n, shards):
+        base, resto = divmod(n, len(shards))
+        return [(shard, base + (i < resto)) for i, shard in enumerate(shards) if base + (i < resto)]
+
+    @staticmethod
+    def _agotados(candidatos, cuotas, respuestas, reclamadas):
+        # Quedan los shards a los que no se ha pedido (con n menor que el numero
+        # de shards hay cuotas de 0), primero, y los que han dado todo lo que se
+        # les pidio; los que se quedan cortos estan vacios y se descartan
+        pedidos = {shard for shard, _ in cuotas}
+        llenos = []
+        for (shard, cuota), respuesta in zip(cuotas, respuestas):
+            reclamadas.extend(respuesta[i:i + 3] for i in range(0, len(respuesta), 3))
+            if len(respuesta) // 3 == cuota:
+                llenos.append(shard)
+        return [shard for shard in candidatos if shard not in pedidos] + llenos
+
+    @staticmethod
+    def _ordenar(reclamadas):
+        reclamadas.sort(key=lambda reclamada: float(reclamada[2]), reverse=True)
+        return [(usuario_id, float(prioridad)) for usuario_id, prioridad, _ in reclamadas]
+
+    @classmethod
+    def _args_reclamo(cls, n, visibilidad):
+        return [n, cls._ms(visibilidad), cls._max_vencidas, cls._envejecimiento]
+
+    @classmethod
+    def _ms(cls, visibilidad):
+        return int((cls.visibilidad if visibilidad is None else visibilidad) * 1000)
+
+    @staticmethod
+    def _estadistica(shard, respuesta):
+        pendientes, en_curso, antigua, suma, ahora = respuesta
+        return {
+            "shard": shard,
+            "pendientes": pendientes,
+            "en_curso": en_curso,
+            "espera_max": (ahora - antigua) / 1000 if antigua >= 0 else 0.0,
+            "espera_media": (ahora * pendientes - suma) / pendientes / 1000 if pendientes else 0.0,
+        }
+
+
+class AsyncHelpDesk(HelpDesk):
+    """
+    Version asyncio de HelpDesk sobre redis.asyncio, mismas colas. initRedis
+    no migra las claves antiguas; si no hay un HelpDesk sincrono que lo haga,
+    hay que esperar a migrar_cola.
+    """
+    _asincrono = True
+
+    @classmethod
+    async def migrar_cola(cls):
+        pipe = cls._redis.pipeline(transaction=False)
+        pipe.zrange(cls._cola, 0, -1, withscores=True)
+        pipe.zrange(cls._en_curso, 0, -1)
+        pipe.hgetall(cls._peticiones)
+        peticiones = cls._peticiones_antiguas(*await pipe.execute())
+        if not peticiones:
+            return 0
+        for usuario_id, prioridad in peticiones.items():
+            await cls.solicitar_ayuda(usuario_id, prioridad)
+        pipe = cls._redis.pipeline(transaction=False)
+        for clave in cls._claves_antiguas():
+            pipe.delete(clave)
+        await pipe.execute()
+        return len(peticiones)
+
+    @classmethod
+    async def solicitar_ayuda(cls, usuario_id, prioridad):
         if cls._redis:
-            # bzpopmax elimina y devuelve el miembro con mayor score de un sorted set.
-            # Bloquea si está vacío. timeout=0 indica bloqueo indefinido.
-            # Retorna una tupla key, member, score
-            resultado = cls._redis.bzpopmax("sesiones:helpdesk_queue", timeout=0)
-            
-            if resultado:
-                # resultado[0] es la key "helpdesk_queue"
-                # resultado[1] es el miembro usuario_id
-                # resultado[2] es el score prioridad
-                return resultado[1]
+            usuario_id = str(usuario_id)
+            await cls._script_solicitar(keys=cls._claves(cls._shard(usuario_id)),
+                                        args=[usuario_id, prioridad, cls._envejecimiento])
+
+    @classmethod
+    async def atender_usuario(cls, timeout=0):
+        """
+        Obtiene la petición de mayor prioridad y la elimina de la cola.
+        Espera sin bloquear el bucle de eventos hasta que llegue una.
+
+        Returns:
+            str: El usuario_id de la petición atendida.
+        """
+        if not cls._redis:
+            return None
+        if cls._shards > 1:
+            limite = time.monotonic() + timeout if timeout else None
+            espera = 0.05
+            while limite is None or time.monotonic() < limite:
+                usuario_id = await cls._siguiente_reservada()
+                if usuario_id is not None:
+                    return usuario_id
+                if not await cls._reservar():
+                    await asyncio.sleep(espera)
+                    espera = min(espera * 2, cls._espera_max)
+            return None
+        resultado = await cls._redis.bzpopmax(cls._claves(0)[0], timeout=timeout)
+        if resultado:
+            await cls._script_olvidar(keys=cls._claves(0), args=[resultado[1], cls._envejecimiento])
+            return resultado[1]
+        return None
+
+    @classmethod
+    async def reclamar(cls, n=1, visibilidad=None):
+        reclamadas = []
+        candidatos = cls._orden_shards()
+        while n > len(reclamadas) and candidatos:
+            cuotas = cls._cuotas(n - len(reclamadas), candidatos)
+            respuestas = await cls._ejecutar(cls._script_reclamar, [
+                (cls._claves(shard), cls._args_reclamo(cuota, visibilidad)) for shard, cuota in cuotas])
+            candidatos = cls._agotados(candidatos, cuotas, respuestas, reclamadas)
+        return cls._ordenar(reclamadas)
+
+    @classmethod
+    async def confirmar(cls, *usuario_ids):
+        return sum(await cls._ejecutar(cls._script_confirmar, [
+            (cls._claves(shard), [*usuarios, cls._envejecimiento]) for shard, usuarios in cls._por_shard(usuario_ids).items()]))
+
+    @classmethod
+    async def extender(cls, *usuario_ids, visibilidad=None):
+        return sum(await cls._ejecutar(cls._script_extender, [
+            (cls._claves(shard), [cls._ms(visibilidad), *usuarios, cls._envejecimiento])
+            for shard, usuarios in cls._por_shard(usuario_ids).items()]))
+
+    @classmethod
+    async def reencolar_vencidas(cls):
+        await cls._ejecutar(cls._script_reclamar,
+                            [(cls._claves(shard), cls._args_reclamo(0, None)) for shard in range(cls._shards)])
+
+    @classmethod
+    async def estadisticas(cls):
+        respuestas = await cls._ejecutar(cls._script_estadisticas,
+                                         [(cls._claves(shard), [cls._envejecimiento]) for shard in range(cls._shards)])
+        return [cls._estadistica(shard, respuesta) for shard, respuesta in enumerate(respuestas)]
+
+    @classmethod
+    async def despachar(cls, atender, n=10, visibilidad=None, espera=1.0, parar=None):
+        """Como HelpDesk.despachar, con atender una corrutina y parar un asyncio.Event."""
+        parar = parar or asyncio.Event()
+        while not parar.is_set():
+            lote = await cls.reclamar(n, visibilidad)
+            if not lote:
+                try:
+                    await asyncio.wait_for(parar.wait(), espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            atendidas = []
+            for usuario_id, prioridad in lote:
+                try:
+                    await atender(usuario_id, prioridad)
+                    atendidas.append(usuario_id)
+                except Exception:
+                    logger.exception("Error atendiendo la peticion de %s, se reintentara", usuario_id)
+            if atendidas:
+                await cls.confirmar(*atendidas)
+
+    @classmethod
+    async def _ejecutar(cls, script, llamadas):
+        if len(llamadas) == 1:
+            claves, args = llamadas[0]
+            return [await script(keys=claves, args=args)]
+        pipe = cls._redis.pipeline(transaction=False)
+        for claves, args in llamadas:
+            pipe.evalsha(script.sha, len(claves), *claves, *args)
+        respuestas = await pipe.execute(raise_on_error=False)
+        for i, respuesta in enumerate(respuestas):
+            if isinstance(respuesta, redis.exceptions.NoScriptError):
+                claves, args = llamadas[i]
+                respuestas[i] = await script(keys=claves, args=args)
+            elif isinstance(respuesta, Exception):
+                raise respuesta
+        return respuestas
+
+    @classmethod
+    async def _reservar(cls):
+        reclamadas = await cls.reclamar(cls._lote_atender)
+        cls._reservadas.extend(usuario_id for usuario_id, _ in reclamadas)
+        return bool(reclamadas)
+
+    @classmethod
+    async def _siguiente_reservada(cls):
+        while cls._reservadas:
+            usuario_id = cls._reservadas.popleft()
+            if await cls.confirmar(usuario_id):
+                return usuario_id
         return None
@@ -0,0 +1,385 @@
+"""
+Importa en bloque documentos de un modelo de models.yml desde un fichero
+NDJSON, CSV o JSON (un array), sin cargarlo entero en memoria. Cada
+registro se valida con los required_vars/admissible_vars del modelo, los
+validos se insertan por lotes con insert_many(ordered=False) y las
+direcciones de cada lote se geocodifican una sola vez aunque se repitan.
+Usa la configuracion de .env como ODM.py.
+
+    python importar.py persona personas.ndjson
+    python importar.py empresa empresas.csv --batch-size 5000 --cache
+    python importar.py persona personas.json --rechazos rechazos.ndjson --resume
+
+Tras cada lote se guarda un checkpoint con los registros procesados y lo
+escrito en el fichero de rechazados; con --resume se continua desde ahi y
+los rechazados se recortan al checkpoint. Un lote que se corto a medias se
+vuelve a insertar entero: con indices unicos los repetidos salen como
+rechazados.
+
+En CSV todos los valores llegan como texto, salvo las celdas con una lista
+o un subdocumento en JSON; para numeros, fechas o booleanos usa NDJSON o
+JSON (admiten Extended JSON, {"$date": ...}).
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import sys
+import time
+from collections.abc import Iterator
+from typing import Any, BinaryIO, TextIO
+
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+import ODM
+
+FORMATOS = {".ndjson": "ndjson", ".jsonl": "ndjson", ".csv": "csv", ".json": "json"}
+
+# Extended JSON ({"$oid": ...}, {"$date": ...}) como en los volcados de mongoexport
+_DECODER = json.JSONDecoder(object_hook=json_util.object_hook)
+_BLOQUE = 1 << 16
+# Un documento de MongoDB no pasa de 16 MB: un elemento mayor esta mal formado
+_MAX_ELEMENTO = 16 << 20
+
+
+def leer_registros(fichero: TextIO, formato: str, saltar: int = 0) -> Iterator[tuple[int, dict | Exception]]:
+    """
+    Lee los registros de un fichero de uno en uno.
+
+    Parameters
+    ----------
+        fichero : TextIO
+            fichero abierto en modo texto
+        formato : str
+            "ndjson", "csv" o "json"
+        saltar : int
+            registros del principio que no se devuelven (al reanudar)
+    Returns
+    -------
+        Iterator[tuple[int, dict | Exception]]
+            (numero de registro desde 1, documento o el error al leerlo).
+            En CSV los valores son texto, salvo listas y subdocumentos JSON.
+            Un elemento mal formado en un array JSON lanza ValueError con su
+            posicion: a partir de ahi no se puede seguir leyendo el array.
+    """
+    if formato == "ndjson":
+        registros = _leer_ndjson(fichero, saltar)
+    elif formato == "csv":
+        registros = _leer_csv(fichero)
+    elif formato == "json":
+        registros = _leer_json(fichero)
+    else:
+        raise ValueError(f"Formato '{formato}' no soportado, usa ndjson, csv o json.")
+    for numero, registro in enumerate(registros, start=1):
+        if numero > saltar:
+            yield numero, registro
+
+
+def _leer_ndjson(fichero: TextIO, saltar: int) -> Iterator[dict | Exception | None]:
+    numero = 0
+    for linea in fichero:
+        if not linea.strip():
+            continue
+        numero += 1
+        if numero <= saltar:
+            # Al reanudar no hace falta decodificar lo ya importado
+            yield None
+            continue
+        try:
+            yield _DECODER.decode(linea)
+        except ValueError as e:
+            yield e
+
+
+def _leer_csv(fichero: TextIO) -> Iterator[dict]:
+    # Las celdas vacias no son campos; las que empiezan por [ o { son listas o subdocumentos
+    for fila in csv.DictReader(fichero):
+        doc = {}
+        for campo, valor in fila.items():
+            if campo is None or valor is None or valor == "":
+                continue
+            if valor[0] in "[{":
+                try:
+                    valor = _DECODER.decode(valor)
+                except ValueError:
+                    pass
+            doc[campo] = valor
+        yield doc
+
+
+def _leer_json(fichero: TextIO) -> Iterator[dict]:
+    """Elementos de un array JSON, leyendo el fichero por bloques."""
+    buffer = fichero.read(_BLOQUE)
+    pos = _saltar_blancos(buffer, 0)
+    if pos == len(buffer):
+        return
+    if buffer[pos] != "[":
+        raise ValueError("El fichero JSON debe ser un array de documentos.")
+    pos += 1
+    # Caracteres del fichero descartados del principio del buffer, para las posiciones de error
+    descartados = 0
+    fin = False
+    while True:
+        pos = _saltar_blancos(buffer, pos, ",")
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            elemento, pos = _DECODER.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            # Solo un elemento cortado por el final del bloque se arregla leyendo mas
+            # (el error queda al final, salvo en un texto o un literal a medias como
+            # "tr"); cualquier otro no se va a arreglar y cargaria el resto del fichero
+            cortado = len(buffer) - e.pos < 16 or e.msg.startswith("Unterminated string")
+            if fin or not cortado or len(buffer) - pos > _MAX_ELEMENTO:
+                raise ValueError(f"Elemento JSON mal formado en el caracter {descartados + e.pos}: {e.msg}") from None
+            bloque = fichero.read(_BLOQUE)
+            fin = not bloque
+            descartados += pos
+            buffer = buffer[pos:] + bloque
+            pos = 0
+            continue
+        yield elemento
+        if pos > _BLOQUE:
+            descartados += pos
+            buffer = buffer[pos:]
+            pos = 0
+
+
+def _saltar_blancos(texto: str, pos: int, otros: str = "") -> int:
+    while pos < len(texto) and (texto[pos].isspace() or texto[pos] in otros):
+        pos += 1
+    return pos
+
+
+def validar(model_class: type, doc: Any) -> str | None:
+    """Devuelve por que el documento no vale para el modelo, o None si vale."""
+    if not isinstance(doc, dict):
+        return "El registro no es un documento."
+    faltan = model_class._required_vars - doc.keys()
+    if faltan:
+        return f"Faltan los atributos requeridos: {', '.join(sorted(faltan))}."
+    sobran = doc.keys() - model_class._admissible_vars
+    if sobran:
+        return f"Atributos no admisibles: {', '.join(sorted(sobran))}."
+    return None
+
+
+def geocodificar(model_class: type, docs: list[dict]) -> None:
+    """
+    Añade las coordenadas del campo de localizacion a los documentos que no
+    las traen. Cada direccion distinta (tras normalizarla) se geocodifica
+    una vez, en la cola de geocodificacion en segundo plano.
+    """
+    campo = model_class._location_var
+    if campo is None:
+        return
+    futures = {}
+    for doc in docs:
+        direccion = doc.get(campo)
+        if isinstance(direccion, str) and direccion and f"{campo}_loc" not in doc:
+            futures.setdefault(ODM.normalizar_direccion(direccion), ODM.GEOCODE_QUEUE.submit(direccion))
+    for doc in docs:
+        direccion = doc.get(campo)
+        if isinstance(direccion, str) and direccion and f"{campo}_loc" not in doc:
+            future = futures[ODM.normalizar_direccion(direccion)]
+            # Sin coordenadas no se guarda nada, como en save()
+            if future.exception() is None and future.result() is not None:
+                doc[f"{campo}_loc"] = future.result()
+
+
+def insertar_lote(model_class: type, docs: list[dict], cachear: bool = False) -> list[tuple[dict, str]]:
+    """
+    Inserta un lote con un insert_many desordenado y actualiza Redis con un
+    pipeline: invalida la cache de consultas del modelo y, con cachear,
+    guarda los documentos en la cache. Devuelve los que fallaron con su error.
+    """
+    traian_id = [doc for doc in docs if "_id" in doc]
+    errores: dict[int, str] = {}
+    try:
+        model_class._db.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        errores = {error["index"]: error.get("errmsg", "") for error in e.details.get("writeErrors", [])}
+
+    if model_class._redis:
+        pipe = model_class._redis.pipeline(transaction=False)
+        fallidos = {id(docs[indice]) for indice in errores}
+        # Puede haber marcas de inexistente de los _id que venian en el fichero
+        claves = [model_class._cache_key(doc["_id"]) for doc in traian_id if id(doc) not in fallidos]
+        if claves:
+            ODM.L1_CACHE.discard(*claves)
+            pipe.publish(ODM.CacheL1.CANAL, ODM.L1_CACHE.mensaje(claves))
+        if cachear:
+            for doc in docs:
+                if id(doc) not in fallidos:
+                    model_class._poner_en_cache(pipe, model_class._cache_key(doc["_id"]), model_class._serializar(doc))
+        elif claves:
+            pipe.delete(*claves)
+        pipe.incr(model_class._version_key())
+        pipe.execute()
+
+    return [(docs[indice], error) for indice, error in errores.items()]
+
+
+def _guardar_checkpoint(ruta: str, estado: dict) -> None:
+    # Se escribe aparte y se renombra, un corte no deja el checkpoint a medias
+    temporal = ruta + ".tmp"
+    with open(temporal, "w") as f:
+        json.dump(estado, f)
+    os.replace(temporal, ruta)
+
+
+def importar(model_class: type, ruta: str, formato: str | None = None, batch_size: int = 1000,
+             cachear: bool = False, geocodificar_direcciones: bool = True, checkpoint: str | None = None,
+             reanudar: bool = False, rechazos: str | None = None, progreso: float = 5.0) -> dict:
+    """
+    Importa un fichero en la coleccion del modelo.
+
+    Parameters
+    ----------
+        model_class : type
+            modelo de destino
+        ruta : str
+            fichero a importar
+        formato : str | None
+            "ndjson", "csv" o "json"; por defecto segun la extension
+        batch_size : int
+            documentos por insert_many
+        cachear : bool
+            guardar tambien los documentos en la cache de Redis
+        geocodificar_direcciones : bool
+            calcular las coordenadas del campo de localizacion
+        checkpoint : str | None
+            fichero donde apuntar lo procesado tras cada lote
+        reanudar : bool
+            continuar desde el checkpoint si existe
+        rechazos : str | None
+            fichero donde escribir los registros rechazados, uno por linea
+            en NDJSON. Se vacia al empezar y al reanudar se recorta a lo que
+            habia en el checkpoint
+        progreso : float
+            segundos entre mensajes de progreso, 0 para no mostrarlos
+    Returns
+    -------
+        dict
+            registros, insertados y rechazados, segundos y documentos/s
+    """
+    formato = formato or FORMATOS.get(os.path.splitext(ruta)[1].lower())
+    if formato is None:
+        raise ValueError(f"No se reconoce el formato de '{ruta}', indicalo con --formato.")
+
+    estado = {"fichero": os.path.abspath(ruta), "modelo": model_class.__name__,
+              "registros": 0, "insertados": 0, "rechazados": 0}
+    if reanudar and checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            anterior = json.load(f)
+        if anterior.get("fichero") != estado["fichero"] or anterior.get("modelo") != estado["modelo"]:
+            raise ValueError(f"El checkpoint '{checkpoint}' es de otra importacion.")
+        estado = anterior
+    inicio_registros = estado["registros"]
+
+    inicio = time.monotonic()
+    with _abrir_rechazos(rechazos, estado) if rechazos else contextlib.nullcontext() as salida:
+        _importar(model_class, ruta, formato, batch_size, cachear, geocodificar_direcciones,
+                  checkpoint, salida, progreso, estado)
+    segundos = time.monotonic() - inicio
+    return {"registros": estado["registros"], "insertados": estado["insertados"], "rechazados": estado["rechazados"],
+            "segundos": segundos, "por_segundo": (estado["registros"] - inicio_registros) / segundos if segundos else 0.0}
+
+
+def _abrir_rechazos(ruta: str, estado: dict) -> BinaryIO:
+    # Lo escrito despues del ultimo checkpoint se va a volver a procesar: fuera
+    if "rechazos_bytes" in estado and os.path.exists(ruta):
+        salida = open(ruta, "ab")
+        salida.truncate(estado["rechazos_bytes"])
+        return salida
+    return open(ruta, "wb")
+
+
+def _importar(model_class: type, ruta: str, formato: str, batch_size: int, cachear: bool,
+              geocodificar_direcciones: bool, checkpoint: str | None, rechazos: BinaryIO | None,
+              progreso: float, estado: dict) -> None:
+    inicio_registros = estado["registros"]
+
+    def rechazar(numero: int, doc: Any, error: str) -> None:
+        estado["rechazados"] += 1
+        if rechazos is not None:
+            linea = json_util.dumps({"registro": numero, "error": error, "documento": doc}) + "\n"
+            rechazos.write(linea.encode("utf-8"))
+
+    inicio = time.monotonic()
+    ultimo_aviso = inicio
+
+    def procesar(lote: list[tuple[int, dict]], ultimo: int) -> None:
+        nonlocal ultimo_aviso
+        docs = [doc for _, doc in lote]
+        if geocodificar_direcciones:
+            geocodificar(model_class, docs)
+        numeros = {id(doc): numero for numero, doc in lote}
+        fallidos = insertar_lote(model_class, docs, cachear) if docs else []
+        for doc, error in fallidos:
+            rechazar(numeros[id(doc)], doc, error)
+        estado["insertados"] += len(docs) - len(fallidos)
+        estado["registros"] = ultimo
+        if rechazos is not None:
+            rechazos.flush()
+            estado["rechazos_bytes"] = rechazos.tell()
+        if checkpoint:
+            _guardar_checkpoint(checkpoint, estado)
+        ahora = time.monotonic()
+        if progreso and ahora - ultimo_aviso >= progreso:
+            ultimo_aviso = ahora
+            ritmo = (estado["registros"] - inicio_registros) / (ahora - inicio)
+            print(f"{estado['registros']} registros, {estado['insertados']} insertados, "
+                  f"{estado['rechazados']} rechazados, {ritmo:.0f} registros/s", file=sys.stderr)
+
+    with open(ruta, newline="" if formato == "csv" else None, encoding="utf-8") as fichero:
+        lote: list[tuple[int, dict]] = []
+        numero = inicio_registros
+        for numero, registro in leer_registros(fichero, formato, saltar=inicio_registros):
+            if isinstance(registro, Exception):
+                rechazar(numero, None, f"Registro ilegible: {registro}")
+                continue
+            error = validar(model_class, registro)
+            if error is not None:
+                rechazar(numero, registro, error)
+                continue
+            lote.append((numero, registro))
+            if len(lote) >= batch_size:
+                procesar(lote, numero)
+                lote = []
+        # El ultimo lote, o solo el checkpoint si acaba en rechazados
+        procesar(lote, numero)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Importa documentos de un modelo desde NDJSON, CSV o JSON.")
+    parser.add_argument("modelo", help="modelo de models.yml")
+    parser.add_argument("fichero", help="fichero a importar")
+    parser.add_argument("--formato", choices=sorted(set(FORMATOS.values())), help="por defecto segun la extension")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documentos por insert_many")
+    parser.add_argument("--cache", action="store_true", help="guardar tambien los documentos en la cache de Redis")
+    parser.add_argument("--no-geocode", action="store_true", help="no calcular las coordenadas de las direcciones")
+    parser.add_argument("--checkpoint", help="fichero de checkpoint (por defecto <fichero>.checkpoint.json)")
+    parser.add_argument("--resume", action="store_true", help="continuar desde el checkpoint")
+    parser.add_argument("--rechazos", help="fichero NDJSON donde guardar los registros rechazados")
+    parser.add_argument("--definitions", default=ODM.DEFINITIONS_PATH or "./models.yml", help="ruta de models.yml")
+    args = parser.parse_args()
+
+    scope = {}
+    ODM.initApp(definitions_path=args.definitions, db_name=ODM.DB_NAME, mongodb_uri=ODM.MONGO_URI, scope=scope)
+    if args.modelo not in scope:
+        parser.error(f"El modelo '{args.modelo}' no esta en {args.definitions}")
+
+    resumen = importar(scope[args.modelo], args.fichero, formato=args.formato, batch_size=args.batch_size,
+                       cachear=args.cache, geocodificar_direcciones=not args.no_geocode,
+                       checkpoint=args.checkpoint or args.fichero + ".checkpoint.json",
+                       reanudar=args.resume, rechazos=args.rechazos)
+    print(f"{resumen['registros']} registros: {resumen['insertados']} insertados, {resumen['rechazados']} rechazados "
+          f"en {resumen['segundos']:.1f}s ({resumen['por_segundo']:.0f} registros/s)")
+
+
+if __name__ == "__main__":
+    main()
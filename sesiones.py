@@ -1,9 +1,120 @@
+import base64
 import redis
 import random
+import secrets
 import time
 
+# Claves (todas con el hash tag {sesiones}, asi caen en el mismo slot de
+# Redis Cluster y un script puede tocar las del usuario y el indice global):
+#   {sesiones}:user:<usuario>     hash con el perfil y el ultimo token
+#   {sesiones}:tokens:<usuario>   zset de las sesiones del usuario por caducidad (ms)
+#   {sesiones}:activas            zset de todos los tokens por caducidad (ms)
+# Una sesion vale mientras su token siga en el zset del usuario sin caducar, y
+# el token lleva el usuario dentro para saber las claves sin leer nada antes.
+# Los zsets se limpian de sesiones caducadas al escribir y al contar, asi que
+# revocar o contar sesiones no necesita recorrer el keyspace.
+# Los usuarios guardados antes en sesiones:user:<usuario> se pasan a la clave
+# nueva en su primer login (o al registrar el mismo nombre), o todos de una
+# vez con migrar_usuarios().
+
+# Momento actual en ms segun el reloj de Redis, igual para todos los procesos
+_LUA_AHORA = """
+local reloj = redis.call('TIME')
+local ahora = tonumber(reloj[1]) * 1000 + math.floor(tonumber(reloj[2]) / 1000)
+"""
+
+# login en un solo viaje: comprueba la contraseña, guarda el token en el perfil
+# y apunta la sesion con su caducidad en los indices.
+# KEYS: usuario, indice del usuario, indice global. ARGV: contraseña, token, TTL.
+# Devuelve -1, -2 si el usuario no existe o {privilegios, token}
+_LUA_LOGIN = """
+local datos = redis.call('HMGET', KEYS[1], 'contrasenia', 'privilegios')
+if not datos[1] then
+    return -2
+end
+if datos[1] ~= ARGV[1] then
+    return -1
+end
+""" + _LUA_AHORA + """
+local caduca = ahora + tonumber(ARGV[3]) * 1000
+redis.call('HSET', KEYS[1], 'tokenSesion', ARGV[2])
+for i = 2, 3 do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', ahora)
+    redis.call('ZADD', KEYS[i], caduca, ARGV[2])
+end
+redis.call('PEXPIREAT', KEYS[2], caduca)
+return {datos[2], ARGV[2]}
+"""
+
+# Cierra una sesion. KEYS: usuario, indice del usuario, indice global.
+# ARGV: token. Devuelve 1 o 0 si no existia
+_LUA_LOGOUT = """
+redis.call('ZREM', KEYS[3], ARGV[1])
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('HGET', KEYS[1], 'tokenSesion') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'tokenSesion', '')
+end
+return 1
+"""
+
+# Cierra todas las sesiones de varios usuarios. KEYS: indice global y, por
+# cada usuario, su clave y su indice. Devuelve por usuario los tokens cerrados
+# (tambien los ya caducados)
+_LUA_REVOCAR = """
+local revocados = {}
+for i = 2, #KEYS, 2 do
+    local tokens = redis.call('ZRANGE', KEYS[i + 1], 0, -1)
+    for j = 1, #tokens, 1000 do
+        redis.call('ZREM', KEYS[1], unpack(tokens, j, math.min(j + 999, #tokens)))
+    end
+    redis.call('DEL', KEYS[i + 1])
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('HSET', KEYS[i], 'tokenSesion', '')
+    end
+    revocados[#revocados + 1] = tokens
+end
+return revocados
+"""
+
+# Sesiones vivas de un indice (de un usuario o el global), quitando las caducadas
+_LUA_CONTAR = _LUA_AHORA + """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ahora)
+return redis.call('ZCARD', KEYS[1])
+"""
+
+# login_token en un solo viaje. KEYS: usuario, indice del usuario. ARGV: token.
+# Devuelve -1 si la sesion caduco o el usuario ya no existe
+_LUA_LOGIN_TOKEN = _LUA_AHORA + """
+local caduca = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if not caduca or tonumber(caduca) <= ahora then
+    return -1
+end
+local privilegios = redis.call('HGET', KEYS[1], 'privilegios')
+if not privilegios then
+    return -1
+end
+return tonumber(privilegios)
+"""
+
 class Sesiones:
     _redis = None
+    _script_login = None
+    _script_login_token = None
+    _script_logout = None
+    _script_revocar = None
+    _script_contar = None
+    _indice_global = "{sesiones}:activas"
+    # Clave de los usuarios antes de llevar hash tag
+    _prefijo_antiguo = "sesiones:user:"
+    # entiendo que el mes tiene 30 dias, si no solo tendria que tocar el 30
+    _ttl_sesion = 30*24*60*60
+    # Cache local de token -> privilegios para login_token, desactivada con TTL 0.
+    # Una sesion que caduca en Redis puede seguir valiendo aqui hasta ese TTL
+    _tokens = {}
+    _tokens_ttl = 0
+    _tokens_max = 10000
 
     def __init__(self, nombreUsuario, contrasenia, nombreCompleto=None, privilegios=None):
         self.nombreUsuario = nombreUsuario
@@ -17,9 +128,9 @@ class Sesiones:
     #creamos usuario con registrar
     def registrar(self):
         """Guarda los datos del usuario en Redis (sin token aún)"""
-        clave_usuario = f"sesiones:user:{self.nombreUsuario}"
+        clave_usuario = self._clave_usuario(self.nombreUsuario)
         
-        if self._redis.exists(clave_usuario):
+        if self._redis.exists(clave_usuario) or self._migrar_usuario(self.nombreUsuario):
             print("El usuario ya existe.")
             return False
 
@@ -36,46 +147,277 @@ class Sesiones:
     # login con user y pass, nos genera un token de sesion
     @classmethod
     def login(cls, nombreUsuario, contrasenia):
-        clave_usuario = f"sesiones:user:{nombreUsuario}"
+        nuevo_token = cls._nuevo_token(nombreUsuario)
+        resultado = cls._script_login(keys=cls._claves_login(nombreUsuario),
+                                      args=[contrasenia, nuevo_token, cls._ttl_sesion])
+        if resultado == -2 and cls._migrar_usuario(nombreUsuario):
+            resultado = cls._script_login(keys=cls._claves_login(nombreUsuario),
+                                          args=[contrasenia, nuevo_token, cls._ttl_sesion])
+        return cls._resultado_login(resultado)
 
-        if not cls._redis.exists(clave_usuario):
-            return -1
+    #login con Token de sesion
+    @classmethod
+    def login_token(cls, token):
+        privilegios = cls._token_cacheado(token)
+        if privilegios is None:
+            # -1 si la sesion expiro o el usuario ya no existe
+            nombreUsuario = cls._usuario_token(token)
+            if nombreUsuario is None:
+                privilegios = -1
+            else:
+                privilegios = cls._script_login_token(keys=cls._claves_usuario(nombreUsuario), args=[token])
+            cls._cachear_token(token, privilegios)
+        return privilegios
 
-        #verificar contraseña
-        pass_guardada = cls._redis.hget(clave_usuario, "contrasenia")
-        if pass_guardada != contrasenia:
-            return -1
+    @classmethod
+    def logout(cls, token):
+        """
+        Cierra una sesion.
 
-        #generar nuevo token
-        nuevo_token = str(random.randint(100000, 999999))
-        privilegios = cls._redis.hget(clave_usuario, "privilegios")
+        Returns:
+            bool: True si la sesion existia.
+        """
+        cls._tokens.pop(token, None)
+        nombreUsuario = cls._usuario_token(token)
+        if nombreUsuario is None:
+            return False
+        return bool(cls._script_logout(keys=cls._claves_login(nombreUsuario), args=[token]))
 
-        #actualizar el token en el perfil del usuario
-        cls._redis.hset(clave_usuario, "tokenSesion", nuevo_token)
+    @classmethod
+    def revocar(cls, *nombresUsuario):
+        """
+        Cierra todas las sesiones de uno o varios usuarios en un solo viaje
+        a Redis, sin recorrer el keyspace.
+
+        Returns:
+            int: Sesiones cerradas.
+        """
+        if not nombresUsuario:
+            return 0
+        return cls._olvidar_tokens(cls._script_revocar(keys=cls._claves_revocar(nombresUsuario)))
 
-        #crear la clave de sesión con expiración
-        clave_sesion = f"sesiones:session:{nuevo_token}"
-        cls._redis.set(clave_sesion, nombreUsuario, ex=30*24*60*60) # entiendo que el mes tiene 30 dias, si no solo tendria que tocar el m number 30
+    @classmethod
+    def sesiones_activas(cls, nombreUsuario=None):
+        """
+        Cuenta las sesiones vivas de un usuario o, sin usuario, de todos.
 
-        return int(privilegios), nuevo_token
+        Returns:
+            int: Numero de sesiones sin caducar.
+        """
+        return cls._script_contar(keys=[cls._indice(nombreUsuario)])
 
-    #login con Token de sesion
     @classmethod
-    def login_token(cls, token):
-        clave_sesion = f"sesiones:session:{token}"
+    def migrar_usuarios(cls):
+        """
+        Pasa de una vez todos los usuarios guardados con las claves antiguas,
+        sin hash tag, a las nuevas. No hace falta para que puedan entrar, el
+        login los migra uno a uno. Sus sesiones no se migran (caducan solas),
+        esos usuarios tienen que volver a hacer login.
+
+        Returns:
+            int: Usuarios migrados.
+        """
+        migrados = 0
+        for clave in cls._redis.scan_iter(match=cls._prefijo_antiguo + "*", count=1000):
+            if cls._migrar_usuario(clave[len(cls._prefijo_antiguo):]):
+                migrados += 1
+        return migrados
+
+    @classmethod
+    def _migrar_usuario(cls, nombreUsuario):
+        # True si el usuario estaba en la clave antigua y ya esta en la nueva.
+        # Si la nueva ya existe gana esa y la antigua se borra sin mas
+        clave = cls._prefijo_antiguo + nombreUsuario
+        datos = cls._redis.hgetall(clave)
+        if not datos:
+            return False
+        migrado = not cls._redis.exists(cls._clave_usuario(nombreUsuario))
+        if migrado:
+            datos["tokenSesion"] = ""
+            cls._redis.hset(cls._clave_usuario(nombreUsuario), mapping=datos)
+        cls._redis.delete(clave)
+        return migrado
+
+    @staticmethod
+    def _nuevo_token(nombreUsuario):
+        # 256 bits: las colisiones entre sesiones no son un problema.
+        # Detras del punto va el usuario, token_urlsafe no usa puntos
+        usuario = base64.urlsafe_b64encode(nombreUsuario.encode()).rstrip(b"=").decode()
+        return f"{secrets.token_urlsafe(32)}.{usuario}"
+
+    @staticmethod
+    def _usuario_token(token):
+        # None si el token no es nuestro o es de antes de llevar el usuario
+        _, punto, usuario = token.partition(".")
+        if not punto:
+            return None
+        try:
+            return base64.urlsafe_b64decode(usuario + "=" * (-len(usuario) % 4)).decode()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _clave_usuario(nombreUsuario):
+        return f"{{sesiones}}:user:{nombreUsuario}"
+
+    @classmethod
+    def _indice(cls, nombreUsuario):
+        return cls._indice_global if nombreUsuario is None else f"{{sesiones}}:tokens:{nombreUsuario}"
+
+    @classmethod
+    def _claves_usuario(cls, nombreUsuario):
+        return [cls._clave_usuario(nombreUsuario), cls._indice(nombreUsuario)]
+
+    @classmethod
+    def _claves_login(cls, nombreUsuario):
+        return cls._claves_usuario(nombreUsuario) + [cls._indice_global]
+
+    @classmethod
+    def _claves_revocar(cls, nombresUsuario):
+        claves = [cls._indice_global]
+        for nombreUsuario in nombresUsuario:
+            claves += cls._claves_usuario(nombreUsuario)
+        return claves
+
+    @classmethod
+    def _olvidar_tokens(cls, revocados):
+        # Solo de la cache de este proceso, el resto los olvida al caducar
+        cerradas = 0
+        for tokens in revocados:
+            cerradas += len(tokens)
+            for token in tokens:
+                cls._tokens.pop(token, None)
+        return cerradas
 
-        # Si la clave no existe, la sesión expiró
-        if not cls._redis.exists(clave_sesion):
+    @classmethod
+    def _resultado_login(cls, resultado):
+        # -2 (usuario inexistente) se devuelve como una contraseña mala
+        if resultado in (-1, -2):
             return -1
+        privilegios, token = int(resultado[0]), resultado[1]
+        cls._cachear_token(token, privilegios)
+        return privilegios, token
 
-        #recuperamos el usuario dueño de la sesión
-        nombreUsuario = cls._redis.get(clave_sesion)
-        clave_usuario = f"sesiones:user:{nombreUsuario}"
+    @classmethod
+    def _token_cacheado(cls, token):
+        if not cls._tokens_ttl:
+            return None
+        cacheado = cls._tokens.get(token)
+        if cacheado is None or cacheado[1] < time.monotonic():
+            return None
+        return cacheado[0]
 
-        #devolvemos privilegios
-        privilegios = cls._redis.hget(clave_usuario, "privilegios")
-        return int(privilegios)
+    @classmethod
+    def _cachear_token(cls, token, privilegios):
+        # Los fallos no se cachean, un login nuevo tiene que valer en el momento
+        if not cls._tokens_ttl or privilegios == -1:
+            return
+        tokens = cls._tokens
+        if len(tokens) >= cls._tokens_max:
+            # Fuera el mas antiguo, los dict conservan el orden de insercion
+            tokens.pop(next(iter(tokens)), None)
+        tokens[token] = (privilegios, time.monotonic() + cls._tokens_ttl)
 
     @classmethod
-    def initRedis(cls, redis_client):
-        cls._redis = redis_client
\ No newline at end of file
+    def initRedis(cls, redis_client, token_cache_ttl=0, token_cache_size=10000):
+        """
+        Guarda el cliente y registra los scripts de login, que luego se
+        llaman con EVALSHA (y se vuelven a cargar solos si Redis los pierde).
+
+        Args:
+            redis_client: cliente de Redis con decode_responses=True.
+            token_cache_ttl (float): segundos que login_token recuerda en el
+                proceso los privilegios de un token, 0 para no recordarlos.
+            token_cache_size (int): tokens como maximo en esa cache.
+        """
+        cls._redis = redis_client
+        cls._script_login = redis_client.register_script(_LUA_LOGIN)
+        cls._script_login_token = redis_client.register_script(_LUA_LOGIN_TOKEN)
+        cls._script_logout = redis_client.register_script(_LUA_LOGOUT)
+        cls._script_revocar = redis_client.register_script(_LUA_REVOCAR)
+        cls._script_contar = redis_client.register_script(_LUA_CONTAR)
+        cls._tokens = {}
+        cls._tokens_ttl = token_cache_ttl
+        cls._tokens_max = token_cache_size
+
+class AsyncSesiones(Sesiones):
+    """Version asyncio de Sesiones sobre redis.asyncio, mismas claves y TTL."""
+
+    async def registrar(self):
+        """Guarda los datos del usuario en Redis (sin token aún)"""
+        clave_usuario = self._clave_usuario(self.nombreUsuario)
+
+        if await self._redis.exists(clave_usuario) or await self._migrar_usuario(self.nombreUsuario):
+            print("El usuario ya existe.")
+            return False
+
+        datos = {
+            "nombreCompleto": self.nombreCompleto,
+            "contrasenia": self.contrasenia,
+            "privilegios": self.privilegios,
+            "tokenSesion": ""
+        }
+
+        await self._redis.hset(clave_usuario, mapping=datos)
+        return True
+
+    @classmethod
+    async def login(cls, nombreUsuario, contrasenia):
+        nuevo_token = cls._nuevo_token(nombreUsuario)
+        resultado = await cls._script_login(keys=cls._claves_login(nombreUsuario),
+                                            args=[contrasenia, nuevo_token, cls._ttl_sesion])
+        if resultado == -2 and await cls._migrar_usuario(nombreUsuario):
+            resultado = await cls._script_login(keys=cls._claves_login(nombreUsuario),
+                                                args=[contrasenia, nuevo_token, cls._ttl_sesion])
+        return cls._resultado_login(resultado)
+
+    @classmethod
+    async def login_token(cls, token):
+        privilegios = cls._token_cacheado(token)
+        if privilegios is None:
+            nombreUsuario = cls._usuario_token(token)
+            if nombreUsuario is None:
+                privilegios = -1
+            else:
+                privilegios = await cls._script_login_token(keys=cls._claves_usuario(nombreUsuario), args=[token])
+            cls._cachear_token(token, privilegios)
+        return privilegios
+
+    @classmethod
+    async def logout(cls, token):
+        cls._tokens.pop(token, None)
+        nombreUsuario = cls._usuario_token(token)
+        if nombreUsuario is None:
+            return False
+        return bool(await cls._script_logout(keys=cls._claves_login(nombreUsuario), args=[token]))
+
+    @classmethod
+    async def revocar(cls, *nombresUsuario):
+        if not nombresUsuario:
+            return 0
+        return cls._olvidar_tokens(await cls._script_revocar(keys=cls._claves_revocar(nombresUsuario)))
+
+    @classmethod
+    async def sesiones_activas(cls, nombreUsuario=None):
+        return await cls._script_contar(keys=[cls._indice(nombreUsuario)])
+
+    @classmethod
+    async def migrar_usuarios(cls):
+        migrados = 0
+        async for clave in cls._redis.scan_iter(match=cls._prefijo_antiguo + "*", count=1000):
+            if await cls._migrar_usuario(clave[len(cls._prefijo_antiguo):]):
+                migrados += 1
+        return migrados
+
+    @classmethod
+    async def _migrar_usuario(cls, nombreUsuario):
+        clave = cls._prefijo_antiguo + nombreUsuario
+        datos = await cls._redis.hgetall(clave)
+        if not datos:
+            return False
+        migrado = not await cls._redis.exists(cls._clave_usuario(nombreUsuario))
+        if migrado:
+            datos["tokenSesion"] = ""
+            await cls._redis.hset(cls._clave_usuario(nombreUsuario), mapping=datos)
+        await cls._redis.delete(clave)
+        return migrado
@@ -0,0 +1,36 @@
+"""
+Precarga la cache de Redis con los documentos mas leidos de cada modelo
+(los que tienen track_access en models.yml), p.ej. tras un despliegue o
+una caida de Redis. Usa la configuracion de .env como ODM.py.
+
+    python warmup.py                        # todos los modelos con track_access
+    python warmup.py persona --top 5000     # solo persona
+    python warmup.py --rate 200             # como mucho 200 documentos/s
+"""
+
+import argparse
+
+import ODM
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Precarga la cache con los documentos mas leidos.")
+    parser.add_argument("modelos", nargs="*", help="modelos a precargar (por defecto los que tienen track_access)")
+    parser.add_argument("--top", type=int, default=1000, help="ids mas leidos a precargar por modelo")
+    parser.add_argument("--rate", type=float, default=ODM.CACHE_WARMUP_RATE, help="documentos por segundo como maximo")
+    parser.add_argument("--batch-size", type=int, default=100, help="ids por consulta a MongoDB")
+    parser.add_argument("--definitions", default=ODM.DEFINITIONS_PATH or "./models.yml", help="ruta de models.yml")
+    args = parser.parse_args()
+
+    scope = {}
+    ODM.initApp(definitions_path=args.definitions, db_name=ODM.DB_NAME, mongodb_uri=ODM.MONGO_URI, scope=scope)
+
+    for nombre in args.modelos or [nombre for nombre, model in scope.items() if model._track_access]:
+        if nombre not in scope:
+            parser.error(f"El modelo '{nombre}' no esta en {args.definitions}")
+        cargados = ODM.calentar_cache(scope[nombre], top=args.top, rate=args.rate, batch_size=args.batch_size)
+        print(f"{nombre}: {cargados} documentos precargados")
+
+
+if __name__ == "__main__":
+    main()